@@ -0,0 +1,147 @@
+"""Benchmark: stored size and CPU cost of each encrypted blob format.
+
+For every file size, encrypts random data (or CSV-like text with
+--data text) into a temporary file with each format, reads it back through
+the streaming decryptor and reports the bytes on disk and the CPU time per
+MiB of plaintext. The legacy whole-file Fernet token has to be held in
+memory, so it is skipped above --legacy-max bytes.
+
+    python benchmarks/blob_format_bench.py --sizes 1K 64K 1M 16M 256M 1G \
+        --data text --output blob_format_bench.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from blob_format import (  # noqa: E402
+    SEGMENT_SIZE, CompressedSegmentEncryptor, FernetSegmentEncryptor, SegmentDecryptor, SegmentEncryptor,
+    decrypt_blob
+)
+
+READ_SIZE = 256 * 1024
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(value: str) -> int:
+    if value[-1].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1].upper()]
+    return int(value)
+
+
+def text_block(size: int) -> bytes:
+    rows = bytearray(b"id,timestamp,user,status,latency_ms\n")
+    row = 0
+    while len(rows) < size:
+        rows += b"%d,2024-01-%02dT%02d:%02d:%02dZ,user%04d,%s,%d\n" % (
+            row, row % 28 + 1, row % 24, row % 60, row * 7 % 60, row * 37 % 5000,
+            (b"ok", b"ok", b"ok", b"error")[row % 4], row * 13 % 900
+        )
+        row += 1
+    return bytes(rows[:size])
+
+
+def plaintext_segments(size: int, segment_size: int, data: str = "random"):
+    # One segment reused throughout: the ciphers do not care and 1 GB stays cheap to generate
+    block = os.urandom(min(size, segment_size)) if data == "random" else text_block(min(size, segment_size))
+    remaining = size
+    while True:
+        chunk = block[:min(remaining, segment_size)]
+        remaining -= len(chunk)
+        yield chunk, remaining == 0
+        if remaining == 0:
+            return
+
+
+def write_segmented(path: Path, encryptor, size: int, data: str):
+    with open(path, "wb") as f:
+        f.write(encryptor.header())
+        for index, (chunk, final) in enumerate(plaintext_segments(size, encryptor.segment_size, data)):
+            f.write(encryptor.encrypt_segment(chunk, index, final))
+        f.write(encryptor.trailer())
+
+
+def read_segmented(path: Path, key: bytes) -> int:
+    decryptor = SegmentDecryptor(key)
+    size = 0
+    with open(path, "rb") as f:
+        while data := f.read(READ_SIZE):
+            for plaintext in decryptor.feed(data):
+                size += len(plaintext)
+    return size + len(decryptor.close())
+
+
+def write_legacy(path: Path, key: bytes, size: int, data: str):
+    plaintext = b"".join(chunk for chunk, _ in plaintext_segments(size, SEGMENT_SIZE, data))
+    path.write_bytes(Fernet(key).encrypt(plaintext))
+
+
+def read_legacy(path: Path, key: bytes) -> int:
+    return len(decrypt_blob(path.read_bytes(), key))
+
+
+def measure(path: Path, write, read, size: int) -> dict:
+    start = time.process_time()
+    write()
+    encrypt_cpu = time.process_time() - start
+    start = time.process_time()
+    assert read() == size
+    decrypt_cpu = time.process_time() - start
+    stored = path.stat().st_size
+    mib = max(size, 1) / 1024 ** 2
+    path.unlink()
+    return {
+        "stored_bytes": stored,
+        "overhead_pct": round((stored - size) / max(size, 1) * 100, 2),
+        "encrypt_cpu_ms_per_mib": round(encrypt_cpu * 1000 / mib, 3),
+        "decrypt_cpu_ms_per_mib": round(decrypt_cpu * 1000 / mib, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["1K", "64K", "1M", "16M", "256M", "1G"])
+    parser.add_argument("--segment-size", type=parse_size, default=SEGMENT_SIZE)
+    parser.add_argument("--legacy-max", type=parse_size, default=parse_size("256M"))
+    parser.add_argument("--data", choices=["random", "text"], default="random")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "blob.enc"
+        for size in map(parse_size, args.sizes):
+            formats = {
+                "v1_fernet_segments": FernetSegmentEncryptor(key, args.segment_size),
+                "v2_aes_256_gcm": SegmentEncryptor(key, args.segment_size, "aes-256-gcm"),
+                "v2_chacha20_poly1305": SegmentEncryptor(key, args.segment_size, "chacha20-poly1305"),
+                "v3_aes_256_gcm_zstd_1": CompressedSegmentEncryptor(key, args.segment_size, level=1),
+                "v3_aes_256_gcm_zstd_3": CompressedSegmentEncryptor(key, args.segment_size, level=3),
+                "v3_aes_256_gcm_zstd_9": CompressedSegmentEncryptor(key, args.segment_size, level=9),
+            }
+            row = {"size": size, "data": args.data}
+            if size <= args.legacy_max:
+                row["legacy_fernet"] = measure(
+                    path, lambda: write_legacy(path, key, size, args.data), lambda: read_legacy(path, key), size
+                )
+            for name, encryptor in formats.items():
+                row[name] = measure(
+                    path, lambda: write_segmented(path, encryptor, size, args.data),
+                    lambda: read_segmented(path, key), size
+                )
+            results.append(row)
+            print(json.dumps(row), flush=True)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Benchmark: dashboard lists via files + $in + Python join vs a single aggregation.
+
+Seeds a throwaway database with one owner holding --files files and
+--attempts access attempts (plus one share link per file), then times the
+first page of /share/links and /access/attempts both ways and counts the
+commands sent to MongoDB.
+
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/dashboard_bench.py \
+        --files 10000 --attempts 1000000 --runs 20 --output dashboard_bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from dashboard import page_with_filenames_pipeline, stream_page  # noqa: E402
+from db_indexes import INDEXES  # noqa: E402
+
+OWNER_ID = "bench-owner"
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def seed(db, files: int, attempts: int, batch: int = 10000):
+    for collection, models in INDEXES.items():
+        await db[collection].create_indexes(models)
+    now = datetime.now(timezone.utc)
+    file_ids = [str(uuid.uuid4()) for _ in range(files)]
+    for start in range(0, files, batch):
+        ids = file_ids[start:start + batch]
+        await db.files.insert_many([
+            {"id": fid, "user_id": OWNER_ID, "filename": f"file-{fid[:8]}.csv",
+             "upload_date": now - timedelta(minutes=i)}
+            for i, fid in enumerate(ids, start)
+        ])
+        await db.share_links.insert_many([
+            {"id": str(uuid.uuid4()), "file_id": fid, "owner_id": OWNER_ID,
+             "link_token": uuid.uuid4().hex, "password_hash": "x", "is_active": True,
+             "created_at": now - timedelta(minutes=i)}
+            for i, fid in enumerate(ids, start)
+        ])
+    for start in range(0, attempts, batch):
+        await db.access_attempts.insert_many([
+            {"id": str(uuid.uuid4()), "file_id": random.choice(file_ids), "owner_id": OWNER_ID,
+             "link_token": "t", "attempted_at": now - timedelta(seconds=i),
+             "password_correct": random.random() < 0.8}
+            for i in range(start, min(start + batch, attempts))
+        ])
+
+
+async def legacy_page(db, collection: str, sort_field: str, limit: int):
+    """What the endpoints did before: every file id into a $in, then join in Python"""
+    user_files = await db.files.find({"user_id": OWNER_ID}, {"_id": 0, "id": 1, "filename": 1}).to_list(None)
+    file_ids = [f["id"] for f in user_files]
+    rows = await db[collection].find({"file_id": {"$in": file_ids}}, {"_id": 0}) \
+        .sort(sort_field, -1).to_list(limit)
+    file_map = {f["id"]: f["filename"] for f in user_files}
+    for row in rows:
+        row["filename"] = file_map.get(row["file_id"], "Unknown")
+    return len(rows)
+
+
+async def pipeline_page(db, collection: str, sort_field: str, limit: int):
+    pipeline = page_with_filenames_pipeline({"owner_id": OWNER_ID}, sort_field, limit, None)
+    size = 0
+    async for chunk in stream_page(db[collection].aggregate(pipeline), collection, sort_field, limit):
+        size += len(chunk)
+    return size
+
+
+async def measure(fn, counter: CommandCounter, runs: int, *args):
+    latencies = []
+    commands = []
+    for _ in range(runs):
+        before = counter.count
+        start = time.perf_counter()
+        await fn(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+        commands.append(counter.count - before)
+    latencies.sort()
+    return {
+        "round_trips": statistics.median(commands),
+        "p50_ms": round(latencies[len(latencies) // 2], 2),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+        "mean_ms": round(statistics.mean(latencies), 2),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--attempts", type=int, default=1000000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded database")
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+                                tz_aware=True, event_listeners=[counter])
+    db = client[f"secureshare_bench_{uuid.uuid4().hex[:8]}"]
+    try:
+        started = time.perf_counter()
+        await seed(db, args.files, args.attempts)
+        results = {
+            "files": args.files,
+            "attempts": args.attempts,
+            "limit": args.limit,
+            "seed_seconds": round(time.perf_counter() - started, 1),
+            "share_links": {
+                "legacy": await measure(legacy_page, counter, args.runs, db, "share_links", "created_at", args.limit),
+                "pipeline": await measure(pipeline_page, counter, args.runs, db, "share_links", "created_at", args.limit),
+            },
+            "access_attempts": {
+                "legacy": await measure(legacy_page, counter, args.runs, db, "access_attempts", "attempted_at", args.limit),
+                "pipeline": await measure(pipeline_page, counter, args.runs, db, "access_attempts", "attempted_at", args.limit),
+            },
+        }
+    finally:
+        if not args.keep:
+            await client.drop_database(db.name)
+        client.close()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,313 @@
+"""Benchmark: offline micro-benchmarks of the upload, download, hashing and dashboard hot paths.
+
+Needs nothing but the backend's own dependencies (no MongoDB, no server):
+
+* crypto: encrypt and decrypt throughput of the upload/download pipeline
+  (new_encryptor, SegmentDecryptor) by file size, for random and text-like
+  data, plus the latency of decrypting one 64 KiB range (SegmentIndex);
+* hashing: bcrypt hash and verify time per rounds setting, and throughput
+  of the dedup HMAC and the chunk SHA-256;
+* storage: LocalBlobStore write and read throughput for each fsync policy
+  and ranged read latency (in a temp dir, or on the disk given by --dir);
+* json: serialising dashboard pages with stream_page.
+
+Every metric name ends with its unit; those ending in _per_s are better
+higher, all others better lower. Results are written as JSON together with
+the commit and machine they were measured on, and --compare reports every
+metric that got worse than an earlier results file by more than
+--threshold percent (exiting with status 1 if any did):
+
+    python benchmarks/hot_paths_bench.py --output bench-main.json
+    python benchmarks/hot_paths_bench.py --quick --compare bench-main.json
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+from passlib.context import CryptContext
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from blob_format import (  # noqa: E402
+    FORMAT_AEAD_COMPRESSED, HEADER_V3, PREAMBLE, SEGMENT_SIZE, TRAILER, SegmentDecryptor, SegmentIndex,
+    new_encryptor, trailer_length
+)
+from blob_format_bench import parse_size, text_block  # noqa: E402
+from blob_store import LocalBlobStore  # noqa: E402
+from dashboard import stream_page  # noqa: E402
+
+SECTIONS = ("crypto", "hashing", "storage", "json")
+READ_SIZE = 256 * 1024
+RANGE_SIZE = 64 * 1024
+MIB = 1024 ** 2
+
+
+def median_seconds(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def throughput(size: int, seconds: float) -> float:
+    return round(size / MIB / seconds, 2) if seconds else float("inf")
+
+
+def plaintext(size: int, data: str) -> bytes:
+    block = os.urandom(min(size, SEGMENT_SIZE)) if data == "random" else text_block(min(size, SEGMENT_SIZE))
+    return (block * (size // max(len(block), 1) + 1))[:size]
+
+
+def encrypt(key: bytes, data: bytes) -> bytes:
+    """What store_encrypted_upload does, in memory"""
+    segments = [data[offset:offset + SEGMENT_SIZE] for offset in range(0, len(data), SEGMENT_SIZE)] or [b""]
+    encryptor = new_encryptor(key, segments[0])
+    parts = [encryptor.header()]
+    parts += [encryptor.encrypt_segment(chunk, i, i == len(segments) - 1) for i, chunk in enumerate(segments)]
+    parts.append(encryptor.trailer())
+    return b"".join(parts)
+
+
+def decrypt(key: bytes, blob: bytes) -> int:
+    """What iter_decrypted_blob does, in memory"""
+    decryptor = SegmentDecryptor(key)
+    size = 0
+    for offset in range(0, len(blob), READ_SIZE):
+        for chunk in decryptor.feed(blob[offset:offset + READ_SIZE]):
+            size += len(chunk)
+    return size + len(decryptor.close())
+
+
+def decrypt_range(key: bytes, blob: bytes, start: int, end: int) -> bytes:
+    """What iter_decrypted_range does, in memory"""
+    trailer = b""
+    if PREAMBLE.unpack_from(blob)[1] == FORMAT_AEAD_COMPRESSED:
+        trailer = blob[-trailer_length(blob[-TRAILER.size:]):]
+    index = SegmentIndex(key, blob[:HEADER_V3.size], len(blob), trailer)
+    segment, offset, length = index.locate(start, end)
+    position = segment * index.segment_size
+    covering = blob[offset:offset + length]
+    out = []
+    while covering:
+        stored_size = index.stored_size(segment)
+        data = index.decrypt_segment(segment, covering[:stored_size])
+        out.append(data[max(0, start - position):end - position + 1])
+        covering = covering[stored_size:]
+        position += len(data)
+        segment += 1
+    return b"".join(out)
+
+
+def bench_crypto(args) -> dict:
+    results = {}
+    key = Fernet.generate_key()
+    for data_kind in ("random", "text"):
+        for label in args.sizes:
+            size = parse_size(label)
+            data = plaintext(size, data_kind)
+            blob = encrypt(key, data)
+            assert decrypt(key, blob) == size
+            prefix = f"crypto.{data_kind}.{label}"
+            results[f"{prefix}.encrypt_mib_per_s"] = throughput(size, median_seconds(lambda: encrypt(key, data), args.repeat))
+            results[f"{prefix}.decrypt_mib_per_s"] = throughput(size, median_seconds(lambda: decrypt(key, blob), args.repeat))
+            results[f"{prefix}.stored_ratio"] = round(len(blob) / max(size, 1), 4)
+            if size > RANGE_SIZE:
+                start = size // 2
+                end = start + RANGE_SIZE - 1
+                assert decrypt_range(key, blob, start, end) == data[start:end + 1]
+                results[f"{prefix}.range_64k_ms"] = round(
+                    median_seconds(lambda: decrypt_range(key, blob, start, end), args.repeat) * 1000, 3
+                )
+    return results
+
+
+def bench_hashing(args) -> dict:
+    # passlib warns about the bcrypt package's version attribute on every load
+    logging.getLogger("passlib").setLevel(logging.ERROR)
+    results = {}
+    for rounds in args.bcrypt_rounds:
+        context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+        hashed = context.hash("correct horse battery staple")
+        repeat = max(1, args.repeat if rounds < 12 else min(args.repeat, 3))
+        results[f"hashing.bcrypt.rounds_{rounds}.hash_ms"] = round(
+            median_seconds(lambda: context.hash("correct horse battery staple"), repeat) * 1000, 2
+        )
+        results[f"hashing.bcrypt.rounds_{rounds}.verify_ms"] = round(
+            median_seconds(lambda: context.verify("correct horse battery staple", hashed), repeat) * 1000, 2
+        )
+
+    data = os.urandom(16 * MIB)
+    owner_key = os.urandom(32)
+    results["hashing.dedup_hmac_sha256_mib_per_s"] = throughput(
+        len(data), median_seconds(lambda: hmac.new(owner_key, data, hashlib.sha256).digest(), args.repeat)
+    )
+    results["hashing.chunk_sha256_mib_per_s"] = throughput(
+        len(data), median_seconds(lambda: hashlib.sha256(data).digest(), args.repeat)
+    )
+    return results
+
+
+async def _write(store: LocalBlobStore, key: str, data: bytes, chunk_size: int):
+    async def chunks():
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    await store.put(key, chunks())
+
+
+async def _read(store: LocalBlobStore, key: str, offset: int = 0, length=None) -> int:
+    return sum([len(chunk) async for chunk in store.get(key, offset, length)])
+
+
+def bench_storage(args) -> dict:
+    results = {}
+    size = parse_size(args.blob_size)
+    data = os.urandom(size)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for fsync in ("always", "close", "never"):
+            store = LocalBlobStore(Path(tmp), fsync=fsync)
+            key = f"bench_{fsync}.enc"
+            prefix = f"storage.fsync_{fsync}"
+            results[f"{prefix}.write_mib_per_s"] = throughput(
+                size, median_seconds(lambda: asyncio.run(_write(store, key, data, SEGMENT_SIZE)), args.repeat)
+            )
+            # Reads are served from the page cache right after the write
+            results[f"{prefix}.read_mib_per_s"] = throughput(
+                size, median_seconds(lambda: asyncio.run(_read(store, key)), args.repeat)
+            )
+            offsets = [random.randrange(max(1, size - RANGE_SIZE)) for _ in range(32)]
+
+            async def ranged_reads():
+                for offset in offsets:
+                    await _read(store, key, offset, RANGE_SIZE)
+
+            results[f"{prefix}.range_64k_ms"] = round(
+                median_seconds(lambda: asyncio.run(ranged_reads()), args.repeat) / len(offsets) * 1000, 3
+            )
+            asyncio.run(store.delete(key))
+    return results
+
+
+def dashboard_rows(count: int):
+    now = datetime.now(timezone.utc)
+    return [
+        {"id": str(uuid.uuid4()), "file_id": str(uuid.uuid4()), "owner_id": "bench-owner",
+         "owner_email": "owner@example.com", "filename": f"report-{i}.csv", "decoy_filename": f"decoy-{i}.csv",
+         "link_token": uuid.uuid4().hex, "expiry_date": now + timedelta(hours=24), "download_limit": 5,
+         "downloads_count": i % 5, "is_active": True, "created_at": now - timedelta(minutes=i)}
+        for i in range(count)
+    ]
+
+
+async def _stream(rows, limit: int) -> int:
+    async def cursor():
+        for row in rows:
+            yield row
+
+    return sum([len(chunk) async for chunk in stream_page(cursor(), "links", "created_at", limit)])
+
+
+def bench_json(args) -> dict:
+    results = {}
+    for page_size in args.page_sizes:
+        # One extra row, as the aggregation returns when there is a next page
+        rows = dashboard_rows(page_size + 1)
+        seconds = median_seconds(lambda: asyncio.run(_stream(rows, page_size)), args.repeat)
+        results[f"json.stream_page.rows_{page_size}.page_ms"] = round(seconds * 1000, 3)
+        results[f"json.stream_page.rows_{page_size}.rows_per_s"] = round(page_size / seconds)
+        results[f"json.stream_page.rows_{page_size}.page_bytes"] = asyncio.run(_stream(rows, page_size))
+    return results
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "measured_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "segment_size": SEGMENT_SIZE,
+        "args": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Print every metric that moved by more than threshold percent; returns the number of regressions"""
+    regressions = 0
+    for name, value in sorted(results.items()):
+        before = baseline.get(name)
+        if not before or not isinstance(value, (int, float)):
+            continue
+        change = (value - before) / before * 100
+        worse = -change if name.endswith("_per_s") else change
+        if abs(change) >= threshold:
+            status = "REGRESSED" if worse > 0 else "improved"
+            regressions += worse > 0
+            print(f"{status:<10} {name}: {before} -> {value} ({change:+.1f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer repeats, for a fast check")
+    parser.add_argument("--sizes", nargs="+", help="crypto file sizes (default 64K 1M 16M 64M)")
+    parser.add_argument("--bcrypt-rounds", nargs="+", type=int, help="default 4 8 10 12")
+    parser.add_argument("--blob-size", help="storage blob size (default 64M)")
+    parser.add_argument("--page-sizes", nargs="+", type=int, help="dashboard page sizes (default 100 1000)")
+    parser.add_argument("--repeat", type=int, help="runs per measurement; the median is reported (default 5)")
+    parser.add_argument("--dir", help="directory for the storage benchmark (default: a temp dir)")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change reported by --compare")
+    args = parser.parse_args()
+
+    args.sizes = args.sizes or (["64K", "1M"] if args.quick else ["64K", "1M", "16M", "64M"])
+    args.bcrypt_rounds = args.bcrypt_rounds or ([4, 8] if args.quick else [4, 8, 10, 12])
+    args.blob_size = args.blob_size or ("8M" if args.quick else "64M")
+    args.page_sizes = args.page_sizes or ([100] if args.quick else [100, 1000])
+    args.repeat = args.repeat or (2 if args.quick else 5)
+
+    benches = {"crypto": bench_crypto, "hashing": bench_hashing, "storage": bench_storage, "json": bench_json}
+    results = {}
+    for section in args.only:
+        section_results = benches[section](args)
+        for name, value in section_results.items():
+            print(f"{name}: {value}", flush=True)
+        results.update(section_results)
+
+    report = {"meta": metadata(args), "results": results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        print(f"Compared with {baseline['meta'].get('commit')} ({baseline['meta'].get('measured_at')}):")
+        if compare(results, baseline["results"], args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
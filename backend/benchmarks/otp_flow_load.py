@@ -0,0 +1,274 @@
+"""Load test: concurrent recipients through the whole OTP share-access flow, in process.
+
+Runs the FastAPI app inside this process (httpx over ASGI, no network)
+against a throwaway database: a real MongoDB with --mongo-url, otherwise
+an in-memory stand-in (pip install mongomock-motor). Emails go through
+the real outbox to a transport that captures them, so each OTP reaches
+the recipient the way it reaches a file owner.
+
+Setup creates --links share links, each owned by its own user and
+pointing at a file whose real and decoy sizes are drawn from --file-sizes.
+Then --recipients concurrent recipients each run --flows times through:
+
+    POST /access/request-otp -> owner email (OTP) -> POST /access/verify-otp
+    (correct password, or a wrong one with probability --decoy-ratio)
+    -> GET /access/download/{ticket}
+
+The report has p50/p95/p99 latency per step, flows and bytes per second,
+event-loop lag (how late a 10 ms timer fires) and peak RSS of this process
+(the bcrypt worker processes are not included).
+
+    python benchmarks/otp_flow_load.py --recipients 50 --links 10 --flows 4 \
+        --decoy-ratio 0.2 --file-sizes 64K:6 1M:3 16M:1 --output otp_flow_load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from blob_format_bench import parse_size  # noqa: E402
+from hot_paths_bench import metadata  # noqa: E402
+
+OTP_SUBJECT = "File Access Authorization Required"
+OTP_PATTERN = re.compile(r">(\d{6})</p>")
+PASSWORD = "load-test-password"
+
+
+class CapturingTransport:
+    """Email transport that hands each OTP to whoever is waiting on that owner's address."""
+
+    def __init__(self):
+        self.otps = defaultdict(asyncio.Queue)
+        self.sent = 0
+
+    async def send(self, message: dict):
+        self.sent += 1
+        if OTP_SUBJECT in message["subject"]:
+            match = OTP_PATTERN.search(message["html"])
+            if match:
+                self.otps[message["to"]].put_nowait((time.perf_counter(), match.group(1)))
+
+    async def close(self):
+        pass
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(len(values) * q))], 2)
+
+    return {
+        "count": len(values),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(values[-1], 2),
+        "mean_ms": round(statistics.mean(values), 2),
+    }
+
+
+def parse_distribution(items):
+    """["64K:6", "1M:3", "16M"] -> ([65536, 1048576, 16777216], [6.0, 3.0, 1.0])"""
+    sizes, weights = [], []
+    for item in items:
+        size, _, weight = item.partition(":")
+        sizes.append(parse_size(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def load_server(args, tmp: str):
+    """Import server.py wired to the throwaway database, blob directory and email capture"""
+    os.environ["DB_NAME"] = f"secureshare_load_{uuid.uuid4().hex[:8]}"
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["BLOB_STORE"] = "local"
+    os.environ["BLOB_STORE_PATH"] = tmp
+    os.environ["EMAIL_TRANSPORT"] = "local"
+    os.environ["SWEEPER_INTERVAL_SECONDS"] = "0"
+    if not args.mongo_url:
+        try:
+            import motor.motor_asyncio
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("Without --mongo-url the in-memory stand-in is needed: pip install mongomock-motor")
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    import server
+    return server
+
+
+async def setup_links(client, args, file_sizes):
+    """Owners, files and share links; returns [(link_token, owner_email, real_size, decoy_size)]"""
+    sizes, weights = file_sizes
+    links = []
+    for i in range(args.links):
+        email = f"owner-{i}-{uuid.uuid4().hex[:6]}@example.com"
+        response = await client.post("/api/auth/register", json={"email": email, "password": PASSWORD, "name": f"Owner {i}"})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['token']}"}
+        real_size, decoy_size = random.choices(sizes, weights, k=2)
+        response = await client.post("/api/files/upload", headers=headers, files={
+            "real_file": (f"real-{i}.bin", os.urandom(real_size)),
+            "decoy_file": (f"decoy-{i}.bin", os.urandom(decoy_size)),
+        })
+        response.raise_for_status()
+        response = await client.post("/api/share/create", headers=headers, json={
+            "file_id": response.json()["file_id"], "password": PASSWORD,
+            "expiry_hours": 24, "download_limit": 10 ** 9
+        })
+        response.raise_for_status()
+        links.append((response.json()["link_token"], email, real_size, decoy_size))
+    return links
+
+
+async def recipient(client, transport, links, args, latencies, counters):
+    for _ in range(args.flows):
+        link_token, owner_email, real_size, decoy_size = random.choice(links)
+        decoy = random.random() < args.decoy_ratio
+        try:
+            start = time.perf_counter()
+            response = await client.post("/api/access/request-otp", json={"link_token": link_token})
+            response.raise_for_status()
+            requested = time.perf_counter()
+            latencies["request-otp"].append((requested - start) * 1000)
+
+            delivered, otp = await asyncio.wait_for(transport.otps[owner_email].get(), args.otp_timeout)
+            latencies["otp-email"].append((max(delivered, requested) - requested) * 1000)
+
+            verify_start = time.perf_counter()
+            response = await client.post(
+                "/api/access/verify-otp",
+                headers={"Accept": "application/json"},
+                json={"link_token": link_token, "otp": otp, "password": "wrong-password" if decoy else PASSWORD}
+            )
+            response.raise_for_status()
+            latencies["verify-otp"].append((time.perf_counter() - verify_start) * 1000)
+
+            download_start = time.perf_counter()
+            response = await client.get(response.json()["download_url"])
+            response.raise_for_status()
+            latencies["download"].append((time.perf_counter() - download_start) * 1000)
+            if len(response.content) != (decoy_size if decoy else real_size):
+                raise ValueError(f"Downloaded {len(response.content)} bytes from {link_token}")
+
+            latencies["flow"].append((time.perf_counter() - start) * 1000)
+            counters["decoy" if decoy else "real"] += 1
+            counters["bytes"] += len(response.content)
+        except Exception as e:
+            counters["errors"] += 1
+            if counters["errors"] <= 5:
+                print(f"flow failed: {e!r}", file=sys.stderr)
+
+
+async def run(args):
+    import httpx
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = load_server(args, tmp)
+        transport = CapturingTransport()
+        server.email_outbox.transport = transport
+        for handler in server.app.router.on_startup:
+            await handler()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://load.test",
+                                   timeout=None)
+        try:
+            started = time.perf_counter()
+            links = await setup_links(client, args, parse_distribution(args.file_sizes))
+            setup_seconds = time.perf_counter() - started
+
+            latencies = defaultdict(list)
+            counters = defaultdict(int)
+            monitor = LoopLagMonitor()
+            monitor.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                recipient(client, transport, links, args, latencies, counters) for _ in range(args.recipients)
+            ))
+            elapsed = time.perf_counter() - started
+            await monitor.stop()
+        finally:
+            await client.aclose()
+            for handler in server.app.router.on_shutdown:
+                await handler()
+            if args.mongo_url:
+                await server.client.drop_database(os.environ["DB_NAME"])
+
+    flows = counters["real"] + counters["decoy"]
+    lags = sorted(monitor.lags)
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "meta": metadata(args),
+        "setup_seconds": round(setup_seconds, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "flows": flows,
+        "real_downloads": counters["real"],
+        "decoy_downloads": counters["decoy"],
+        "errors": counters["errors"],
+        "flows_per_second": round(flows / elapsed, 2) if elapsed else None,
+        "download_mib_per_second": round(counters["bytes"] / 1024 ** 2 / elapsed, 2) if elapsed else None,
+        "latency": {step: percentiles(latencies[step])
+                    for step in ("request-otp", "otp-email", "verify-otp", "download", "flow")},
+        "event_loop_lag": percentiles(lags),
+        "peak_rss_bytes": peak_rss,
+        "emails_sent": transport.sent,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=20, help="concurrent recipients")
+    parser.add_argument("--links", type=int, default=5, help="share links (one owner and file each)")
+    parser.add_argument("--flows", type=int, default=5, help="flows per recipient")
+    parser.add_argument("--decoy-ratio", type=float, default=0.2, help="share of flows using a wrong password")
+    parser.add_argument("--file-sizes", nargs="+", default=["64K:6", "1M:3", "8M:1"],
+                        help="file size distribution as SIZE[:WEIGHT] ...")
+    parser.add_argument("--otp-timeout", type=float, default=30.0, help="seconds to wait for an OTP email")
+    parser.add_argument("--mongo-url", help="MongoDB to use (a throwaway database is created and dropped)")
+    parser.add_argument("--seed", type=int, help="random seed for link choice, sizes and the decoy mix")
+    parser.add_argument("--output", help="write the report as JSON to this path")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
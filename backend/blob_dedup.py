@@ -0,0 +1,131 @@
+"""Content-addressed, per-owner deduplication of uploaded blobs.
+
+Every uploaded payload is identified by an HMAC-SHA256 of its plaintext
+under a key derived from the server secret and the owner's id. The digest
+never matches across owners (so dedup cannot be used to confirm whether
+someone else holds a file) and reveals nothing about the content without
+the secret.
+
+db.blobs holds one refcounted record per stored payload:
+
+    {id: digest, owner_id, blob_key, encryption_key, blob_format, size, refcount, created_at}
+
+An upload whose digest is already known takes a reference and reuses the
+stored blob and its key; deleting a file releases its references and the
+blob is removed with its last one. Blob keys carry a generation suffix, so
+a blob being deleted is never confused with a fresh copy of the same
+payload stored concurrently.
+"""
+import base64
+import hashlib
+import hmac
+import uuid
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class BlobDeduplicator:
+    def __init__(self, collection, blob_store, secret: str):
+        self.collection = collection
+        self.blob_store = blob_store
+        self._secret = secret.encode()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def hasher(self, owner_id: str):
+        """Incremental digest of an owner's payload (feed it the plaintext with update())"""
+        owner_key = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=f"secureshare dedup {owner_id}".encode()
+        ).derive(self._secret)
+        return hmac.new(owner_key, digestmod=hashlib.sha256)
+
+    async def acquire(self, owner_id: str, digest: str, size: int, generate_key: Callable[[], bytes],
+                      store: Callable[[str, bytes], Awaitable[int]]) -> dict:
+        """Reference the blob for digest, storing it with store(blob_key, key) if it is new; returns its record.
+
+        store returns the format the blob was written in.
+        """
+        while True:
+            record = await self.collection.find_one_and_update(
+                {"id": digest, "refcount": {"$gt": 0}},
+                {"$inc": {"refcount": 1}},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            if record:
+                self.hits += 1
+                self.bytes_saved += record["size"]
+                return record
+
+            key = generate_key()
+            record = {
+                "id": digest,
+                "owner_id": owner_id,
+                "blob_key": f"cas_{digest}.{uuid.uuid4().hex[:8]}.enc",
+                "encryption_key": base64.b64encode(key).decode(),
+                "size": size,
+                "refcount": 1,
+                "created_at": datetime.now(timezone.utc)
+            }
+            record["blob_format"] = await store(record["blob_key"], key)
+            try:
+                # A record left at refcount 0 by a release still being cleaned up is replaced
+                previous = await self.collection.find_one_and_replace(
+                    {"id": digest, "refcount": {"$lte": 0}}, record, upsert=True
+                )
+            except DuplicateKeyError:
+                # Someone stored the same payload first: use theirs
+                await self.blob_store.delete(record["blob_key"])
+                continue
+            if previous:
+                # That release can no longer match its record, so its blob is ours to delete
+                await self.blob_store.delete(previous["blob_key"])
+            record.pop("_id", None)
+            self.misses += 1
+            return record
+
+    async def release(self, digest: str):
+        """Drop one reference; the blob is deleted with the last one"""
+        record = await self.collection.find_one_and_update(
+            {"id": digest},
+            {"$inc": {"refcount": -1}},
+            projection={"_id": 0, "blob_key": 1, "refcount": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not record or record["refcount"] > 0:
+            return
+        result = await self.collection.delete_one({"id": digest, "blob_key": record["blob_key"], "refcount": {"$lte": 0}})
+        if result.deleted_count:
+            await self.blob_store.delete(record["blob_key"])
+
+    async def owner_stats(self, owner_id: str) -> dict:
+        totals = await self.collection.aggregate([
+            {"$match": {"owner_id": owner_id, "refcount": {"$gt": 0}}},
+            {"$group": {
+                "_id": None,
+                "blobs": {"$sum": 1},
+                "references": {"$sum": "$refcount"},
+                "stored_bytes": {"$sum": "$size"},
+                "logical_bytes": {"$sum": {"$multiply": ["$size", "$refcount"]}}
+            }}
+        ]).to_list(1)
+        totals = totals[0] if totals else {"blobs": 0, "references": 0, "stored_bytes": 0, "logical_bytes": 0}
+        totals.pop("_id", None)
+        totals["bytes_saved"] = totals["logical_bytes"] - totals["stored_bytes"]
+        totals["dedup_ratio"] = round(totals["logical_bytes"] / totals["stored_bytes"], 3) if totals["stored_bytes"] else None
+        return totals
+
+    def stats(self) -> dict:
+        uploads = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / uploads, 4) if uploads else None,
+            "bytes_saved": self.bytes_saved
+        }
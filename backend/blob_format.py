@@ -0,0 +1,503 @@
+"""On-disk format for encrypted file blobs.
+
+Four layouts can be found in the blob store:
+
+* legacy blobs: one Fernet token covering the whole file (no header).
+* format 1: a fixed header followed by length-prefixed Fernet tokens, one
+  per plaintext segment.
+* format 2 (written for new uploads): a header naming the AEAD algorithm,
+  segment size and nonce prefix, followed by raw binary AES-256-GCM or
+  ChaCha20-Poly1305 segments. Every segment but the last holds exactly
+  segment_size bytes of plaintext plus a 16-byte tag, so there is no
+  framing and no base64 overhead.
+* format 3 (new uploads that compress well): format 2 with a compression
+  stage. The header also names the codec; each segment is compressed
+  (or kept as is when that does not make it smaller) before encryption
+  and stored with a length frame, and a trailer listing the stored segment
+  lengths follows the final segment.
+
+Whether a file is written as format 2 or 3 is decided from a sample of
+its first segment (new_encryptor), so incompressible files pay nothing.
+
+Readers dispatch on the header, so every layout stays readable, and
+format 2 and 3 blobs can also be read from any offset (SegmentIndex). In
+every segmented format each segment authenticates its own index and a
+"final" flag, so a blob cannot be truncated or have its segments reordered
+without decryption failing.
+"""
+import base64
+import os
+import struct
+from typing import Iterator, List
+
+import zstandard
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"SSBLOB"
+FORMAT_SEGMENTED_FERNET = 1
+FORMAT_AEAD = 2
+FORMAT_AEAD_COMPRESSED = 3
+
+ALGORITHM_AES_256_GCM = 1
+ALGORITHM_CHACHA20_POLY1305 = 2
+ALGORITHMS = {
+    "aes-256-gcm": ALGORITHM_AES_256_GCM,
+    "chacha20-poly1305": ALGORITHM_CHACHA20_POLY1305,
+}
+_CIPHERS = {
+    ALGORITHM_AES_256_GCM: AESGCM,
+    ALGORITHM_CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+
+CODEC_ZSTD = 1
+CODECS = {
+    "zstd": CODEC_ZSTD,
+}
+
+SEGMENT_SIZE = int(os.environ.get("ENCRYPTION_SEGMENT_SIZE", 1024 * 1024))
+ALGORITHM = os.environ.get("ENCRYPTION_ALGORITHM", "aes-256-gcm")
+# "zstd", or "none" to always write format 2
+COMPRESSION = os.environ.get("ENCRYPTION_COMPRESSION", "zstd")
+COMPRESSION_LEVEL = int(os.environ.get("ENCRYPTION_COMPRESSION_LEVEL", 3))
+# Bytes of the first segment compressed to decide whether a file is worth compressing
+COMPRESSION_SAMPLE_SIZE = 128 * 1024
+# Smallest saving on the sample (as a fraction) for which a file is compressed
+COMPRESSION_MIN_SAVING = 0.1
+
+# magic, format version (common to every segmented format)
+PREAMBLE = struct.Struct(">6sB")
+# format 1: magic, format version, plaintext segment size
+HEADER = struct.Struct(">6sBI")
+# format 2: magic, format version, algorithm, plaintext segment size, nonce prefix
+HEADER_V2 = struct.Struct(">6sBBI7s")
+# format 3: magic, format version, algorithm, codec, plaintext segment size, nonce prefix
+HEADER_V3 = struct.Struct(">6sBBBI7s")
+# format 1: length of the Fernet token that follows
+# format 3: length of the segment that follows, with the final flag in the top bit
+FRAME = struct.Struct(">I")
+FINAL_FLAG = 0x80000000
+# format 3: plaintext size, segment count, marker (after the stored length of every segment)
+TRAILER = struct.Struct(">QI6s")
+TRAILER_MAGIC = b"SSIDX1"
+# format 3: first byte of every segment's plaintext
+SEGMENT_RAW = 0
+SEGMENT_COMPRESSED = 1
+# format 1: segment index, final flag (prepended to the plaintext inside each token)
+SEGMENT_PREFIX = struct.Struct(">QB")
+# format 2: segment index, final flag (appended to the nonce prefix to form the 96-bit nonce)
+NONCE_SUFFIX = struct.Struct(">IB")
+TAG_SIZE = 16
+
+
+class BlobFormatError(ValueError):
+    """Raised when a blob is corrupt, truncated or fails authentication."""
+
+
+def is_segmented(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def _aead(key: bytes, algorithm: int):
+    """AEAD cipher for a file's (Fernet-encoded) key; the raw key is never used directly"""
+    if algorithm not in _CIPHERS:
+        raise BlobFormatError("Unsupported encryption algorithm")
+    derived = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None,
+        info=b"secureshare blob v2 %d" % algorithm
+    ).derive(base64.urlsafe_b64decode(key))
+    return _CIPHERS[algorithm](derived)
+
+
+def _decompress(codec: int, data: bytes, limit: int) -> bytes:
+    if codec != CODEC_ZSTD:
+        raise BlobFormatError("Unsupported compression codec")
+    try:
+        plaintext = zstandard.ZstdDecompressor().decompress(data, max_output_size=limit)
+    except zstandard.ZstdError as e:
+        raise BlobFormatError("Segment failed to decompress") from e
+    if len(plaintext) > limit:
+        raise BlobFormatError("Segment is larger than the segment size")
+    return plaintext
+
+
+def _unpack_segment(payload: bytes, codec: int, segment_size: int, final: bool) -> bytes:
+    """Plaintext of a decrypted format 3 segment"""
+    if not payload:
+        raise BlobFormatError("Segment is empty")
+    if payload[0] == SEGMENT_COMPRESSED:
+        plaintext = _decompress(codec, payload[1:], segment_size)
+    elif payload[0] == SEGMENT_RAW:
+        plaintext = payload[1:]
+    else:
+        raise BlobFormatError("Unknown segment encoding")
+    if len(plaintext) > segment_size or (not final and len(plaintext) != segment_size):
+        raise BlobFormatError("Segment has the wrong size")
+    return plaintext
+
+
+def trailer_length(tail: bytes) -> int:
+    """Length of a format 3 trailer, from the last TRAILER.size bytes of the blob"""
+    if len(tail) < TRAILER.size:
+        raise BlobFormatError("Blob is truncated")
+    _, count, marker = TRAILER.unpack(tail[-TRAILER.size:])
+    if marker != TRAILER_MAGIC:
+        raise BlobFormatError("Blob has no segment index")
+    return count * FRAME.size + TRAILER.size
+
+
+def _trailer(lengths: List[int], plaintext_size: int) -> bytes:
+    return struct.pack(f">{len(lengths)}I", *lengths) + TRAILER.pack(plaintext_size, len(lengths), TRAILER_MAGIC)
+
+
+# Uploads no longer write format 1; kept to test its decryption path and to benchmark it against 2 and 3
+class FernetSegmentEncryptor:
+    """Encrypts a file one segment at a time as format 1."""
+
+    format = FORMAT_SEGMENTED_FERNET
+
+    def __init__(self, key: bytes, segment_size: int = SEGMENT_SIZE):
+        self._fernet = Fernet(key)
+        self.segment_size = segment_size
+
+    def header(self) -> bytes:
+        return HEADER.pack(MAGIC, FORMAT_SEGMENTED_FERNET, self.segment_size)
+
+    def encrypt_segment(self, chunk: bytes, index: int, final: bool) -> bytes:
+        token = self._fernet.encrypt(SEGMENT_PREFIX.pack(index, int(final)) + chunk)
+        return FRAME.pack(len(token)) + token
+
+    def trailer(self) -> bytes:
+        return b""
+
+
+class SegmentEncryptor:
+    """Encrypts a file one segment at a time as format 2.
+
+    Every segment except the final one must hold exactly segment_size bytes.
+    """
+
+    format = FORMAT_AEAD
+
+    def __init__(self, key: bytes, segment_size: int = SEGMENT_SIZE, algorithm: str = ALGORITHM):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown encryption algorithm: {algorithm}")
+        self.algorithm = ALGORITHMS[algorithm]
+        self.segment_size = segment_size
+        self._aead = _aead(key, self.algorithm)
+        self._header = HEADER_V2.pack(MAGIC, FORMAT_AEAD, self.algorithm, segment_size, os.urandom(7))
+
+    @classmethod
+    def from_header(cls, key: bytes, header: bytes) -> "SegmentEncryptor":
+        """Encryptor that continues a blob whose header was generated earlier"""
+        magic, version, algorithm, segment_size, _ = HEADER_V2.unpack(header)
+        if magic != MAGIC or version != FORMAT_AEAD:
+            raise BlobFormatError("Unsupported blob format")
+        encryptor = cls.__new__(cls)
+        encryptor.algorithm = algorithm
+        encryptor.segment_size = segment_size
+        encryptor._aead = _aead(key, algorithm)
+        encryptor._header = bytes(header)
+        return encryptor
+
+    def header(self) -> bytes:
+        return self._header
+
+    def encrypt_segment(self, chunk: bytes, index: int, final: bool) -> bytes:
+        if not final and len(chunk) != self.segment_size:
+            raise ValueError("Only the final segment may be shorter than segment_size")
+        nonce = self._header[-7:] + NONCE_SUFFIX.pack(index, int(final))
+        # The header is authenticated with every segment so it cannot be altered
+        return self._aead.encrypt(nonce, chunk, self._header)
+
+    def trailer(self) -> bytes:
+        """Bytes written after the final segment (none in format 2)"""
+        return b""
+
+
+class CompressedSegmentEncryptor:
+    """Encrypts a file one segment at a time as format 3.
+
+    Every segment except the final one must hold exactly segment_size bytes;
+    trailer() must be written after the final segment.
+    """
+
+    format = FORMAT_AEAD_COMPRESSED
+
+    def __init__(self, key: bytes, segment_size: int = SEGMENT_SIZE, algorithm: str = ALGORITHM,
+                 codec: str = "zstd", level: int = COMPRESSION_LEVEL):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown encryption algorithm: {algorithm}")
+        if codec not in CODECS:
+            raise ValueError(f"Unknown compression codec: {codec}")
+        self.algorithm = ALGORITHMS[algorithm]
+        self.codec = CODECS[codec]
+        self.segment_size = segment_size
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._aead = _aead(key, self.algorithm)
+        self._header = HEADER_V3.pack(
+            MAGIC, FORMAT_AEAD_COMPRESSED, self.algorithm, self.codec, segment_size, os.urandom(7)
+        )
+        self._lengths: List[int] = []
+        self._plaintext_size = 0
+
+    def header(self) -> bytes:
+        return self._header
+
+    def encrypt_segment(self, chunk: bytes, index: int, final: bool) -> bytes:
+        if not final and len(chunk) != self.segment_size:
+            raise ValueError("Only the final segment may be shorter than segment_size")
+        if index != len(self._lengths):
+            raise ValueError("Segments must be encrypted in order")
+        compressed = self._compressor.compress(chunk)
+        # Segments that do not shrink are stored as they are
+        if len(compressed) < len(chunk):
+            payload = bytes([SEGMENT_COMPRESSED]) + compressed
+        else:
+            payload = bytes([SEGMENT_RAW]) + chunk
+        nonce = self._header[-7:] + NONCE_SUFFIX.pack(index, int(final))
+        ciphertext = self._aead.encrypt(nonce, payload, self._header)
+        segment = FRAME.pack(len(ciphertext) | (FINAL_FLAG if final else 0)) + ciphertext
+        self._lengths.append(len(segment))
+        self._plaintext_size += len(chunk)
+        return segment
+
+    def trailer(self) -> bytes:
+        """Stored length of every segment, so the blob can be read from any offset"""
+        return _trailer(self._lengths, self._plaintext_size)
+
+
+def new_encryptor(key: bytes, sample: bytes, segment_size: int = SEGMENT_SIZE):
+    """Encryptor for a new blob: format 3 if sample (the start of the file) compresses well enough, else format 2"""
+    if COMPRESSION != "none":
+        sample = sample[:COMPRESSION_SAMPLE_SIZE]
+        compressed = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(sample)
+        if sample and len(compressed) <= len(sample) * (1 - COMPRESSION_MIN_SAVING):
+            return CompressedSegmentEncryptor(key, segment_size, codec=COMPRESSION)
+    return SegmentEncryptor(key, segment_size)
+
+
+class SegmentDecryptor:
+    """Incrementally decrypts a segmented blob (format 1, 2 or 3) fed in arbitrary-sized pieces."""
+
+    def __init__(self, key: bytes):
+        self._key = key
+        self._buffer = bytearray()
+        self._version = None
+        self._next_index = 0
+        self.finished = False
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        """Consume ciphertext and yield every plaintext segment it completes."""
+        self._buffer += data
+        if self._version is None and not self._read_header():
+            return
+        if self._version == FORMAT_SEGMENTED_FERNET:
+            yield from self._feed_fernet()
+        elif self._version == FORMAT_AEAD_COMPRESSED:
+            yield from self._feed_compressed()
+        else:
+            yield from self._feed_aead()
+
+    def close(self) -> bytes:
+        """Check that the blob ended exactly after its final segment; returns any plaintext left."""
+        plaintext = b""
+        if self._version == FORMAT_AEAD and not self.finished:
+            # In format 2 the final segment is whatever is left once the input ends
+            plaintext = self._open_aead(bytes(self._buffer), final=True)
+            self._buffer.clear()
+        if self._version == FORMAT_AEAD_COMPRESSED and self.finished:
+            # Whatever follows the final segment must be the trailer describing the segments read
+            if self._buffer != _trailer(self._lengths, self._plaintext_size):
+                raise BlobFormatError("Blob has a corrupt segment index")
+            self._buffer.clear()
+        if not self.finished or self._buffer:
+            raise BlobFormatError("Blob is truncated")
+        return plaintext
+
+    def _read_header(self) -> bool:
+        if len(self._buffer) < PREAMBLE.size:
+            return False
+        magic, version = PREAMBLE.unpack_from(self._buffer)
+        if magic != MAGIC or version not in (FORMAT_SEGMENTED_FERNET, FORMAT_AEAD, FORMAT_AEAD_COMPRESSED):
+            raise BlobFormatError("Unsupported blob format")
+        if version == FORMAT_SEGMENTED_FERNET:
+            if len(self._buffer) < HEADER.size:
+                return False
+            self._fernet = Fernet(self._key)
+            del self._buffer[:HEADER.size]
+        elif version == FORMAT_AEAD_COMPRESSED:
+            if len(self._buffer) < HEADER_V3.size:
+                return False
+            self._header = bytes(self._buffer[:HEADER_V3.size])
+            _, _, algorithm, self._codec, self._segment_size, self._nonce_prefix = HEADER_V3.unpack(self._header)
+            self._aead = _aead(self._key, algorithm)
+            self._lengths: List[int] = []
+            self._plaintext_size = 0
+            del self._buffer[:HEADER_V3.size]
+        else:
+            if len(self._buffer) < HEADER_V2.size:
+                return False
+            self._header = bytes(self._buffer[:HEADER_V2.size])
+            _, _, algorithm, segment_size, self._nonce_prefix = HEADER_V2.unpack(self._header)
+            self._aead = _aead(self._key, algorithm)
+            self._segment_size = segment_size + TAG_SIZE
+            del self._buffer[:HEADER_V2.size]
+        self._version = version
+        return True
+
+    def _feed_fernet(self) -> Iterator[bytes]:
+        while len(self._buffer) >= FRAME.size:
+            (length,) = FRAME.unpack_from(self._buffer)
+            if len(self._buffer) < FRAME.size + length:
+                return
+            token = bytes(self._buffer[FRAME.size:FRAME.size + length])
+            del self._buffer[:FRAME.size + length]
+            yield self._open_fernet(token)
+
+    def _feed_aead(self) -> Iterator[bytes]:
+        # A full segment is only known not to be the final one once more data follows it
+        while len(self._buffer) > self._segment_size:
+            segment = bytes(self._buffer[:self._segment_size])
+            del self._buffer[:self._segment_size]
+            yield self._open_aead(segment, final=False)
+
+    def _feed_compressed(self) -> Iterator[bytes]:
+        # Once the final segment is read, the rest of the blob is the trailer (checked by close())
+        while not self.finished and len(self._buffer) >= FRAME.size:
+            (frame,) = FRAME.unpack_from(self._buffer)
+            length = frame & ~FINAL_FLAG
+            if len(self._buffer) < FRAME.size + length:
+                return
+            segment = bytes(self._buffer[FRAME.size:FRAME.size + length])
+            del self._buffer[:FRAME.size + length]
+            final = bool(frame & FINAL_FLAG)
+            payload = self._open_aead(segment, final)
+            plaintext = _unpack_segment(payload, self._codec, self._segment_size, final)
+            self._lengths.append(FRAME.size + length)
+            self._plaintext_size += len(plaintext)
+            yield plaintext
+
+    def _open_fernet(self, token: bytes) -> bytes:
+        if self.finished:
+            raise BlobFormatError("Data found after final segment")
+        try:
+            plaintext = self._fernet.decrypt(token)
+        except InvalidToken as e:
+            raise BlobFormatError("Segment failed authentication") from e
+        index, final = SEGMENT_PREFIX.unpack_from(plaintext)
+        if index != self._next_index:
+            raise BlobFormatError("Segments out of order")
+        self._next_index += 1
+        self.finished = bool(final)
+        return plaintext[SEGMENT_PREFIX.size:]
+
+    def _open_aead(self, segment: bytes, final: bool) -> bytes:
+        if self.finished:
+            raise BlobFormatError("Data found after final segment")
+        nonce = self._nonce_prefix + NONCE_SUFFIX.pack(self._next_index, int(final))
+        try:
+            plaintext = self._aead.decrypt(nonce, segment, self._header)
+        except InvalidTag as e:
+            raise BlobFormatError("Segment failed authentication") from e
+        self._next_index += 1
+        self.finished = final
+        return plaintext
+
+
+class SegmentIndex:
+    """Random access into a format 2 or 3 blob.
+
+    Format 2 segments have a fixed stored size, so the ciphertext covering
+    any plaintext byte range is found arithmetically from the header and
+    the blob's stored size. Format 3 segments vary in size; their offsets
+    come from the trailer. Either way the covering segments can be
+    decrypted without reading anything else.
+    """
+
+    def __init__(self, key: bytes, header: bytes, blob_size: int, trailer: bytes = b""):
+        if len(header) < PREAMBLE.size:
+            raise BlobFormatError("Blob is truncated")
+        magic, self.version = PREAMBLE.unpack_from(header)
+        if magic != MAGIC or self.version not in (FORMAT_AEAD, FORMAT_AEAD_COMPRESSED):
+            raise BlobFormatError("Blob has no segment index")
+        self.blob_size = blob_size
+        if self.version == FORMAT_AEAD:
+            self._init_v2(key, header)
+        else:
+            self._init_v3(key, header, trailer)
+
+    def _init_v2(self, key: bytes, header: bytes):
+        if len(header) < HEADER_V2.size:
+            raise BlobFormatError("Blob is truncated")
+        self.header = bytes(header[:HEADER_V2.size])
+        _, _, algorithm, self.segment_size, self._nonce_prefix = HEADER_V2.unpack(self.header)
+        self._aead = _aead(key, algorithm)
+        self.stored_segment_size = self.segment_size + TAG_SIZE
+        body = self.blob_size - HEADER_V2.size
+        self.segment_count = max(1, -(-body // self.stored_segment_size))
+        self.plaintext_size = body - self.segment_count * TAG_SIZE
+        if self.plaintext_size < 0:
+            raise BlobFormatError("Blob is truncated")
+        self._offsets = None
+
+    def _init_v3(self, key: bytes, header: bytes, trailer: bytes):
+        if len(header) < HEADER_V3.size:
+            raise BlobFormatError("Blob is truncated")
+        self.header = bytes(header[:HEADER_V3.size])
+        _, _, algorithm, self._codec, self.segment_size, self._nonce_prefix = HEADER_V3.unpack(self.header)
+        self._aead = _aead(key, algorithm)
+        if len(trailer) != trailer_length(trailer):
+            raise BlobFormatError("Blob has a corrupt segment index")
+        self.plaintext_size, self.segment_count, _ = TRAILER.unpack(trailer[-TRAILER.size:])
+        self._offsets = [HEADER_V3.size]
+        for (length,) in FRAME.iter_unpack(trailer[:-TRAILER.size]):
+            self._offsets.append(self._offsets[-1] + length)
+        if self.segment_count < 1 or self._offsets[-1] + len(trailer) != self.blob_size:
+            raise BlobFormatError("Blob has a corrupt segment index")
+        self.stored_segment_size = None
+
+    def stored_size(self, index: int) -> int:
+        """Bytes segment index takes up in the blob"""
+        if self._offsets is not None:
+            return self._offsets[index + 1] - self._offsets[index]
+        return self.stored_segment_size
+
+    def locate(self, start: int, end: int):
+        """(first segment index, ciphertext offset, ciphertext length) covering plaintext bytes start..end inclusive"""
+        first = start // self.segment_size
+        last = min(end // self.segment_size, self.segment_count - 1)
+        if self._offsets is not None:
+            return first, self._offsets[first], self._offsets[last + 1] - self._offsets[first]
+        offset = HEADER_V2.size + first * self.stored_segment_size
+        stop = min(self.blob_size, HEADER_V2.size + (last + 1) * self.stored_segment_size)
+        return first, offset, stop - offset
+
+    def decrypt_segment(self, index: int, segment: bytes) -> bytes:
+        final = index == self.segment_count - 1
+        if self._offsets is not None:
+            (frame,) = FRAME.unpack_from(segment)
+            if bool(frame & FINAL_FLAG) != final:
+                raise BlobFormatError("Blob has a corrupt segment index")
+            segment = segment[FRAME.size:]
+        nonce = self._nonce_prefix + NONCE_SUFFIX.pack(index, int(final))
+        try:
+            plaintext = self._aead.decrypt(nonce, segment, self.header)
+        except InvalidTag as e:
+            raise BlobFormatError("Segment failed authentication") from e
+        if self._offsets is not None:
+            plaintext = _unpack_segment(plaintext, self._codec, self.segment_size, final)
+        return plaintext
+
+
+def decrypt_blob(data: bytes, key: bytes) -> bytes:
+    """Decrypt a whole blob held in memory, whichever format it uses."""
+    if not is_segmented(data):
+        return Fernet(key).decrypt(data)
+    decryptor = SegmentDecryptor(key)
+    plaintext = b"".join(decryptor.feed(data))
+    return plaintext + decryptor.close()
@@ -0,0 +1,360 @@
+"""Storage backends for encrypted blobs.
+
+Blobs are addressed by storage-relative keys (e.g. ``{file_id}_real.enc``)
+so that several API nodes can share one store. Two backends exist:
+
+* LocalBlobStore: a directory on disk, with all file I/O offloaded to
+  threads and writes made atomic through a temp file + rename.
+* S3BlobStore: any S3-compatible object store (AWS, MinIO, ...), streamed
+  with multipart uploads and ranged GETs.
+
+MeteredBlobStore wraps either to record I/O timings for /metrics and traces.
+
+Select one with BLOB_STORE=local|s3 (see blob_store_from_env).
+"""
+import asyncio
+import os
+from abc import ABC, abstractmethod
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import tracing
+from metrics import observe_stage, stage
+
+READ_SIZE = 256 * 1024
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+@dataclass
+class BlobStat:
+    key: str
+    size: int
+    modified: datetime
+
+
+class BlobStore(ABC):
+    """Interface implemented by every backend."""
+
+    @abstractmethod
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        """Store the streamed chunks under key, replacing any existing blob; returns bytes written."""
+
+    @abstractmethod
+    def get(self, key: str, offset: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Stream the blob's bytes, optionally only `length` bytes starting at `offset`."""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Remove the blob; a missing blob is not an error."""
+
+    @abstractmethod
+    async def stat(self, key: str) -> BlobStat:
+        """Size and modification time of the blob; raises BlobNotFound."""
+
+    @abstractmethod
+    def list(self) -> AsyncIterator[BlobStat]:
+        """Stream every blob in the store (including partial writes), in no particular order."""
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files under `root`.
+
+    fsync policy: "always" syncs after every write, "close" once before the
+    blob is renamed into place, "never" leaves it to the OS.
+    """
+
+    def __init__(self, root: Path, fsync: str = "close", read_size: int = READ_SIZE):
+        if fsync not in ("always", "close", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.read_size = read_size
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root not in path.parents:
+            raise ValueError(f"Invalid blob key: {key}")
+        return path
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        path = self._path(key)
+        await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+        f = await asyncio.to_thread(open, temp_path, "wb")
+        size = 0
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(self._write, f, chunk, self.fsync == "always")
+                size += len(chunk)
+            await asyncio.to_thread(self._write, f, b"", self.fsync == "close")
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, temp_path, path)
+        except BaseException:
+            f.close()
+            temp_path.unlink(missing_ok=True)
+            raise
+        return size
+
+    @staticmethod
+    def _write(f, data: bytes, sync: bool):
+        if data:
+            f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def get(self, key: str, offset: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        try:
+            f = await asyncio.to_thread(open, self._path(key), "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+        try:
+            if offset:
+                await asyncio.to_thread(f.seek, offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = self.read_size if remaining is None else min(self.read_size, remaining)
+                data = await asyncio.to_thread(f.read, size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._path(key).unlink, missing_ok=True)
+
+    async def stat(self, key: str) -> BlobStat:
+        try:
+            st = await asyncio.to_thread(os.stat, self._path(key))
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+        return BlobStat(key, st.st_size, datetime.fromtimestamp(st.st_mtime, timezone.utc))
+
+    def _scan(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = Path(directory) / name
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                yield BlobStat(
+                    path.relative_to(self.root).as_posix(), st.st_size,
+                    datetime.fromtimestamp(st.st_mtime, timezone.utc)
+                )
+
+    @staticmethod
+    def _next_batch(entries, size: int = 1000):
+        return [entry for _, entry in zip(range(size), entries)]
+
+    async def list(self) -> AsyncIterator[BlobStat]:
+        entries = self._scan()
+        while batch := await asyncio.to_thread(self._next_batch, entries):
+            for entry in batch:
+                yield entry
+
+
+class S3BlobStore(BlobStore):
+    """Blobs as objects in an S3-compatible bucket (boto3 calls run in threads)."""
+
+    # S3 requires every multipart part except the last to be at least 5 MiB
+    PART_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 client=None, read_size: int = READ_SIZE):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self._s3 = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.read_size = read_size
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    @staticmethod
+    def _is_not_found(error) -> bool:
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        object_key = self._key(key)
+        buffer = bytearray()
+        parts = []
+        upload_id = None
+        size = 0
+
+        async def upload_part(body: bytes):
+            response = await asyncio.to_thread(
+                self._s3.upload_part, Bucket=self.bucket, Key=object_key,
+                UploadId=upload_id, PartNumber=len(parts) + 1, Body=body
+            )
+            parts.append({"PartNumber": len(parts) + 1, "ETag": response["ETag"]})
+
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= self.PART_SIZE:
+                    if upload_id is None:
+                        response = await asyncio.to_thread(
+                            self._s3.create_multipart_upload, Bucket=self.bucket, Key=object_key
+                        )
+                        upload_id = response["UploadId"]
+                    part = bytes(buffer[:self.PART_SIZE])
+                    del buffer[:self.PART_SIZE]
+                    await upload_part(part)
+            if upload_id is None:
+                await asyncio.to_thread(self._s3.put_object, Bucket=self.bucket, Key=object_key, Body=bytes(buffer))
+            else:
+                if buffer:
+                    await upload_part(bytes(buffer))
+                await asyncio.to_thread(
+                    self._s3.complete_multipart_upload, Bucket=self.bucket, Key=object_key,
+                    UploadId=upload_id, MultipartUpload={"Parts": parts}
+                )
+        except BaseException:
+            if upload_id is not None:
+                await asyncio.to_thread(
+                    self._s3.abort_multipart_upload, Bucket=self.bucket, Key=object_key, UploadId=upload_id
+                )
+            raise
+        return size
+
+    async def get(self, key: str, offset: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        kwargs = {"Bucket": self.bucket, "Key": self._key(key)}
+        if length is not None:
+            if length <= 0:
+                return
+            kwargs["Range"] = f"bytes={offset}-{offset + length - 1}"
+        elif offset:
+            kwargs["Range"] = f"bytes={offset}-"
+        try:
+            response = await asyncio.to_thread(self._s3.get_object, **kwargs)
+        except Exception as e:
+            if self._is_not_found(e):
+                raise BlobNotFound(key)
+            raise
+        body = response["Body"]
+        try:
+            while True:
+                data = await asyncio.to_thread(body.read, self.read_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            body.close()
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._s3.delete_object, Bucket=self.bucket, Key=self._key(key))
+
+    async def stat(self, key: str) -> BlobStat:
+        try:
+            response = await asyncio.to_thread(self._s3.head_object, Bucket=self.bucket, Key=self._key(key))
+        except Exception as e:
+            if self._is_not_found(e):
+                raise BlobNotFound(key)
+            raise
+        return BlobStat(key, response["ContentLength"], response["LastModified"])
+
+    async def list(self) -> AsyncIterator[BlobStat]:
+        kwargs = {"Bucket": self.bucket, "Prefix": self.prefix}
+        while True:
+            response = await asyncio.to_thread(self._s3.list_objects_v2, **kwargs)
+            for item in response.get("Contents", []):
+                yield BlobStat(item["Key"][len(self.prefix):], item["Size"], item["LastModified"])
+            if not response.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def blob_store_from_env(default_root: Path) -> BlobStore:
+    if os.environ.get("BLOB_STORE", "local") == "s3":
+        return S3BlobStore(
+            os.environ["S3_BUCKET"],
+            prefix=os.environ.get("S3_PREFIX", ""),
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL")
+        )
+    return LocalBlobStore(
+        Path(os.environ.get("BLOB_STORE_PATH", default_root)),
+        fsync=os.environ.get("BLOB_FSYNC", "close")
+    )
+
+
+class MeteredBlobStore(BlobStore):
+    """Another store with each operation timed into the blob_* stage metrics and traced.
+
+    Only the store's own time is counted: put excludes the time spent
+    producing the chunks (e.g. encrypting them) and get excludes the time
+    the caller spends between chunks.
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes]) -> int:
+        producing = 0.0
+
+        async def timed_chunks():
+            nonlocal producing
+            iterator = chunks.__aiter__()
+            while True:
+                start = time.perf_counter()
+                try:
+                    data = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    producing += time.perf_counter() - start
+                yield data
+
+        start = time.perf_counter()
+        with tracing.span("blob_write", {"blob.key": key}):
+            size = await self.store.put(key, timed_chunks())
+        observe_stage("blob_write", time.perf_counter() - start - producing, size)
+        return size
+
+    @tracing.traced_stream("blob_read", lambda self, key, offset=0, length=None: {
+        "blob.key": key, "blob.offset": offset, "blob.length": -1 if length is None else length
+    })
+    async def get(self, key: str, offset: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        chunks = self.store.get(key, offset, length)
+        elapsed = 0.0
+        size = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    data = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                size += len(data)
+                yield data
+        finally:
+            await chunks.aclose()
+            observe_stage("blob_read", elapsed, size)
+
+    async def delete(self, key: str):
+        with stage("blob_delete"), tracing.span("blob_delete", {"blob.key": key}):
+            await self.store.delete(key)
+
+    async def stat(self, key: str) -> BlobStat:
+        with stage("blob_stat"), tracing.span("blob_stat", {"blob.key": key}):
+            return await self.store.stat(key)
+
+    def list(self) -> AsyncIterator[BlobStat]:
+        return self.store.list()
@@ -0,0 +1,123 @@
+"""Keyset-paginated queries behind the owner dashboard.
+
+Every list is ordered newest first on (timestamp field, id). A page is
+continued with an opaque cursor encoding the last row's (timestamp, id), so
+fetching page N costs the same index seek as page 1.
+"""
+import base64
+import json
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+from migrations import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+
+def encode_cursor(doc: dict, sort_field: str) -> str:
+    """Opaque keyset cursor pointing just after doc"""
+    value = [parse_datetime(doc[sort_field]).isoformat(), doc["id"]]
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return parse_datetime(value), str(doc_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def date_range_filter(field: str, since: Optional[datetime], until: Optional[datetime]) -> dict:
+    bounds = {}
+    if since:
+        bounds["$gte"] = parse_datetime(since)
+    if until:
+        bounds["$lt"] = parse_datetime(until)
+    return {field: bounds} if bounds else {}
+
+
+def keyset_query(query: dict, sort_field: str, cursor: Optional[str]) -> dict:
+    """Restrict query to the rows after cursor"""
+    if not cursor:
+        return query
+    value, doc_id = decode_cursor(cursor)
+    return {"$and": [query, {"$or": [
+        {sort_field: {"$lt": value}},
+        {sort_field: value, "id": {"$lt": doc_id}}
+    ]}]}
+
+
+async def fetch_page(collection, query: dict, sort_field: str, limit: int, cursor: Optional[str],
+                     projection: dict):
+    """Returns (docs, next_cursor)"""
+    docs = await collection.find(keyset_query(query, sort_field, cursor), projection) \
+        .sort([(sort_field, -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(docs[limit - 1], sort_field) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+
+def page_with_filenames_pipeline(query: dict, sort_field: str, limit: int, cursor: Optional[str],
+                                 exclude: List[str] = ()) -> List[dict]:
+    """One aggregation that pages the rows and joins each row's file name from db.files"""
+    return [
+        {"$match": keyset_query(query, sort_field, cursor)},
+        {"$sort": {sort_field: -1, "id": -1}},
+        # One extra row tells us whether there is a next page
+        {"$limit": limit + 1},
+        {"$lookup": {"from": "files", "localField": "file_id", "foreignField": "id", "as": "file"}},
+        {"$addFields": {"filename": {"$ifNull": [{"$arrayElemAt": ["$file.filename", 0]}, "Unknown"]}}},
+        {"$project": {"_id": 0, "file": 0, **{field: 0 for field in exclude}}},
+    ]
+
+
+async def stream_page(cursor, key: str, sort_field: str, limit: int, first: Optional[dict] = None):
+    """Serialise an aggregation cursor as {key: [...], "next_cursor": ...} row by row.
+
+    first is a row already taken from the cursor. Once the status is sent an
+    error can no longer become a 5xx, so a query failing mid-stream still
+    closes the JSON, with next_cursor null and an "error" marker.
+    """
+    yield f'{{"{key}":['.encode()
+    count = 0
+    last = None
+    next_cursor = None
+
+    async def rows():
+        if first is not None:
+            yield first
+        async for doc in cursor:
+            yield doc
+
+    try:
+        async for doc in rows():
+            if count == limit:
+                # The extra row: there is another page. Keep iterating so the cursor is exhausted.
+                next_cursor = encode_cursor(last, sort_field)
+                continue
+            yield (b"," if count else b"") + json.dumps(jsonable_encoder(doc)).encode()
+            last = doc
+            count += 1
+    except Exception as e:
+        logger.error(f"Dashboard {key} page failed after {count} rows: {e}")
+        yield b'],"next_cursor":null,"error":"incomplete"}'
+        return
+    yield f'],"next_cursor":{json.dumps(next_cursor)}}}'.encode()
+
+
+async def page_response(cursor, key: str, sort_field: str, limit: int) -> StreamingResponse:
+    """Stream a page from an aggregation cursor, once its first row is in.
+
+    Taking the first row runs the aggregation, so a query that fails outright
+    still gets an error status instead of a 200 with a truncated body.
+    """
+    try:
+        first = await cursor.__anext__()
+    except StopAsyncIteration:
+        first = None
+    return StreamingResponse(stream_page(cursor, key, sort_field, limit, first), media_type="application/json")
@@ -0,0 +1,227 @@
+"""Declarative registry of the MongoDB indexes the API relies on.
+
+The server applies the registry on startup. It can also be checked or
+applied by hand:
+
+    python db_indexes.py --check    # report missing and extra indexes
+    python db_indexes.py --apply    # create missing indexes
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from dashboard import encode_cursor, page_with_filenames_pipeline
+from download_tickets import redeem_pipeline
+
+logger = logging.getLogger(__name__)
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "files": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("id", ASCENDING)], name="user_id_id"),
+        IndexModel([("user_id", ASCENDING), ("upload_date", DESCENDING), ("id", DESCENDING)], name="user_id_upload_date_id"),
+        # Re-encryption job: files sharing a deduplicated blob; files stored before dedup have none
+        IndexModel([("real_blob_id", ASCENDING)], name="real_blob_id", sparse=True),
+        IndexModel([("decoy_blob_id", ASCENDING)], name="decoy_blob_id", sparse=True),
+    ],
+    "share_links": [
+        IndexModel([("link_token", ASCENDING)], name="link_token_unique", unique=True),
+        IndexModel([("file_id", ASCENDING)], name="file_id"),
+        # Dashboard pages: newest first per owner, optionally narrowed by file or state
+        IndexModel([("owner_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="owner_id_created_at_id"),
+        IndexModel([("owner_id", ASCENDING), ("file_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="owner_id_file_id_created_at_id"),
+        IndexModel([("owner_id", ASCENDING), ("is_active", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="owner_id_is_active_created_at_id"),
+        # Storage sweeper: active links past their expiry
+        IndexModel([("is_active", ASCENDING), ("expiry_date", ASCENDING)], name="is_active_expiry_date"),
+    ],
+    "file_access_otps": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("link_token", ASCENDING), ("otp", ASCENDING), ("used", ASCENDING)], name="link_token_otp_used"),
+        # TTL: MongoDB deletes each OTP once its expiry time has passed
+        IndexModel([("expiry", ASCENDING)], name="expiry_ttl", expireAfterSeconds=0),
+    ],
+    "password_reset_otps": [
+        IndexModel([("email", ASCENDING), ("otp", ASCENDING), ("used", ASCENDING)], name="email_otp_used"),
+        IndexModel([("expiry", ASCENDING)], name="expiry_ttl", expireAfterSeconds=0),
+    ],
+    "access_attempts": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("file_id", ASCENDING), ("attempted_at", DESCENDING)], name="file_id_attempted_at"),
+        IndexModel([("owner_id", ASCENDING), ("attempted_at", DESCENDING), ("id", DESCENDING)],
+                   name="owner_id_attempted_at_id"),
+        IndexModel([("owner_id", ASCENDING), ("file_id", ASCENDING), ("attempted_at", DESCENDING), ("id", DESCENDING)],
+                   name="owner_id_file_id_attempted_at_id"),
+        IndexModel([("owner_id", ASCENDING), ("password_correct", ASCENDING), ("attempted_at", DESCENDING),
+                    ("id", DESCENDING)], name="owner_id_password_correct_attempted_at_id"),
+    ],
+    "blobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("owner_id", ASCENDING)], name="owner_id"),
+    ],
+    "retired_blobs": [
+        IndexModel([("blob_key", ASCENDING)], name="blob_key"),
+        # The sweeper ignores a hold once it is past; the TTL monitor just tidies up
+        IndexModel([("delete_after", ASCENDING)], name="delete_after_ttl", expireAfterSeconds=0),
+    ],
+    "upload_sessions": [
+        IndexModel([("id", ASCENDING), ("user_id", ASCENDING)], name="id_user_id", unique=True),
+        # Swept by the server rather than a TTL index: expired sessions still own stored parts
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+    ],
+    "email_outbox": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt_at"),
+        IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)], name="status_locked_until"),
+        # Delivered messages are kept for a week for troubleshooting
+        IndexModel([("sent_at", ASCENDING)], name="sent_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+}
+
+_NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _newest(field):
+    return [(field, DESCENDING), ("id", DESCENDING)]
+
+
+def _after(query, field):
+    """Keyset continuation filter, as built by keyset_query in dashboard.py"""
+    return {"$and": [query, {"$or": [{field: {"$lt": _NOW}}, {field: _NOW, "id": {"$lt": "id-1"}}]}]}
+
+
+# Representative filter/sort for every query a route or worker issues, used
+# to check with explain() that each one is served by an index.
+QUERY_SHAPES = [
+    ("users", {"email": "owner@example.com"}, None),
+    ("users", {"id": "user-1"}, None),
+    ("files", {"id": "file-1"}, None),
+    ("files", {"id": "file-1", "user_id": "user-1"}, None),
+    ("files", {"id": {"$in": ["file-1", "file-2"]}}, None),
+    ("files", {"user_id": "user-1"}, _newest("upload_date")),
+    ("files", {"real_blob_id": "digest-1", "real_blob_key": "cas_digest-1.0.enc"}, None),
+    ("files", {"decoy_blob_id": "digest-1", "decoy_blob_key": "cas_digest-1.0.enc"}, None),
+    ("files", {"user_id": "user-1", "upload_date": {"$gte": _NOW}}, _newest("upload_date")),
+    ("files", _after({"user_id": "user-1"}, "upload_date"), _newest("upload_date")),
+    ("share_links", {"link_token": "token-1"}, None),
+    ("share_links", {"owner_id": "user-1"}, _newest("created_at")),
+    ("share_links", {"owner_id": "user-1", "file_id": "file-1"}, _newest("created_at")),
+    ("share_links", {"owner_id": "user-1", "is_active": True}, _newest("created_at")),
+    ("share_links", _after({"owner_id": "user-1"}, "created_at"), _newest("created_at")),
+    ("share_links", {"is_active": True, "expiry_date": {"$lte": _NOW}}, None),
+    ("file_access_otps", {"id": "otp-1"}, None),
+    ("file_access_otps", {"link_token": "token-1", "otp": "123456", "used": False, "expiry": {"$gt": _NOW}}, None),
+    ("password_reset_otps", {"email": "owner@example.com", "otp": "123456", "used": False, "expiry": {"$gt": _NOW}}, None),
+    ("access_attempts", {"id": "attempt-1"}, None),
+    ("access_attempts", {"owner_id": "user-1"}, _newest("attempted_at")),
+    ("access_attempts", {"owner_id": "user-1", "file_id": "file-1"}, _newest("attempted_at")),
+    ("access_attempts", {"owner_id": "user-1", "password_correct": False}, _newest("attempted_at")),
+    ("access_attempts", {"owner_id": "user-1", "attempted_at": {"$gte": _NOW, "$lt": _NOW}}, _newest("attempted_at")),
+    ("access_attempts", _after({"owner_id": "user-1"}, "attempted_at"), _newest("attempted_at")),
+    # migrations.backfill_owner_ids, run on every startup
+    ("share_links", {"owner_id": {"$exists": False}}, [("_id", ASCENDING)]),
+    ("access_attempts", {"owner_id": {"$exists": False}}, [("_id", ASCENDING)]),
+    ("blobs", {"id": "digest-1", "refcount": {"$gt": 0}}, None),
+    ("blobs", {"owner_id": "user-1", "refcount": {"$gt": 0}}, None),
+    ("blobs", {"id": {"$in": ["digest-1", "digest-2"]}}, None),
+    ("retired_blobs", {"blob_key": {"$in": ["file-1_real.enc", "file-1_decoy.enc"]}, "delete_after": {"$gt": _NOW}}, None),
+    ("upload_sessions", {"id": "upload-1", "user_id": "user-1"}, None),
+    ("upload_sessions", {"id": "upload-1"}, None),
+    ("upload_sessions", {"expires_at": {"$lte": _NOW}}, None),
+    ("upload_sessions", {"id": {"$in": ["upload-1", "upload-2"]}}, None),
+    ("email_outbox", {"id": "message-1"}, None),
+    # EmailOutbox._claim: due messages and messages whose worker died mid-send
+    ("email_outbox", {"$or": [
+        {"status": "pending", "next_attempt_at": {"$lte": _NOW}},
+        {"status": "sending", "locked_until": {"$lte": _NOW}}
+    ]}, [("next_attempt_at", ASCENDING)]),
+]
+
+# Aggregations, as (collection, pipeline); the $lookup stages must use an index on the joined collection too
+PIPELINE_SHAPES = [
+    *(("share_links", page_with_filenames_pipeline(query, "created_at", 100, cursor, exclude=["password_hash"]))
+      for query in ({"owner_id": "user-1"}, {"owner_id": "user-1", "file_id": "file-1"},
+                    {"owner_id": "user-1", "is_active": True})
+      for cursor in (None, encode_cursor({"created_at": _NOW, "id": "id-1"}, "created_at"))),
+    *(("access_attempts", page_with_filenames_pipeline(query, "attempted_at", 100, cursor))
+      for query in ({"owner_id": "user-1"}, {"owner_id": "user-1", "file_id": "file-1"},
+                    {"owner_id": "user-1", "password_correct": False},
+                    {"owner_id": "user-1", "attempted_at": {"$gte": _NOW, "$lt": _NOW}})
+      for cursor in (None, encode_cursor({"attempted_at": _NOW, "id": "id-1"}, "attempted_at"))),
+    *(("share_links", redeem_pipeline({"file_id": "file-1", "link_token": "token-1", "variant": variant}))
+      for variant in ("real", "decoy")),
+    # BlobDeduplicator.owner_stats
+    ("blobs", [{"$match": {"owner_id": "user-1", "refcount": {"$gt": 0}}},
+               {"$group": {"_id": None, "blobs": {"$sum": 1}}}]),
+]
+
+
+async def ensure_indexes(db) -> List[str]:
+    """Create every registered index; returns the names of indexes that failed."""
+    failed = []
+    for collection, models in INDEXES.items():
+        for model in models:
+            try:
+                await db[collection].create_indexes([model])
+            except OperationFailure as e:
+                # e.g. duplicate keys blocking a unique index; keep serving
+                failed.append(f"{collection}.{model.document['name']}")
+                logger.error(f"Could not create index {collection}.{model.document['name']}: {e}")
+    return failed
+
+
+async def diff_indexes(db) -> Dict[str, List[str]]:
+    """Compare the registry with the database, by index name."""
+    missing, extra = [], []
+    for collection, models in INDEXES.items():
+        existing = set(await db[collection].index_information()) - {"_id_"}
+        wanted = {model.document["name"] for model in models}
+        missing += [f"{collection}.{name}" for name in sorted(wanted - existing)]
+        extra += [f"{collection}.{name}" for name in sorted(existing - wanted)]
+    return {"missing": missing, "extra": extra}
+
+
+async def _main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Check or apply the SecureShare MongoDB indexes")
+    parser.add_argument("--apply", action="store_true", help="create missing indexes")
+    parser.add_argument("--check", action="store_true", help="report missing and extra indexes (default)")
+    args = parser.parse_args()
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if args.apply:
+            failed = await ensure_indexes(db)
+            for name in failed:
+                print(f"FAILED  {name}")
+        report = await diff_indexes(db)
+        for name in report["missing"]:
+            print(f"MISSING {name}")
+        for name in report["extra"]:
+            print(f"EXTRA   {name}")
+        if not report["missing"] and not report["extra"]:
+            print("Indexes match the registry")
+        return 1 if report["missing"] else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(_main()))
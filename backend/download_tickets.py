@@ -0,0 +1,69 @@
+"""Short-lived download tickets.
+
+Verifying a share link (OTP, password, download limit, owner alert) is
+done once; the result is a ticket that the recipient can then use, and
+retry or resume with Range requests, until it expires.
+
+A ticket carries only the file id, share link token, variant and attempt
+id, so redeeming it is not stateless: each request reads the link together
+with the file it shares (one indexed aggregation, see redeem_pipeline).
+That way a link the owner disabled or that expired stops serving tickets
+minted from it, and the download uses the file's current blob and key,
+which the re-encryption job may have replaced since.
+It is a Fernet token under a key derived from the server secret:
+HMAC-SHA256 signed, timestamped for the TTL check, and encrypted, so a
+recipient cannot tell from the ticket whether it was given the real file
+or the decoy.
+"""
+import base64
+import json
+import os
+from typing import Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from fastapi import HTTPException
+
+# File document fields a download needs, per variant
+_FIELDS = {
+    "real": ("filename", "file_size", "real_blob_key", "real_file_path", "real_encryption_key", "real_blob_format"),
+    "decoy": ("decoy_filename", "decoy_file_size", "decoy_blob_key", "decoy_file_path", "decoy_encryption_key",
+              "decoy_blob_format"),
+}
+_COMMON_FIELDS = ("id", "encryption_key", "upload_date", "blob_format")
+
+
+def redeem_pipeline(grant: dict) -> list:
+    """The grant's share link, with the file fields needed to serve its variant joined in as "file"
+    (a one-element list, or empty if the file is gone)
+    """
+    return [
+        {"$match": {"link_token": grant["link_token"], "file_id": grant["file_id"]}},
+        {"$limit": 1},
+        {"$lookup": {"from": "files", "localField": "file_id", "foreignField": "id", "as": "file"}},
+        {"$project": {
+            "_id": 0, "is_active": 1, "expiry_date": 1,
+            **{f"file.{field}": 1 for field in _COMMON_FIELDS + _FIELDS[grant["variant"]]}
+        }},
+    ]
+
+
+class DownloadTickets:
+    def __init__(self, secret: str, ttl: Optional[int] = None):
+        self.ttl = ttl or int(os.environ.get("DOWNLOAD_TICKET_TTL_SECONDS", 900))
+        key = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=b"secureshare download tickets"
+        ).derive(secret.encode())
+        self._fernet = Fernet(base64.urlsafe_b64encode(key))
+
+    def issue(self, file_id: str, link_token: str, variant: str, attempt_id: str) -> str:
+        payload = {"file_id": file_id, "link_token": link_token, "variant": variant, "attempt_id": attempt_id}
+        return self._fernet.encrypt(json.dumps(payload, separators=(",", ":")).encode()).decode()
+
+    def redeem(self, ticket: str) -> dict:
+        """Validate a ticket; returns {"file_id", "link_token", "variant", "attempt_id"}"""
+        try:
+            return json.loads(self._fernet.decrypt(ticket.encode(), ttl=self.ttl))
+        except InvalidToken:
+            raise HTTPException(status_code=404, detail="Download expired. Please request access again")
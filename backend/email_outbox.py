@@ -0,0 +1,285 @@
+"""Persistent outbox for alert and OTP emails.
+
+Handlers only insert a message into the ``email_outbox`` collection and
+return. Background workers claim pending messages in batches, hand them to
+a transport and retry failures with exponential backoff. A circuit breaker
+stops hammering the provider while it is failing.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import List, Optional
+
+import httpx
+from opentelemetry.trace import SpanKind
+from pymongo import ReturnDocument
+from sendgrid.helpers.mail import Mail
+
+import tracing
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class TransportError(Exception):
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class SendGridTransport:
+    """Sends through the SendGrid v3 API over a pooled HTTP connection."""
+
+    def __init__(self, api_key: str, from_email: str, timeout: float = 10.0):
+        self.from_email = from_email
+        self._client = httpx.AsyncClient(
+            base_url="https://api.sendgrid.com",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+
+    async def send(self, message: dict):
+        mail = Mail(
+            from_email=self.from_email,
+            to_emails=message["to"],
+            subject=message["subject"],
+            html_content=message["html"]
+        )
+        try:
+            response = await self._client.post("/v3/mail/send", json=mail.get())
+        except httpx.HTTPError as e:
+            raise TransportError(str(e))
+        if response.status_code >= 400:
+            retryable = response.status_code == 429 or response.status_code >= 500
+            raise TransportError(f"SendGrid returned {response.status_code}", retryable=retryable)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class LocalSinkTransport:
+    """Keeps sent messages in memory (and optionally a JSONL file) instead of sending them."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.messages: List[dict] = []
+
+    async def send(self, message: dict):
+        record = {"to": message["to"], "subject": message["subject"], "html": message["html"]}
+        self.messages.append(record)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    async def close(self):
+        pass
+
+
+def transport_from_env():
+    if os.environ.get("EMAIL_TRANSPORT", "sendgrid") == "local":
+        return LocalSinkTransport(os.environ.get("EMAIL_SINK_PATH"))
+    return SendGridTransport(os.environ["SENDGRID_API_KEY"], os.environ["SENDGRID_FROM_EMAIL"])
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and lets one probe through after `reset_after` seconds.
+
+    The probe slot is shared by everyone using the breaker: while half-open,
+    allow() admits a single caller until it records the outcome or gives
+    the slot back with release_probe().
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def release_probe(self):
+        """Free the probe slot without an outcome (nothing was sent, or the failure was not the provider's)"""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+class EmailOutbox:
+    def __init__(self, collection, transport, workers: Optional[int] = None, batch_size: Optional[int] = None,
+                 max_attempts: Optional[int] = None, base_delay: float = 2.0, max_delay: float = 600.0,
+                 lease_seconds: float = 60.0, poll_interval: float = 1.0):
+        self.collection = collection
+        self.transport = transport
+        self.workers = workers or int(os.environ.get("EMAIL_OUTBOX_WORKERS", 2))
+        self.batch_size = batch_size or int(os.environ.get("EMAIL_OUTBOX_BATCH_SIZE", 10))
+        self.max_attempts = max_attempts or int(os.environ.get("EMAIL_OUTBOX_MAX_ATTEMPTS", 8))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.breaker = CircuitBreaker()
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def enqueue(self, to: str, subject: str, html: str) -> str:
+        now = datetime.now(timezone.utc)
+        message_id = str(uuid.uuid4())
+        await self.collection.insert_one({
+            "id": message_id,
+            "to": to,
+            "subject": subject,
+            "html": html,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            # The worker that sends it continues the enqueuing request's trace
+            "trace_context": tracing.carrier()
+        })
+        self._wakeup.set()
+        return message_id
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.transport.close()
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                # Messages whose worker died mid-send
+                {"status": "sending", "locked_until": {"$lte": now}}
+            ]},
+            {"$set": {"status": "sending", "locked_until": now + timedelta(seconds=self.lease_seconds)}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _claim_batch(self, limit: int) -> List[dict]:
+        batch = []
+        while len(batch) < limit:
+            message = await self._claim()
+            if message is None:
+                break
+            batch.append(message)
+        return batch
+
+    async def _deliver(self, message: dict):
+        try:
+            with stage("email_send"), tracing.span(
+                "email_send", {"email.attempt": message["attempts"] + 1},
+                carrier=message.get("trace_context"), kind=SpanKind.CLIENT
+            ):
+                await self.transport.send(message)
+        except Exception as e:
+            retryable = getattr(e, "retryable", True)
+            # A rejected message (bad address, invalid content) says nothing about the provider's health
+            if retryable:
+                self.breaker.record_failure()
+            attempts = message["attempts"] + 1
+            if not retryable or attempts >= self.max_attempts:
+                self.failed += 1
+                logger.error(f"Email to {message['to']} failed permanently: {e}")
+                await self.collection.update_one(
+                    {"id": message["id"]},
+                    {"$set": {"status": "failed", "attempts": attempts, "last_error": str(e)}}
+                )
+                return
+            self.retried += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+            logger.warning(f"Email to {message['to']} failed (attempt {attempts}), retrying in {delay:.0f}s: {e}")
+            await self.collection.update_one(
+                {"id": message["id"]},
+                {"$set": {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": str(e),
+                    "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay)
+                }}
+            )
+            return
+        self.breaker.record_success()
+        self.sent += 1
+        logger.info(f"Email sent successfully to {message['to']}")
+        await self.collection.update_one(
+            {"id": message["id"]},
+            {"$set": {"status": "sent", "attempts": message["attempts"] + 1, "sent_at": datetime.now(timezone.utc)}}
+        )
+
+    async def _worker(self):
+        while True:
+            try:
+                if not self.breaker.allow():
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                # Only one probe message while half-open, and only from the worker holding the probe slot
+                probe = self.breaker.state == "half_open"
+                try:
+                    batch = await self._claim_batch(1 if probe else self.batch_size)
+                    if batch:
+                        await asyncio.gather(*(self._deliver(m) for m in batch))
+                        continue
+                finally:
+                    if probe:
+                        self.breaker.release_probe()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Email outbox worker error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "circuit": self.breaker.state
+        }
@@ -0,0 +1,310 @@
+"""In-process metrics in the Prometheus text format.
+
+A deliberately small implementation (counters, gauges and histograms with
+labels) so that instrumenting a hot path costs a dict lookup, a bisect and
+a couple of additions under an uncontended lock. Everything is exposed by
+GET /metrics:
+
+* secureshare_http_request_duration_seconds{method,route,status}: every
+  request, until the last byte of its body (so downloads include the
+  transfer), labelled by route template;
+* secureshare_http_requests_in_flight;
+* secureshare_stage_duration_seconds{stage} and
+  secureshare_stage_bytes_total{stage}: password hashing, encryption,
+  decryption, blob reads and writes, and email sends;
+* secureshare_mongo_command_duration_seconds{command,collection,outcome}:
+  every MongoDB command, from pymongo's command monitoring;
+* secureshare_share_downloads_total{variant}: real vs decoy files served;
+* secureshare_otp_failures_total{flow}: share access or password reset;
+* secureshare_event_loop_lag_seconds: how late a periodic timer fires.
+"""
+import asyncio
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+# Latency buckets (seconds) from 0.5 ms to 60 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines += self._samples(values, child)
+        return lines
+
+    def _samples(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self, values, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            le = 'le="{}"'.format(_format_value(bound))
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for metric in _REGISTRY:
+        lines += metric.collect()
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "secureshare_http_request_duration_seconds", "HTTP requests until the last body byte was sent",
+    ("method", "route", "status")
+)
+HTTP_IN_FLIGHT = Gauge("secureshare_http_requests_in_flight", "HTTP requests being served")
+STAGE_SECONDS = Histogram(
+    "secureshare_stage_duration_seconds", "Time spent in each processing stage", ("stage",)
+)
+STAGE_BYTES = Counter("secureshare_stage_bytes_total", "Bytes processed by each stage", ("stage",))
+MONGO_COMMAND_SECONDS = Histogram(
+    "secureshare_mongo_command_duration_seconds", "MongoDB commands", ("command", "collection", "outcome")
+)
+SHARE_DOWNLOADS = Counter(
+    "secureshare_share_downloads_total", "Share-link downloads granted, by file served", ("variant",)
+)
+OTP_FAILURES = Counter("secureshare_otp_failures_total", "Wrong, expired or reused OTPs", ("flow",))
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "secureshare_event_loop_lag_seconds", "How late a periodic event-loop timer fired",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+
+@contextmanager
+def stage(name: str, nbytes: int = 0):
+    """Time the enclosed block as one pass through stage name (which processed nbytes)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+        if nbytes:
+            STAGE_BYTES.labels(name).inc(nbytes)
+
+
+def observe_stage(name: str, seconds: float, nbytes: int = 0):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    if nbytes:
+        STAGE_BYTES.labels(name).inc(nbytes)
+
+
+def timed(name: str, nbytes: int, fn, *args):
+    """fn(*args) under stage(name, nbytes); for passing to run_in_threadpool so queueing is not counted"""
+    with stage(name, nbytes):
+        return fn(*args)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording every HTTP request by method, route template and status"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+        finished = False
+
+        async def send_wrapper(message):
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and not finished:
+                finished = True
+                record()
+
+        def record():
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners cannot blow up the label set
+            template = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], template, str(status)).observe(time.perf_counter() - start)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            if not finished:
+                finished = True
+                record()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo listener timing every command (pass it to the client's event_listeners)"""
+
+    def __init__(self):
+        self._collections: Dict[Tuple[str, int], str] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def _record(self, event, outcome: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.labels(event.command_name, collection, outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+
+class EventLoopLagMonitor:
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,196 @@
+"""Online data migrations.
+
+Each migration walks its collections in _id order, a batch at a time, and
+only touches documents that still need converting, so it can run while the
+API is serving traffic and can be stopped and restarted at any point.
+
+    python migrations.py datetimes [--batch-size 500]
+    python migrations.py owner_ids [--batch-size 500]
+    python migrations.py share_link_metadata [--batch-size 500]
+    python migrations.py blob_keys [--batch-size 500]
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Union
+
+from pymongo import UpdateMany, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Fields that used to be stored as ISO-8601 strings
+DATETIME_FIELDS = {
+    "users": ["created_at"],
+    "files": ["upload_date"],
+    "share_links": ["expiry_date", "created_at"],
+    "file_access_otps": ["expiry", "created_at"],
+    "password_reset_otps": ["expiry", "created_at"],
+    "access_attempts": ["attempted_at"],
+}
+
+
+def parse_datetime(value: Union[str, datetime]) -> datetime:
+    """Return an aware UTC datetime from a BSON datetime or a legacy ISO string"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+async def migrate_datetimes(db, batch_size: int = 500) -> int:
+    """Convert ISO-string timestamps to native datetimes; returns documents updated"""
+    updated = 0
+    for collection, fields in DATETIME_FIELDS.items():
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        last_id = None
+        while True:
+            batch_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+            docs = await db[collection].find(batch_query, {field: 1 for field in fields}) \
+                .sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            requests = []
+            for doc in docs:
+                changes = {
+                    field: parse_datetime(doc[field])
+                    for field in fields if isinstance(doc.get(field), str)
+                }
+                # Match on the old values so a concurrent write is never clobbered
+                match = {"_id": doc["_id"], **{field: doc[field] for field in changes}}
+                requests.append(UpdateOne(match, {"$set": changes}))
+            result = await db[collection].bulk_write(requests, ordered=False)
+            updated += result.modified_count
+            last_id = docs[-1]["_id"]
+            logger.info(f"{collection}: converted {updated} documents so far")
+    return updated
+
+
+async def backfill_owner_ids(db, batch_size: int = 500) -> int:
+    """Copy each file's user_id onto its share links and access attempts as owner_id.
+
+    Only documents still missing owner_id are read, so once it has run this
+    costs one indexed query per collection; the server runs it on startup.
+    """
+    updated = 0
+    query = {"owner_id": {"$exists": False}}
+    for collection in ("share_links", "access_attempts"):
+        last_id = None
+        while True:
+            # Documents whose file is gone stay without an owner, so page by _id rather than re-querying
+            batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+            docs = await db[collection].find(batch_query, {"file_id": 1}) \
+                .sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            file_ids = list({doc["file_id"] for doc in docs})
+            files = await db.files.find({"id": {"$in": file_ids}}, {"id": 1, "user_id": 1}).to_list(len(file_ids))
+            if files:
+                result = await db[collection].bulk_write([
+                    UpdateMany({"file_id": f["id"], **query}, {"$set": {"owner_id": f["user_id"]}})
+                    for f in files
+                ], ordered=False)
+                updated += result.modified_count
+            last_id = docs[-1]["_id"]
+            logger.info(f"{collection}: owner_id backfilled on {updated} documents so far")
+    return updated
+
+
+async def backfill_share_link_metadata(db, batch_size: int = 500) -> int:
+    """Denormalize owner email and file names onto share links created before they were stored"""
+    updated = 0
+    last_id = None
+    query = {"owner_email": {"$exists": False}}
+    while True:
+        batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+        links = await db.share_links.find(batch_query, {"file_id": 1}) \
+            .sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not links:
+            break
+        file_ids = list({link["file_id"] for link in links})
+        files = await db.files.find(
+            {"id": {"$in": file_ids}}, {"id": 1, "user_id": 1, "filename": 1, "decoy_filename": 1}
+        ).to_list(len(file_ids))
+        user_ids = list({f["user_id"] for f in files})
+        owners = await db.users.find({"id": {"$in": user_ids}}, {"id": 1, "email": 1}).to_list(len(user_ids))
+        file_map = {f["id"]: f for f in files}
+        email_map = {u["id"]: u["email"] for u in owners}
+        requests = []
+        for link in links:
+            file_doc = file_map.get(link["file_id"])
+            if not file_doc or file_doc["user_id"] not in email_map:
+                continue
+            requests.append(UpdateOne({"_id": link["_id"]}, {"$set": {
+                "owner_id": file_doc["user_id"],
+                "owner_email": email_map[file_doc["user_id"]],
+                "filename": file_doc["filename"],
+                "decoy_filename": file_doc["decoy_filename"]
+            }}))
+        if requests:
+            result = await db.share_links.bulk_write(requests, ordered=False)
+            updated += result.modified_count
+        last_id = links[-1]["_id"]
+        logger.info(f"share link metadata backfilled on {updated} links so far")
+    return updated
+
+
+async def backfill_blob_keys(db, batch_size: int = 500) -> int:
+    """Replace absolute real/decoy file paths with storage-relative blob keys"""
+    updated = 0
+    last_id = None
+    query = {"real_blob_key": {"$exists": False}, "real_file_path": {"$exists": True}}
+    while True:
+        batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+        files = await db.files.find(batch_query, {"real_file_path": 1, "decoy_file_path": 1}) \
+            .sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not files:
+            break
+        requests = [
+            UpdateOne({"_id": f["_id"], "real_blob_key": {"$exists": False}}, {
+                "$set": {
+                    "real_blob_key": Path(f["real_file_path"]).name,
+                    "decoy_blob_key": Path(f["decoy_file_path"]).name
+                },
+                "$unset": {"real_file_path": "", "decoy_file_path": ""}
+            })
+            for f in files
+        ]
+        result = await db.files.bulk_write(requests, ordered=False)
+        updated += result.modified_count
+        last_id = files[-1]["_id"]
+        logger.info(f"blob keys backfilled on {updated} files so far")
+    return updated
+
+
+MIGRATIONS = {
+    "datetimes": migrate_datetimes,
+    "owner_ids": backfill_owner_ids,
+    "share_link_metadata": backfill_share_link_metadata,
+    "blob_keys": backfill_blob_keys,
+}
+
+
+async def _main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Run an online SecureShare data migration")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        updated = await MIGRATIONS[args.migration](client[os.environ['DB_NAME']], batch_size=args.batch_size)
+        print(f"{args.migration}: {updated} documents updated")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,121 @@
+"""Process pool for bcrypt password hashing.
+
+bcrypt is deliberately slow (hundreds of milliseconds per call), so running it
+inside an async handler stalls every other request on the event loop. The
+PasswordHasher runs hashing and verification in a dedicated pool of worker
+processes and refuses new work once too many calls are already waiting.
+If a worker process dies the pool is replaced, and the calls it broke are
+retried once on the new one.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from passlib.context import CryptContext
+
+from metrics import stage
+
+# Created lazily in each worker process
+_pwd_context: Optional[CryptContext] = None
+
+
+def _context() -> CryptContext:
+    global _pwd_context
+    if _pwd_context is None:
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
+
+
+def _hash(password: str) -> str:
+    return _context().hash(password)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return _context().verify(plain_password, hashed_password)
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the pool already has max_pending calls queued or running."""
+
+
+class PasswordHasher:
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.workers = workers or int(os.environ.get("PASSWORD_HASH_WORKERS", 0)) or os.cpu_count() or 1
+        self.max_pending = max_pending or int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 0)) or self.workers * 8
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn rather than fork: the parent runs the Mongo driver's threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor):
+        """Drop a pool broken by a dead worker, so the next call starts a fresh one"""
+        if self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                return await loop.run_in_executor(executor, fn, *args)
+            except BrokenProcessPool:
+                self._discard(executor)
+                # Hashing and verifying are safe to repeat
+                if attempt:
+                    raise
+
+    async def _submit(self, stage_name: str, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        try:
+            with stage(stage_name):
+                result = await self._run(fn, *args)
+        except Exception:
+            # e.g. a malformed hash, or a pool that broke again on the retry
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash_password", _hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit("verify_password", _verify, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "restarts": self.restarts
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
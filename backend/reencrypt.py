@@ -0,0 +1,458 @@
+"""Online bulk re-encryption of stored blobs.
+
+Rewrites the real and decoy blob of every file into the current format
+(and, with --rotate-keys, under a fresh key) while the API keeps serving:
+
+* files are walked in _id order and the position is checkpointed in
+  db.migration_checkpoints, so the job can be stopped and resumed;
+* blobs are decrypted and re-encrypted in a pool of worker processes,
+  optionally throttled to a byte rate and a blob operation rate;
+* new blobs are written under new keys and swapped in with one
+  conditional update of the file document, so readers see either the old
+  blobs and key or the new ones. Old blobs are deleted after a grace
+  period so downloads already streaming them can finish; until then they
+  are listed in db.retired_blobs, which the storage sweeper honours.
+
+Deduplicated blobs are shared between files and were always written in
+the current format, so they are only rewritten by --rotate-keys: after
+the files, each db.blobs record gets a new key and a new cas_* generation,
+and the files referencing it are then pointed at the new blob.
+
+    python reencrypt.py [--workers 4] [--max-mbps 200] [--max-iops 400]
+                        [--rotate-keys] [--restart]
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterable, Optional
+
+from cryptography.fernet import Fernet
+
+from blob_format import (
+    FORMAT_AEAD, FORMAT_AEAD_COMPRESSED, SEGMENT_SIZE, SegmentDecryptor, decrypt_blob, is_segmented, new_encryptor
+)
+from blob_store import blob_store_from_env
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path(__file__).parent / "uploads"
+JOB_NAME = "reencrypt"
+# Every file costs a read and a write of each of its two blobs, a deduplicated blob one of each
+OPS_PER_FILE = 4
+OPS_PER_BLOB = 2
+
+# Created lazily in each worker process
+_store = None
+
+
+async def _plaintext(store, blob_key: str, key: bytes):
+    chunks = store.get(blob_key)
+    try:
+        data = await chunks.__anext__()
+    except StopAsyncIteration:
+        data = b""
+    if not is_segmented(data):
+        yield decrypt_blob(data + b"".join([chunk async for chunk in chunks]), key)
+        return
+    decryptor = SegmentDecryptor(key)
+    for plaintext in decryptor.feed(data):
+        yield plaintext
+    async for data in chunks:
+        for plaintext in decryptor.feed(data):
+            yield plaintext
+    yield decryptor.close()
+
+
+async def _reencrypt(src: str, dst: str, old_key: bytes, new_key: bytes, segment_size: int) -> tuple:
+    global _store
+    if _store is None:
+        _store = blob_store_from_env(UPLOAD_DIR)
+    encryptor = None
+
+    async def segments():
+        nonlocal encryptor
+        buffer = bytearray()
+        index = 0
+        async for plaintext in _plaintext(_store, src, old_key):
+            buffer += plaintext
+            # Keep at least one byte back: the last segment has to be flagged as final
+            while len(buffer) > segment_size:
+                if encryptor is None:
+                    encryptor = new_encryptor(new_key, bytes(buffer[:segment_size]), segment_size)
+                    yield encryptor.header()
+                yield encryptor.encrypt_segment(bytes(buffer[:segment_size]), index, False)
+                del buffer[:segment_size]
+                index += 1
+        if encryptor is None:
+            # The whole file fits in one segment
+            encryptor = new_encryptor(new_key, bytes(buffer), segment_size)
+            yield encryptor.header()
+        yield encryptor.encrypt_segment(bytes(buffer), index, True)
+        yield encryptor.trailer()
+
+    written = await _store.put(dst, segments())
+    return written, encryptor.format
+
+
+def reencrypt_blob(src: str, dst: str, old_key: bytes, new_key: bytes, segment_size: int = SEGMENT_SIZE) -> tuple:
+    """Worker entry point: rewrite blob src as dst; returns (bytes written, format written)"""
+    return asyncio.run(_reencrypt(src, dst, old_key, new_key, segment_size))
+
+
+class Throttle:
+    """Token bucket allowing `rate` units per second; a large request may overdraw it."""
+
+    def __init__(self, rate: Optional[float]):
+        self.rate = rate
+        self._tokens = rate or 0
+        self._updated = time.monotonic()
+
+    async def acquire(self, amount: float):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class Progress:
+    def __init__(self, total_files: int, total_bytes: int, total_blobs: int = 0):
+        self.total_files = total_files
+        self.total_blobs = total_blobs
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.blobs = 0
+        self.bytes = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    def snapshot(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        rate = self.bytes / elapsed if elapsed else 0
+        remaining = max(0, self.total_bytes - self.bytes)
+        return {
+            "files_done": self.files,
+            "files_total": self.total_files,
+            "blobs_done": self.blobs,
+            "blobs_total": self.total_blobs,
+            "failed": self.failed,
+            "bytes_done": self.bytes,
+            "bytes_total": self.total_bytes,
+            "mb_per_second": round(rate / 1e6, 2),
+            "eta_seconds": round(remaining / rate) if rate else None,
+        }
+
+
+# File document fields locating a file's blobs and keys
+_BLOB_FIELDS = (
+    "encryption_key", "real_encryption_key", "decoy_encryption_key",
+    "real_blob_key", "decoy_blob_key", "real_file_path", "decoy_file_path",
+)
+
+
+def _file_key(file_doc: dict, variant: str) -> bytes:
+    return base64.b64decode(file_doc.get(f"{variant}_encryption_key") or file_doc["encryption_key"])
+
+
+def _blob_key(file_doc: dict, variant: str) -> str:
+    if f"{variant}_blob_key" in file_doc:
+        return file_doc[f"{variant}_blob_key"]
+    return Path(file_doc[f"{variant}_file_path"]).name
+
+
+class ReencryptJob:
+    def __init__(self, db, store, workers: int, max_mbps: Optional[float] = None,
+                 max_iops: Optional[float] = None, rotate_keys: bool = False,
+                 grace_period: float = 300, report_interval: float = 10):
+        self.db = db
+        self.store = store
+        self.workers = workers
+        self.bytes_throttle = Throttle(max_mbps * 1e6 if max_mbps else None)
+        self.ops_throttle = Throttle(max_iops)
+        self.rotate_keys = rotate_keys
+        self.grace_period = grace_period
+        self.report_interval = report_interval
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # (deadline, blob keys, coroutine function to run before deleting them or None)
+        self._retired = []
+
+    def _query(self) -> dict:
+        # Deduplicated blobs are shared between files: they are rewritten once, from db.blobs
+        query = {"real_blob_id": {"$exists": False}}
+        if self.rotate_keys:
+            return query
+        # Otherwise only files with a blob not yet in a current format (2, or 3 when compressed)
+        current = {"$in": [FORMAT_AEAD, FORMAT_AEAD_COMPRESSED]}
+        return {**query, "$nor": [
+            {"real_blob_format": current, "decoy_blob_format": current},
+            # Files from before each blob's format was recorded
+            {"real_blob_format": {"$exists": False}, "blob_format": current},
+        ]}
+
+    def _blob_query(self) -> Optional[dict]:
+        # Deduplicated blobs were always written in the current format, so only rotation touches them
+        return {"refcount": {"$gt": 0}} if self.rotate_keys else None
+
+    async def _checkpoint(self, **fields):
+        await self.db.migration_checkpoints.update_one(
+            {"_id": JOB_NAME},
+            {"$set": {**fields, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    async def _hold(self, blob_keys: Iterable[str]):
+        """Keep the storage sweeper off blobs about to be replaced until their grace period is over"""
+        delete_after = datetime.now(timezone.utc) + timedelta(seconds=self.grace_period)
+        await self.db.retired_blobs.insert_many([
+            {"blob_key": key, "delete_after": delete_after, "job": JOB_NAME} for key in blob_keys
+        ])
+
+    async def _rewrite(self, file_doc: dict) -> int:
+        loop = asyncio.get_running_loop()
+        variants = ("real", "decoy")
+        old_keys = {variant: _file_key(file_doc, variant) for variant in variants}
+        new_keys = {variant: Fernet.generate_key() if self.rotate_keys else old_keys[variant] for variant in variants}
+        generation = uuid.uuid4().hex[:8]
+        old_blobs = {variant: _blob_key(file_doc, variant) for variant in variants}
+        new_blobs = {variant: f"{file_doc['id']}_{variant}.{generation}.enc" for variant in variants}
+        try:
+            results = dict(zip(variants, await asyncio.gather(*(
+                loop.run_in_executor(self._executor, reencrypt_blob,
+                                     old_blobs[variant], new_blobs[variant], old_keys[variant], new_keys[variant])
+                for variant in variants
+            ))))
+            written = sum(size for size, _ in results.values())
+            # Held before the swap, so a crash right after it cannot leave them unprotected;
+            # if the swap does not happen they are still referenced and the hold is moot
+            await self._hold(old_blobs.values())
+            # Swap only if nobody changed the document since we read it
+            match = {"_id": file_doc["_id"]}
+            for field in _BLOB_FIELDS:
+                match[field] = file_doc.get(field, {"$exists": False})
+            result = await self.db.files.update_one(match, {
+                "$set": {
+                    **{f"{variant}_blob_key": new_blobs[variant] for variant in variants},
+                    **{f"{variant}_encryption_key": base64.b64encode(new_keys[variant]).decode() for variant in variants},
+                    **{f"{variant}_blob_format": results[variant][1] for variant in variants}
+                },
+                "$unset": {"encryption_key": "", "real_file_path": "", "decoy_file_path": "", "blob_format": ""}
+            })
+        except BaseException:
+            await asyncio.gather(*(self.store.delete(key) for key in new_blobs.values()), return_exceptions=True)
+            raise
+        if result.modified_count:
+            self._retired.append((time.monotonic() + self.grace_period, list(old_blobs.values()), None))
+        else:
+            logger.warning(f"File {file_doc['id']} changed during re-encryption, discarding new blobs")
+            await asyncio.gather(*(self.store.delete(key) for key in new_blobs.values()))
+        return written
+
+    async def _repoint(self, digest: str, old_blob: str, new_fields: dict):
+        """Point the files still using old_blob of deduplicated blob digest at its new blob and key"""
+        for variant in ("real", "decoy"):
+            await self.db.files.update_many(
+                {f"{variant}_blob_id": digest, f"{variant}_blob_key": old_blob},
+                {"$set": {f"{variant}_{field}": value for field, value in new_fields.items()}}
+            )
+
+    async def _rewrite_blob(self, record: dict) -> int:
+        loop = asyncio.get_running_loop()
+        digest = record["id"]
+        old_blob = record["blob_key"]
+        new_key = Fernet.generate_key()
+        new_blob = f"cas_{digest}.{uuid.uuid4().hex[:8]}.enc"
+        try:
+            written, blob_format = await loop.run_in_executor(
+                self._executor, reencrypt_blob, old_blob, new_blob,
+                base64.b64decode(record["encryption_key"]), new_key
+            )
+            new_fields = {
+                "blob_key": new_blob, "encryption_key": base64.b64encode(new_key).decode(), "blob_format": blob_format
+            }
+            await self._hold([old_blob])
+            # Swap only while the blob is still referenced and nobody replaced it since we read it;
+            # a release racing with us either sees the new blob_key or makes this match nothing
+            result = await self.db.blobs.update_one(
+                {"id": digest, "blob_key": old_blob, "refcount": {"$gt": 0}},
+                {"$set": new_fields}
+            )
+        except BaseException:
+            await asyncio.gather(self.store.delete(new_blob), return_exceptions=True)
+            raise
+        if not result.modified_count:
+            logger.warning(f"Blob {digest} changed during re-encryption, discarding the new blob")
+            await self.store.delete(new_blob)
+            return written
+
+        async def repoint():
+            # Also catches files whose upload took a reference just before the swap
+            await self._repoint(digest, old_blob, new_fields)
+
+        # Retired first, so a failure below still re-points the files before the old blob goes
+        self._retired.append((time.monotonic() + self.grace_period, [old_blob], repoint))
+        await repoint()
+        return written
+
+    async def _delete_retired(self, force: bool = False):
+        while self._retired and (force or self._retired[0][0] <= time.monotonic()):
+            deadline, keys, before = self._retired.pop(0)
+            if force:
+                await asyncio.sleep(max(0, deadline - time.monotonic()))
+            if before is not None:
+                await before()
+            await asyncio.gather(*(self.store.delete(key) for key in keys))
+
+    async def _totals(self, collection, query: dict, size: dict) -> tuple:
+        totals = await collection.aggregate([
+            {"$match": query},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "bytes": {"$sum": size}}}
+        ]).to_list(1)
+        return (totals[0]["count"], totals[0]["bytes"]) if totals else (0, 0)
+
+    async def run(self, restart: bool = False, batch_size: int = 100) -> dict:
+        checkpoint = await self.db.migration_checkpoints.find_one({"_id": JOB_NAME})
+        # A finished run leaves nothing to resume; the next one starts over
+        resume = checkpoint and not checkpoint.get("finished_at") and not restart
+        phase = checkpoint.get("phase", "files") if resume else "files"
+        last_id = checkpoint.get("last_id") if resume else None
+        phases = [("files", self.db.files, self._query(), self._rewrite)]
+        if self._blob_query() is not None:
+            phases.append(("blobs", self.db.blobs, self._blob_query(), self._rewrite_blob))
+        if phase == "blobs":
+            phases = phases[1:]
+
+        def remaining(query: dict, name: str) -> dict:
+            return query if name != phase or last_id is None else {**query, "_id": {"$gt": last_id}}
+
+        total_files = total_blobs = total_bytes = 0
+        for name, collection, query, _ in phases:
+            if name == "files":
+                total_files, nbytes = await self._totals(collection, remaining(query, name), {
+                    "$add": [{"$ifNull": ["$file_size", 0]}, {"$ifNull": ["$decoy_file_size", 0]}]
+                })
+            else:
+                total_blobs, nbytes = await self._totals(collection, remaining(query, name), {"$ifNull": ["$size", 0]})
+            total_bytes += nbytes
+        progress = Progress(total_files, total_bytes, total_blobs)
+        await self._checkpoint(phase=phase, last_id=last_id, started_at=datetime.now(timezone.utc), finished_at=None)
+        logger.info(f"Re-encrypting {progress.total_files} files and {progress.total_blobs} deduplicated blobs "
+                    f"({progress.total_bytes / 1e9:.2f} GB)")
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # Tasks in _id order; the checkpoint only advances past a prefix that has fully finished
+        inflight = []
+        try:
+            for name, collection, query, rewrite in phases:
+                if name != phase:
+                    phase, last_id = name, None
+                    await self._checkpoint(phase=phase, last_id=None)
+                await self._walk(name, collection, remaining(query, name), rewrite, inflight, progress, batch_size)
+            await self._delete_retired(force=True)
+            snapshot = progress.snapshot()
+            await self._checkpoint(progress=snapshot, finished_at=datetime.now(timezone.utc))
+            return snapshot
+        finally:
+            for _, _, task in inflight:
+                task.cancel()
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    async def _walk(self, phase: str, collection, query: dict, rewrite, inflight: list,
+                    progress: Progress, batch_size: int):
+        """Rewrite every document matching query with rewrite(doc), in _id order"""
+        last_id = None
+        last_report = time.monotonic()
+        while True:
+            batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+            docs = await collection.find(batch_query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            last_id = docs[-1]["_id"]
+            for doc in docs:
+                await self.bytes_throttle.acquire(_size(phase, doc))
+                await self.ops_throttle.acquire(OPS_PER_FILE if phase == "files" else OPS_PER_BLOB)
+                inflight.append((phase, doc, asyncio.ensure_future(rewrite(doc))))
+                # Two tasks per worker keeps the pool busy while results are being swapped in
+                while len([task for _, _, task in inflight if not task.done()]) >= self.workers * 2:
+                    await asyncio.wait([task for _, _, task in inflight if not task.done()],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                await self._collect(inflight, progress)
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    logger.info(f"Progress: {progress.snapshot()}")
+        # The next phase checkpoints its own positions, so finish this one first
+        if inflight:
+            await asyncio.wait([task for _, _, task in inflight])
+        await self._collect(inflight, progress)
+
+    async def _collect(self, inflight: list, progress: Progress):
+        checkpoint_id = None
+        while inflight and inflight[0][2].done():
+            phase, doc, task = inflight.pop(0)
+            error = asyncio.CancelledError() if task.cancelled() else task.exception()
+            if error:
+                # Left as it was; the next full run picks it up again
+                progress.failed += 1
+                logger.error(f"Re-encrypting {phase[:-1]} {doc['id']} failed: {error!r}")
+            else:
+                if phase == "files":
+                    progress.files += 1
+                else:
+                    progress.blobs += 1
+                progress.bytes += _size(phase, doc)
+            checkpoint_id = doc["_id"]
+        if checkpoint_id is not None:
+            await self._checkpoint(last_id=checkpoint_id, progress=progress.snapshot())
+        await self._delete_retired()
+
+
+def _size(phase: str, doc: dict) -> int:
+    """Plaintext bytes a file or deduplicated blob record stands for"""
+    if phase == "files":
+        return doc.get("file_size", 0) + doc.get("decoy_file_size", 0)
+    return doc.get("size", 0)
+
+
+async def _main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Re-encrypt stored SecureShare blobs online")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max-mbps", type=float, help="plaintext megabytes per second")
+    parser.add_argument("--max-iops", type=float, help="blob reads and writes per second")
+    parser.add_argument("--rotate-keys", action="store_true", help="encrypt every file and deduplicated blob under a new key")
+    parser.add_argument("--grace-period", type=float, default=300,
+                        help="seconds to keep replaced blobs for downloads in progress")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of an interrupted run")
+    parser.add_argument("--report-interval", type=float, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        job = ReencryptJob(
+            client[os.environ['DB_NAME']], blob_store_from_env(UPLOAD_DIR), args.workers,
+            max_mbps=args.max_mbps, max_iops=args.max_iops, rotate_keys=args.rotate_keys,
+            grace_period=args.grace_period, report_interval=args.report_interval
+        )
+        print(await job.run(restart=args.restart))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
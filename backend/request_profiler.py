@@ -0,0 +1,277 @@
+"""On-demand stack profiles of single requests.
+
+Opt-in with PROFILER_ENABLED=1; when it is off the middleware is not
+installed and nothing runs. Once enabled, a request is profiled when
+
+* it carries an X-Profile-Token header equal to PROFILER_TOKEN, or
+* it is the Nth request since the last sampled one (PROFILER_SAMPLE_EVERY=N,
+  default 0: on request only).
+
+While a profiled request runs, a sampling thread records every
+PROFILER_INTERVAL_MS (default 5) the Python stack of every busy thread:
+the event loop and the threads it hands work to (decryption, Motor, blob
+file I/O). Threads waiting for work are skipped. The event loop and the
+thread pools are shared, so other requests in flight show up as well;
+bcrypt runs in separate processes and shows up as the event loop waiting.
+
+When the response is done the profile is written to PROFILER_DIR (default
+profiles/ next to this module) for https://www.speedscope.app or, with
+PROFILER_FORMAT=collapsed, as folded stacks for flamegraph.pl. Only the
+newest PROFILER_MAX_FILES (default 50) are kept. GET /debug/profiles lists
+them and GET /debug/profiles/{name} downloads one; both need the token.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = b"x-profile-token"
+FORMATS = {"speedscope": ".speedscope.json", "collapsed": ".collapsed.txt"}
+MAX_DEPTH = 256
+# A thread whose innermost Python frame is in one of these is waiting for work
+_IDLE_MODULES = ("threading.py", "queue.py", "selectors.py", os.path.join("concurrent", "futures", "thread.py"))
+
+
+class StackSampler:
+    """Samples the stacks of the process's busy threads from a background thread"""
+
+    def __init__(self, loop_thread: int, interval: float):
+        self.loop_thread = loop_thread
+        self.interval = interval
+        self.frames: List[Tuple[str, str, int]] = []
+        self._frame_ids: Dict[Tuple[str, str, int], int] = {}
+        # thread id -> [(stack as frame ids, root first; seconds it stands for)]
+        self.samples: Dict[int, List[Tuple[Tuple[int, ...], float]]] = defaultdict(list)
+        self.thread_names: Dict[int, str] = {}
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        self.thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+    def _frame_id(self, code) -> int:
+        key = (getattr(code, "co_qualname", code.co_name), code.co_filename, code.co_firstlineno)
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            frame_id = self._frame_ids[key] = len(self.frames)
+            self.frames.append(key)
+        return frame_id
+
+    def _stack(self, frame) -> Tuple[int, ...]:
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(self._frame_id(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def _run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident != self.loop_thread and frame.f_code.co_filename.endswith(_IDLE_MODULES):
+                    continue
+                self.samples[ident].append((self._stack(frame), weight))
+
+    def _thread_name(self, ident: int) -> str:
+        if ident == self.loop_thread:
+            return "event loop"
+        return self.thread_names.get(ident, f"thread {ident}")
+
+    def _threads(self):
+        # Event loop first, so it is the profile speedscope opens
+        return sorted(self.samples.items(), key=lambda item: (item[0] != self.loop_thread, self._thread_name(item[0])))
+
+    def speedscope(self, name: str) -> dict:
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "secureshare",
+            "activeProfileIndex": 0,
+            "shared": {"frames": [{"name": qualname, "file": filename, "line": line}
+                                  for qualname, filename, line in self.frames]},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": self._thread_name(ident),
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weight for _, weight in samples),
+                    "samples": [list(stack) for stack, _ in samples],
+                    "weights": [weight for _, weight in samples],
+                }
+                for ident, samples in self._threads()
+            ],
+        }
+
+    def collapsed(self) -> str:
+        """One "thread;outer;...;inner count" line per distinct stack (flamegraph.pl input)"""
+        names = [f"{qualname} ({os.path.basename(filename)}:{line})" for qualname, filename, line in self.frames]
+        counts: Counter = Counter()
+        for ident, samples in self._threads():
+            thread = self._thread_name(ident)
+            for stack, _ in samples:
+                counts[";".join([thread, *(names[frame] for frame in stack)])] += 1
+        return "".join(f"{stack} {count}\n" for stack, count in counts.items())
+
+
+class RequestProfiler:
+    def __init__(self, enabled: Optional[bool] = None, token: Optional[str] = None,
+                 sample_every: Optional[int] = None, interval: Optional[float] = None,
+                 directory: Optional[Path] = None, max_files: Optional[int] = None,
+                 output_format: Optional[str] = None, max_concurrent: Optional[int] = None):
+        self.enabled = enabled if enabled is not None else os.environ.get("PROFILER_ENABLED", "0") == "1"
+        self.token = token if token is not None else os.environ.get("PROFILER_TOKEN", "")
+        self.sample_every = sample_every if sample_every is not None else int(os.environ.get("PROFILER_SAMPLE_EVERY", 0))
+        self.interval = interval or float(os.environ.get("PROFILER_INTERVAL_MS", 5)) / 1000
+        self.directory = Path(directory or os.environ.get("PROFILER_DIR", Path(__file__).parent / "profiles"))
+        self.max_files = max_files or int(os.environ.get("PROFILER_MAX_FILES", 50))
+        self.format = output_format or os.environ.get("PROFILER_FORMAT", "speedscope")
+        if self.format not in FORMATS:
+            raise ValueError(f"Unknown PROFILER_FORMAT: {self.format}")
+        # Each profiled request adds a thread walking every stack; bound how many run at once
+        self.max_concurrent = max_concurrent or int(os.environ.get("PROFILER_MAX_CONCURRENT", 2))
+        self.active = 0
+        self.requests = 0
+        self.profiled = 0
+        self.skipped = 0
+
+    def _wants(self, scope) -> bool:
+        self.requests += 1
+        if self.sample_every and self.requests % self.sample_every == 0:
+            return True
+        if not self.token:
+            return False
+        for name, value in scope["headers"]:
+            if name == TOKEN_HEADER:
+                return secrets.compare_digest(value, self.token.encode())
+        return False
+
+    def should_profile(self, scope) -> bool:
+        if not self._wants(scope):
+            return False
+        if self.active >= self.max_concurrent:
+            self.skipped += 1
+            return False
+        return True
+
+    def authorize(self, token: Optional[str]):
+        """For the listing endpoints: 404 unless profiling is on and the token matches"""
+        if not self.enabled or not self.token or not secrets.compare_digest((token or "").encode(), self.token.encode()):
+            raise HTTPException(status_code=404, detail="Not found")
+
+    def _write(self, sampler: StackSampler, method: str, route: str, status: int) -> str:
+        finished = datetime.now(timezone.utc)
+        route_slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        name = f"{finished:%Y%m%dT%H%M%S%fZ}-{method}-{route_slug}-{status}-{sampler.duration * 1000:.0f}ms"
+        name += FORMATS[self.format]
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.format == "speedscope":
+            body = json.dumps(sampler.speedscope(f"{method} {route} -> {status}"), separators=(",", ":"))
+        else:
+            body = sampler.collapsed()
+        (self.directory / name).write_text(body)
+        # Names start with the time, so the oldest sort first
+        for old in self._files()[:-self.max_files]:
+            old.unlink(missing_ok=True)
+        return name
+
+    def _files(self) -> List[Path]:
+        if not self.directory.is_dir():
+            return []
+        return sorted(path for path in self.directory.iterdir() if path.name.endswith(tuple(FORMATS.values())))
+
+    def list(self) -> List[dict]:
+        """Stored profiles, newest first"""
+        profiles = []
+        for path in reversed(self._files()):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            profiles.append({
+                "name": path.name,
+                "bytes": st.st_size,
+                "created_at": datetime.fromtimestamp(st.st_mtime, timezone.utc)
+            })
+        return profiles
+
+    def path(self, name: str) -> Path:
+        for path in self._files():
+            if path.name == name:
+                return path
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_every": self.sample_every,
+            "active": self.active,
+            "profiled": self.profiled,
+            "skipped_busy": self.skipped
+        }
+
+    async def profile(self, scope, receive, send, app):
+        """Run app for this request under a StackSampler and store the profile"""
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.active += 1
+        sampler.start()
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            await asyncio.to_thread(sampler.stop)
+            self.active -= 1
+            self.profiled += 1
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            try:
+                name = await asyncio.to_thread(self._write, sampler, scope["method"], route, status)
+                logger.info(f"Profiled {scope['method']} {route}: {name}")
+            except Exception as e:
+                logger.error(f"Could not write request profile: {e}")
+
+
+class ProfilerMiddleware:
+    """ASGI middleware handing the requests picked by a RequestProfiler to it (install only when enabled)"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.should_profile(scope):
+            return await self.app(scope, receive, send)
+        await self.profiler.profile(scope, receive, send, self.app)
@@ -0,0 +1,95 @@
+"""Shared, byte-bounded cache of ciphertext blocks.
+
+Blobs are read in fixed-size blocks. Concurrent readers of the same block
+share a single read from the blob store (single-flight), and recently read
+blocks are kept in an LRU bounded by total bytes, so a popular file costs
+one read per block rather than one per download. Only ciphertext is ever
+cached; every reader still decrypts for itself.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+
+class SegmentCache:
+    def __init__(self, blob_store, max_bytes: Optional[int] = None, block_size: Optional[int] = None):
+        self.blob_store = blob_store
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get("SEGMENT_CACHE_BYTES", 256 * 1024 * 1024))
+        self.block_size = block_size or int(os.environ.get("SEGMENT_CACHE_BLOCK_SIZE", 1024 * 1024))
+        self._blocks: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+        self._loading: Dict[Tuple[str, int], asyncio.Future] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    async def _load(self, key: str, index: int, blob_size: int) -> bytes:
+        offset = index * self.block_size
+        length = min(self.block_size, blob_size - offset)
+        return b"".join([data async for data in self.blob_store.get(key, offset, length)])
+
+    async def block(self, key: str, index: int, blob_size: int) -> bytes:
+        cache_key = (key, index)
+        data = self._blocks.get(cache_key)
+        if data is not None:
+            self._blocks.move_to_end(cache_key)
+            self.hits += 1
+            return data
+        loading = self._loading.get(cache_key)
+        if loading is not None:
+            self.coalesced += 1
+            # shield: one waiter giving up must not cancel the read for the others
+            return await asyncio.shield(loading)
+
+        self.misses += 1
+        loading = asyncio.ensure_future(self._load(key, index, blob_size))
+        self._loading[cache_key] = loading
+        try:
+            data = await asyncio.shield(loading)
+        finally:
+            if loading.done():
+                self._loading.pop(cache_key, None)
+            else:
+                loading.add_done_callback(lambda _: self._loading.pop(cache_key, None))
+        self._store(cache_key, data)
+        return data
+
+    def _store(self, cache_key: Tuple[str, int], data: bytes):
+        if len(data) > self.max_bytes or cache_key in self._blocks:
+            return
+        self._blocks[cache_key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    async def read(self, key: str, blob_size: int, offset: int = 0,
+                   length: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Stream bytes of a blob (like BlobStore.get) through the cache"""
+        end = blob_size if length is None else min(blob_size, offset + length)
+        index = offset // self.block_size
+        while offset < end:
+            data = await self.block(key, index, blob_size)
+            start = offset - index * self.block_size
+            piece = data[start:start + end - offset]
+            if not piece:
+                break
+            yield piece
+            offset += len(piece)
+            index += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "max_bytes": self.max_bytes,
+            "bytes": self.size,
+            "blocks": len(self._blocks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else None
+        }
@@ -1,45 +1,97 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Header, Query, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from cryptography.fernet import Fernet
 import base64
 import secrets
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import hashlib
 import json
+from db_indexes import ensure_indexes
+from migrations import backfill_owner_ids, parse_datetime
+from dashboard import date_range_filter, fetch_page, page_response, page_with_filenames_pipeline
+from email_outbox import EmailOutbox, transport_from_env
+from blob_store import BlobNotFound, MeteredBlobStore, blob_store_from_env
+from principal_cache import PrincipalCache
+from upload_sessions import UploadSessions
+from segment_cache import SegmentCache
+from download_tickets import DownloadTickets, redeem_pipeline
+from blob_dedup import BlobDeduplicator
+from storage_sweeper import StorageSweeper
+from password_pool import PasswordHasher, PasswordHasherBusy
+import metrics
+import tracing
+from request_profiler import ProfilerMiddleware, RequestProfiler
+from blob_format import (
+    FORMAT_AEAD, FORMAT_AEAD_COMPRESSED, HEADER_V3, PREAMBLE, SEGMENT_SIZE, TRAILER, SegmentDecryptor, SegmentIndex,
+    decrypt_blob, is_segmented, new_encryptor, trailer_length
+)
+from urllib.parse import quote
+from email.utils import format_datetime
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Tracing (TRACE_EXPORTER=file|otlp, off by default)
+tracing.configure()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url, tz_aware=True, event_listeners=[metrics.MongoCommandMetrics(), tracing.MongoCommandTracing()]
+)
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher()
+principal_cache = PrincipalCache()
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key')
 ALGORITHM = "HS256"
 
-# File storage
+# File storage (blob keys are relative to the store, e.g. "{file_id}_real.enc")
 UPLOAD_DIR = ROOT_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+blob_store = MeteredBlobStore(blob_store_from_env(UPLOAD_DIR))
+
+# Ciphertext blocks shared by concurrent and repeated downloads (SEGMENT_CACHE_BYTES=0 disables)
+segment_cache = SegmentCache(blob_store)
+
+# Identical uploads by the same owner are stored once
+blob_dedup = BlobDeduplicator(db.blobs, blob_store, os.environ.get("DEDUP_SECRET", JWT_SECRET))
+
+# Resumable chunked uploads
+upload_sessions = UploadSessions(db.upload_sessions, blob_store)
+
+# Share downloads are served (and resumed) with tickets minted on OTP verification
+download_tickets = DownloadTickets(JWT_SECRET)
+
+# Removes orphaned blobs and temp files and expires share links (SWEEPER_INTERVAL_SECONDS=0 disables)
+storage_sweeper = StorageSweeper(db, blob_store, temp_dir=UPLOAD_DIR)
+
+# Dashboard pagination
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
 
-# SendGrid for Email
-sendgrid_client = SendGridAPIClient(os.environ['SENDGRID_API_KEY'])
+# Email outbox (SendGrid, or a local sink when EMAIL_TRANSPORT=local)
+email_outbox = EmailOutbox(db.email_outbox, transport_from_env())
+
+# Prometheus metrics, served at /metrics (outside /api, so not routed by the public ingress)
+event_loop_lag = metrics.EventLoopLagMonitor()
+
+# Per-request stack profiles, on demand (PROFILER_ENABLED=1; listed at /debug/profiles)
+request_profiler = RequestProfiler()
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -65,6 +117,12 @@ class FileUploadResponse(BaseModel):
     filename: str
     message: str
 
+class UploadSessionCreate(BaseModel):
+    real_filename: str
+    real_size: int = Field(ge=0)
+    decoy_filename: str
+    decoy_size: int = Field(ge=0)
+
 class ShareLinkCreate(BaseModel):
     file_id: str
     password: str
@@ -111,11 +169,19 @@ class VerifyFileAccessOTP(BaseModel):
     password: str
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    try:
+        with tracing.span("hash_password"):
+            return await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        with tracing.span("verify_password"):
+            return await password_hasher.verify(plain_password, hashed_password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
 
 def create_token(data: dict) -> str:
     to_encode = data.copy()
@@ -123,44 +189,316 @@ def create_token(data: dict) -> str:
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def _token_payload(credentials: HTTPAuthorizationCredentials) -> dict:
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    user_id = _token_payload(credentials)["sub"]
+    user = principal_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        principal_cache.put(user_id, user)
+    return user
+
+async def get_token_principal(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """For read-only routes: trust the signed email/name claims and skip the database"""
+    payload = _token_payload(credentials)
+    if "email" in payload and "name" in payload:
+        return {"id": payload["sub"], "email": payload["email"], "name": payload["name"]}
+    # Tokens issued before the claims were added
+    return await get_current_user(credentials)
 
 def generate_encryption_key() -> bytes:
     return Fernet.generate_key()
 
-def encrypt_file(file_content: bytes, key: bytes) -> bytes:
-    f = Fernet(key)
-    return f.encrypt(file_content)
-
 def decrypt_file(encrypted_content: bytes, key: bytes) -> bytes:
-    f = Fernet(key)
-    return f.decrypt(encrypted_content)
+    return decrypt_blob(encrypted_content, key)
 
-async def send_alert_email(email: str, subject: str, content: str):
+async def store_encrypted_upload(upload: UploadFile, blob_key: str, key: bytes) -> int:
+    """Encrypt (and compress, if it pays) an upload segment by segment into the blob store, returning the blob format"""
+    encryptor = None
+    
+    async def segments():
+        nonlocal encryptor
+        index = 0
+        chunk = await upload.read(SEGMENT_SIZE)
+        # The first segment decides whether the file is compressed
+        encryptor = await run_in_threadpool(new_encryptor, key, chunk)
+        yield encryptor.header()
+        while True:
+            # Read one segment ahead so the last one can be flagged as final
+            next_chunk = await upload.read(SEGMENT_SIZE) if len(chunk) == SEGMENT_SIZE else b""
+            final = not next_chunk
+            yield await run_in_threadpool(metrics.timed, "encrypt", len(chunk), encryptor.encrypt_segment, chunk, index, final)
+            if final:
+                break
+            chunk = next_chunk
+            index += 1
+        yield encryptor.trailer()
+    
+    with tracing.span("encrypt_file", {"blob.key": blob_key}):
+        await blob_store.put(blob_key, segments())
+    return encryptor.format
+
+async def store_upload(upload: UploadFile, owner_id: str) -> dict:
+    """Store an upload once per owner and payload; returns its blob record (blob_key, encryption_key, blob_format, size, id)"""
+    hasher = blob_dedup.hasher(owner_id)
+    size = 0
+    while chunk := await upload.read(SEGMENT_SIZE):
+        await run_in_threadpool(hasher.update, chunk)
+        size += len(chunk)
+    
+    async def store(key_name: str, key: bytes) -> int:
+        await upload.seek(0)
+        return await store_encrypted_upload(upload, key_name, key)
+    
+    return await blob_dedup.acquire(owner_id, hasher.hexdigest(), size, generate_encryption_key, store)
+
+def file_document(file_id: str, user_id: str, filename: str, decoy_filename: str, real: dict, decoy: dict) -> dict:
+    """real and decoy: {"blob_key", "encryption_key" (base64), "blob_format", "size"} plus "id" for deduplicated blobs"""
+    file_doc = {
+        "id": file_id,
+        "user_id": user_id,
+        "filename": filename,
+        "decoy_filename": decoy_filename,
+        "file_size": real["size"],
+        "decoy_file_size": decoy["size"],
+        "upload_date": datetime.now(timezone.utc)
+    }
+    for variant, blob in (("real", real), ("decoy", decoy)):
+        file_doc[f"{variant}_blob_key"] = blob["blob_key"]
+        file_doc[f"{variant}_encryption_key"] = blob["encryption_key"]
+        # Each blob is compressed (format 3) or not (format 2) on its own; deduplicated
+        # blobs stored before their format was recorded leave it unknown
+        if blob.get("blob_format") is not None:
+            file_doc[f"{variant}_blob_format"] = blob["blob_format"]
+        if "id" in blob:
+            file_doc[f"{variant}_blob_id"] = blob["id"]
+    return file_doc
+
+def file_key(file_doc: dict, variant: str) -> bytes:
+    """Encryption key of a file's real or decoy blob (older files share one key)"""
+    return base64.b64decode(file_doc.get(f"{variant}_encryption_key") or file_doc["encryption_key"])
+
+async def release_blob(file_doc: dict, variant: str):
+    if f"{variant}_blob_id" in file_doc:
+        await blob_dedup.release(file_doc[f"{variant}_blob_id"])
+    else:
+        await blob_store.delete(blob_key(file_doc, variant))
+
+def blob_key(file_doc: dict, variant: str) -> str:
+    """Storage key of a file's real or decoy blob"""
+    if f"{variant}_blob_key" in file_doc:
+        return file_doc[f"{variant}_blob_key"]
+    # Documents from before the blob store recorded absolute paths under UPLOAD_DIR
+    return Path(file_doc[f"{variant}_file_path"]).name
+
+def blob_format(file_doc: dict, variant: str) -> Optional[int]:
+    """Format of a file's real or decoy blob (older files record one for both, the oldest none)"""
+    return file_doc.get(f"{variant}_blob_format", file_doc.get("blob_format"))
+
+def _decrypt_segments(decryptor: SegmentDecryptor, data: bytes) -> bytes:
+    return b"".join(decryptor.feed(data))
+
+def read_blob(key_name: str, blob_size: int, offset: int = 0, length: Optional[int] = None):
+    """Stream a blob's ciphertext, through the segment cache when it is enabled"""
+    if segment_cache.max_bytes:
+        return segment_cache.read(key_name, blob_size, offset, length)
+    return blob_store.get(key_name, offset, length)
+
+@tracing.traced_stream("decrypt_file", lambda key_name, *args: {"blob.key": key_name})
+async def iter_decrypted_blob(key_name: str, blob_size: int, key: bytes):
+    """Yield the plaintext of a stored blob a segment at a time"""
+    chunks = read_blob(key_name, blob_size)
     try:
-        message = Mail(
-            from_email=os.environ['SENDGRID_FROM_EMAIL'],
-            to_emails=email,
-            subject=subject,
-            html_content=content
+        data = await chunks.__anext__()
+    except StopAsyncIteration:
+        data = b""
+    if not is_segmented(data):
+        # Legacy blobs are a single Fernet token and can only be decrypted whole
+        token = data + b"".join([chunk async for chunk in chunks])
+        plaintext = await run_in_threadpool(metrics.timed, "decrypt", len(token), decrypt_file, token, key)
+        for offset in range(0, len(plaintext), SEGMENT_SIZE):
+            yield plaintext[offset:offset + SEGMENT_SIZE]
+        return
+    
+    decryptor = SegmentDecryptor(key)
+    plaintext = await run_in_threadpool(metrics.timed, "decrypt", len(data), _decrypt_segments, decryptor, data)
+    if plaintext:
+        yield plaintext
+    async for data in chunks:
+        plaintext = await run_in_threadpool(metrics.timed, "decrypt", len(data), _decrypt_segments, decryptor, data)
+        if plaintext:
+            yield plaintext
+    plaintext = await run_in_threadpool(metrics.timed, "decrypt", 0, decryptor.close)
+    if plaintext:
+        yield plaintext
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+@tracing.traced_stream("decrypt_range", lambda key_name, *args: {"blob.key": key_name})
+async def iter_decrypted_range(key_name: str, index: SegmentIndex, start: int, end: int):
+    """Yield plaintext bytes start..end (inclusive), decrypting only the segments that cover them"""
+    segment_index, offset, length = index.locate(start, end)
+    position = segment_index * index.segment_size
+    buffer = bytearray()
+    
+    async def segments():
+        n = segment_index
+        async for data in read_blob(key_name, index.blob_size, offset, length):
+            buffer.extend(data)
+            while n < index.segment_count and len(buffer) >= index.stored_size(n):
+                stored_size = index.stored_size(n)
+                segment = bytes(buffer[:stored_size])
+                del buffer[:stored_size]
+                n += 1
+                yield segment
+        if buffer:
+            yield bytes(buffer)
+    
+    async for segment in segments():
+        plaintext = await run_in_threadpool(
+            metrics.timed, "decrypt", len(segment), index.decrypt_segment, segment_index, segment
         )
-        response = sendgrid_client.send(message)
-        logging.info(f"Email sent successfully to {email}, status: {response.status_code}")
+        yield plaintext[max(0, start - position):end - position + 1]
+        position += len(plaintext)
+        segment_index += 1
+
+async def load_segment_index(key_name: str, blob_size: int, key: bytes) -> SegmentIndex:
+    """Index of a format 2 or 3 blob, read from its header (and, for format 3, its trailer)"""
+    header = b"".join([chunk async for chunk in read_blob(key_name, blob_size, 0, HEADER_V3.size)])
+    trailer = b""
+    _, version = PREAMBLE.unpack_from(header)
+    if version == FORMAT_AEAD_COMPRESSED:
+        tail = b"".join([chunk async for chunk in read_blob(key_name, blob_size, blob_size - TRAILER.size, TRAILER.size)])
+        length = min(trailer_length(tail), blob_size)
+        trailer = b"".join([chunk async for chunk in read_blob(key_name, blob_size, blob_size - length, length)])
+    return SegmentIndex(key, header, blob_size, trailer)
+
+async def slice_stream(chunks, start: int, end: int):
+    """Bytes start..end (inclusive) of a plaintext stream that cannot seek"""
+    position = 0
+    async for chunk in chunks:
+        if position + len(chunk) > start and position <= end:
+            yield chunk[max(0, start - position):end - position + 1]
+        position += len(chunk)
+
+def requested_range(request: Optional[Request], etag: str, last_modified: Optional[str], size: Optional[int]):
+    """The single byte range (start, end) to serve, or None to serve the whole file"""
+    if request is None or size is None:
+        return None
+    range_header = request.headers.get("range")
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        # Missing, other units or multiple ranges: send the whole representation
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range not in (etag, last_modified):
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            start, end = (max(0, size - suffix) if suffix else size), size - 1
+    except ValueError:
+        return None
+    if start > end and start < size:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+async def decrypted_file_response(file_doc: dict, variant: str, request: Optional[Request] = None) -> StreamingResponse:
+    """Stream the decrypted real or decoy file (or one byte range of it) without writing plaintext to disk"""
+    filename = file_doc["filename"] if variant == "real" else file_doc["decoy_filename"]
+    size = file_doc.get("file_size") if variant == "real" else file_doc.get("decoy_file_size")
+    key_name = blob_key(file_doc, variant)
+    try:
+        stat = await blob_store.stat(key_name)
+    except BlobNotFound:
+        raise HTTPException(status_code=404, detail="File data not found")
+    
+    key = file_key(file_doc, variant)
+    # Opaque validator: does not reveal whether the real or the decoy file is being served
+    etag = '"' + hashlib.sha256(f"{file_doc['id']}:{variant}:{key_name}".encode() + key).hexdigest()[:32] + '"'
+    upload_date = file_doc.get("upload_date")
+    last_modified = format_datetime(parse_datetime(upload_date).astimezone(timezone.utc), usegmt=True) if upload_date else None
+    headers = {"Content-Disposition": content_disposition(filename), "ETag": etag}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    
+    byte_range = None
+    if size is not None:
+        headers["Accept-Ranges"] = "bytes"
+        byte_range = requested_range(request, etag, last_modified, size)
+    if byte_range is None:
+        if size is not None:
+            headers["Content-Length"] = str(size)
+        body = iter_decrypted_blob(key_name, stat.size, key)
+        status_code = 200
+    else:
+        start, end = byte_range
+        if blob_format(file_doc, variant) in (FORMAT_AEAD, FORMAT_AEAD_COMPRESSED):
+            index = await load_segment_index(key_name, stat.size, key)
+            body = iter_decrypted_range(key_name, index, start, end)
+        else:
+            # Older formats have no segment index: decrypt from the start and skip ahead
+            body = slice_stream(iter_decrypted_blob(key_name, stat.size, key), start, end)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        status_code = 206
+    return StreamingResponse(
+        body,
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+async def share_download_response(file_doc: dict, link_token: str, variant: str, attempt_id: str, request: Request):
+    """Ticket for the verified download; the file itself too unless the client only asked for the ticket"""
+    download_url = f"/api/access/download/{download_tickets.issue(file_doc['id'], link_token, variant, attempt_id)}"
+    if "application/json" in request.headers.get("accept", ""):
+        return {"download_url": download_url, "expires_in": download_tickets.ttl}
+    response = await decrypted_file_response(file_doc, variant)
+    response.headers["Content-Location"] = download_url
+    return response
+
+async def share_link_metadata(share_link: dict) -> dict:
+    """Owner email and file names for a share link, read from the link itself when denormalized"""
+    if all(field in share_link for field in ("owner_email", "filename", "decoy_filename")):
+        return share_link
+    # Links created before the fields were denormalized
+    file_doc = await db.files.find_one({"id": share_link["file_id"]}, {"_id": 0, "user_id": 1, "filename": 1, "decoy_filename": 1})
+    if not file_doc:
+        raise HTTPException(status_code=404, detail="File not found")
+    owner = await db.users.find_one({"id": file_doc["user_id"]}, {"_id": 0, "email": 1})
+    if not owner:
+        raise HTTPException(status_code=404, detail="Owner not found")
+    return {"owner_email": owner["email"], "filename": file_doc["filename"], "decoy_filename": file_doc["decoy_filename"]}
+
+async def send_alert_email(email: str, subject: str, content: str):
+    """Queue an email for the outbox workers; returns whether it was queued"""
+    try:
+        with tracing.span("send_alert_email"):
+            await email_outbox.enqueue(email, subject, content)
         return True
     except Exception as e:
-        logging.error(f"Email failed to {email}: {e}")
+        logging.error(f"Email could not be queued for {email}: {e}")
         return False
 
 def generate_otp() -> str:
@@ -240,22 +578,22 @@ async def register(user_data: UserRegister):
     user_doc = {
         "id": user_id,
         "email": user_data.email,
-        "password_hash": hash_password(user_data.password),
+        "password_hash": await hash_password(user_data.password),
         "name": user_data.name,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.users.insert_one(user_doc)
     
-    token = create_token({"sub": user_id})
+    token = create_token({"sub": user_id, "email": user_data.email, "name": user_data.name})
     return {"token": token, "user": {"id": user_id, "email": user_data.email, "name": user_data.name}}
 
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password_hash"]):
+    if not user or not await verify_password(credentials.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    token = create_token({"sub": user["id"]})
+    token = create_token({"sub": user["id"], "email": user["email"], "name": user["name"]})
     return {"token": token, "user": {"id": user["id"], "email": user["email"], "name": user["name"]}}
 
 @api_router.post("/auth/forgot-password")
@@ -274,9 +612,9 @@ async def forgot_password(request: ForgotPasswordRequest):
     await db.password_reset_otps.insert_one({
         "email": request.email,
         "otp": otp,
-        "expiry": expiry.isoformat(),
+        "expiry": expiry,
         "used": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
     
     # Send OTP email
@@ -288,20 +626,17 @@ async def forgot_password(request: ForgotPasswordRequest):
 @api_router.post("/auth/reset-password")
 async def reset_password(request: ResetPasswordRequest):
     """Verify OTP and reset password"""
-    # Find valid OTP
+    # Find valid, unexpired OTP
     otp_doc = await db.password_reset_otps.find_one({
         "email": request.email,
         "otp": request.otp,
-        "used": False
+        "used": False,
+        "expiry": {"$gt": datetime.now(timezone.utc)}
     })
     
     if not otp_doc:
-        raise HTTPException(status_code=400, detail="Invalid OTP")
-    
-    # Check expiry
-    expiry = datetime.fromisoformat(otp_doc["expiry"])
-    if datetime.now(timezone.utc) > expiry:
-        raise HTTPException(status_code=400, detail="OTP expired")
+        metrics.OTP_FAILURES.labels("password_reset").inc()
+        raise HTTPException(status_code=400, detail="Invalid or expired OTP")
     
     # Update password
     user = await db.users.find_one({"email": request.email})
@@ -310,8 +645,9 @@ async def reset_password(request: ResetPasswordRequest):
     
     await db.users.update_one(
         {"email": request.email},
-        {"$set": {"password_hash": hash_password(request.new_password)}}
+        {"$set": {"password_hash": await hash_password(request.new_password)}}
     )
+    principal_cache.invalidate(user["id"])
     
     # Mark OTP as used
     await db.password_reset_otps.update_one(
@@ -323,7 +659,7 @@ async def reset_password(request: ResetPasswordRequest):
     return {"message": "Password reset successful"}
 
 @api_router.get("/auth/me")
-async def get_me(current_user: dict = Depends(get_current_user)):
+async def get_me(current_user: dict = Depends(get_token_principal)):
     return {"id": current_user["id"], "email": current_user["email"], "name": current_user["name"]}
 
 @api_router.post("/files/upload", response_model=FileUploadResponse)
@@ -333,35 +669,23 @@ async def upload_file(
     current_user: dict = Depends(get_current_user)
 ):
     file_id = str(uuid.uuid4())
-    encryption_key = generate_encryption_key()
-    
-    # Save real file (encrypted)
-    real_content = await real_file.read()
-    encrypted_real = encrypt_file(real_content, encryption_key)
-    real_path = UPLOAD_DIR / f"{file_id}_real.enc"
-    with open(real_path, "wb") as f:
-        f.write(encrypted_real)
-    
-    # Save decoy file (encrypted)
-    decoy_content = await decoy_file.read()
-    encrypted_decoy = encrypt_file(decoy_content, encryption_key)
-    decoy_path = UPLOAD_DIR / f"{file_id}_decoy.enc"
-    with open(decoy_path, "wb") as f:
-        f.write(encrypted_decoy)
+    
+    # Store real and decoy (encrypted segment by segment, once per distinct payload)
+    real = await store_upload(real_file, current_user["id"])
+    try:
+        decoy = await store_upload(decoy_file, current_user["id"])
+    except BaseException:
+        await blob_dedup.release(real["id"])
+        raise
     
     # Store in DB
-    file_doc = {
-        "id": file_id,
-        "user_id": current_user["id"],
-        "filename": real_file.filename,
-        "decoy_filename": decoy_file.filename,
-        "real_file_path": str(real_path),
-        "decoy_file_path": str(decoy_path),
-        "encryption_key": base64.b64encode(encryption_key).decode(),
-        "file_size": len(real_content),
-        "upload_date": datetime.now(timezone.utc).isoformat()
-    }
-    await db.files.insert_one(file_doc)
+    try:
+        await db.files.insert_one(file_document(
+            file_id, current_user["id"], real_file.filename, decoy_file.filename, real, decoy
+        ))
+    except BaseException:
+        await asyncio.gather(blob_dedup.release(real["id"]), blob_dedup.release(decoy["id"]))
+        raise
     
     return FileUploadResponse(
         file_id=file_id,
@@ -369,35 +693,115 @@ async def upload_file(
         message="Files uploaded successfully"
     )
 
+@api_router.post("/uploads")
+async def create_upload_session(request: UploadSessionCreate, current_user: dict = Depends(get_current_user)):
+    """Start a resumable upload; chunks are then PUT to /uploads/{upload_id}/{real|decoy}/{index}"""
+    session = await upload_sessions.create(
+        current_user["id"],
+        {
+            "real": {"filename": request.real_filename, "size": request.real_size},
+            "decoy": {"filename": request.decoy_filename, "size": request.decoy_size}
+        },
+        generate_encryption_key()
+    )
+    return upload_sessions.progress(session)
+
+@api_router.put("/uploads/{upload_id}/{variant}/{index}")
+async def upload_chunk(
+    upload_id: str,
+    variant: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: str = Header(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload one chunk (raw body) with its SHA-256 hex digest; chunks may arrive in any order"""
+    session = await upload_sessions.get(upload_id, current_user["id"])
+    await upload_sessions.put_chunk(session, variant, index, request.stream(), x_chunk_sha256)
+    return {"upload_id": upload_id, "variant": variant, "index": index}
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload_session(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Received and missing chunks, so an interrupted client knows what to resend"""
+    return upload_sessions.progress(await upload_sessions.get(upload_id, current_user["id"]))
+
+@api_router.post("/uploads/{upload_id}/finalize", response_model=FileUploadResponse)
+async def finalize_upload_session(upload_id: str, current_user: dict = Depends(get_current_user)):
+    session = await upload_sessions.begin_finalize(upload_id, current_user["id"])
+    file_id = session["file_id"]
+    files = session["files"]
+    if session["status"] != "finalized":
+        try:
+            real_size = await upload_sessions.assemble(session, "real", f"{file_id}_real.enc")
+            decoy_size = await upload_sessions.assemble(session, "decoy", f"{file_id}_decoy.enc")
+            await db.files.update_one({"id": file_id}, {"$setOnInsert": file_document(
+                file_id, current_user["id"], files["real"]["filename"], files["decoy"]["filename"],
+                # Upload sessions encrypt every chunk as a format 2 segment
+                {"blob_key": f"{file_id}_real.enc", "encryption_key": session["encryption_key"],
+                 "blob_format": FORMAT_AEAD, "size": real_size},
+                {"blob_key": f"{file_id}_decoy.enc", "encryption_key": session["encryption_key"],
+                 "blob_format": FORMAT_AEAD, "size": decoy_size}
+            )}, upsert=True)
+        except BaseException:
+            await upload_sessions.abort_finalize(session)
+            raise
+        await upload_sessions.complete(session)
+    
+    return FileUploadResponse(
+        file_id=file_id,
+        filename=files["real"]["filename"],
+        message="Files uploaded successfully"
+    )
+
+@api_router.delete("/uploads/{upload_id}")
+async def delete_upload_session(upload_id: str, current_user: dict = Depends(get_current_user)):
+    session = await upload_sessions.get(upload_id, current_user["id"])
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail="Upload session is already being finalized")
+    await upload_sessions.discard(session)
+    return {"message": "Upload cancelled"}
+
 @api_router.get("/files")
-async def get_user_files(current_user: dict = Depends(get_current_user)):
-    files = await db.files.find({"user_id": current_user["id"]}, {"_id": 0}).to_list(100)
-    return {"files": files}
+async def get_user_files(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {"user_id": current_user["id"], **date_range_filter("upload_date", since, until)}
+    files, next_cursor = await fetch_page(
+        db.files, query, "upload_date", limit, cursor,
+        {"_id": 0, "id": 1, "user_id": 1, "filename": 1, "decoy_filename": 1,
+         "file_size": 1, "decoy_file_size": 1, "upload_date": 1}
+    )
+    return {"files": files, "next_cursor": next_cursor}
+
+@api_router.delete("/files/{file_id}")
+async def delete_file(file_id: str, current_user: dict = Depends(get_current_user)):
+    """Delete a file, disable its share links and release its stored blobs"""
+    file_doc = await db.files.find_one_and_delete({"id": file_id, "user_id": current_user["id"]})
+    if not file_doc:
+        raise HTTPException(status_code=404, detail="File not found or unauthorized")
+    
+    await db.share_links.update_many({"file_id": file_id}, {"$set": {"is_active": False}})
+    await asyncio.gather(release_blob(file_doc, "real"), release_blob(file_doc, "decoy"))
+    return {"message": "File deleted"}
+
+@api_router.get("/storage/stats")
+async def get_storage_stats(current_user: dict = Depends(get_current_user)):
+    """How much the owner's uploads are deduplicated"""
+    return await blob_dedup.owner_stats(current_user["id"])
 
 @api_router.get("/files/{file_id}/download")
-async def download_own_file(file_id: str, current_user: dict = Depends(get_current_user)):
+async def download_own_file(file_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     """Owner can download their own real file anytime"""
     file_doc = await db.files.find_one({"id": file_id, "user_id": current_user["id"]})
     if not file_doc:
         raise HTTPException(status_code=404, detail="File not found or unauthorized")
     
-    # Decrypt and return real file
-    encryption_key = base64.b64decode(file_doc["encryption_key"])
-    with open(file_doc["real_file_path"], "rb") as f:
-        encrypted_content = f.read()
-    
-    decrypted_content = decrypt_file(encrypted_content, encryption_key)
-    
-    # Save decrypted file temporarily
-    temp_path = UPLOAD_DIR / f"temp_owner_{file_doc['id']}_real.tmp"
-    with open(temp_path, "wb") as f:
-        f.write(decrypted_content)
-    
-    return FileResponse(
-        temp_path,
-        filename=file_doc["filename"],
-        media_type="application/octet-stream"
-    )
+    # Decrypt and stream real file (honouring Range / If-Range)
+    return await decrypted_file_response(file_doc, "real", request)
 
 @api_router.post("/share/create", response_model=ShareLinkResponse)
 async def create_share_link(
@@ -415,13 +819,18 @@ async def create_share_link(
     share_doc = {
         "id": str(uuid.uuid4()),
         "file_id": share_data.file_id,
+        "owner_id": current_user["id"],
+        # Denormalized so the access flow needs no file/owner lookups
+        "owner_email": current_user["email"],
+        "filename": file_doc["filename"],
+        "decoy_filename": file_doc["decoy_filename"],
         "link_token": link_token,
-        "password_hash": hash_password(share_data.password),
-        "expiry_date": expiry_date.isoformat(),
+        "password_hash": await hash_password(share_data.password),
+        "expiry_date": expiry_date,
         "download_limit": share_data.download_limit,
         "downloads_count": 0,
         "is_active": True,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     await db.share_links.insert_one(share_doc)
     
@@ -434,20 +843,22 @@ async def create_share_link(
     )
 
 @api_router.get("/share/links")
-async def get_share_links(current_user: dict = Depends(get_current_user)):
-    # Get all files by user
-    user_files = await db.files.find({"user_id": current_user["id"]}, {"_id": 0, "id": 1, "filename": 1}).to_list(100)
-    file_ids = [f["id"] for f in user_files]
-    
-    # Get share links for those files
-    links = await db.share_links.find({"file_id": {"$in": file_ids}}, {"_id": 0}).to_list(100)
-    
-    # Add filename to each link
-    file_map = {f["id"]: f["filename"] for f in user_files}
-    for link in links:
-        link["filename"] = file_map.get(link["file_id"], "Unknown")
-    
-    return {"links": links}
+async def get_share_links(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    file_id: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {"owner_id": current_user["id"], **date_range_filter("created_at", since, until)}
+    if file_id:
+        query["file_id"] = file_id
+    if is_active is not None:
+        query["is_active"] = is_active
+    pipeline = page_with_filenames_pipeline(query, "created_at", limit, cursor, exclude=["password_hash"])
+    return await page_response(db.share_links.aggregate(pipeline), "links", "created_at", limit)
 
 @api_router.post("/access/file")
 async def access_file(access_data: AccessFileRequest):
@@ -463,8 +874,7 @@ async def request_file_access_otp(request: RequestFileAccessOTP):
         raise HTTPException(status_code=404, detail="Invalid link")
     
     # Check expiry
-    expiry = datetime.fromisoformat(share_link["expiry_date"])
-    if datetime.now(timezone.utc) > expiry:
+    if datetime.now(timezone.utc) > parse_datetime(share_link["expiry_date"]):
         raise HTTPException(status_code=403, detail="Link expired")
     
     # Check if link is active
@@ -472,13 +882,7 @@ async def request_file_access_otp(request: RequestFileAccessOTP):
         raise HTTPException(status_code=403, detail="Link disabled by owner")
     
     # Get file and owner info
-    file_doc = await db.files.find_one({"id": share_link["file_id"]})
-    if not file_doc:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    owner = await db.users.find_one({"id": file_doc["user_id"]})
-    if not owner:
-        raise HTTPException(status_code=404, detail="Owner not found")
+    link_meta = await share_link_metadata(share_link)
     
     # Generate OTP
     otp = generate_otp()
@@ -489,107 +893,107 @@ async def request_file_access_otp(request: RequestFileAccessOTP):
     await db.file_access_otps.insert_one({
         "id": otp_id,
         "link_token": request.link_token,
-        "file_id": file_doc["id"],
+        "file_id": share_link["file_id"],
         "otp": otp,
-        "expiry": expiry_time.isoformat(),
+        "expiry": expiry_time,
         "used": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     })
     
     # Send OTP to owner
-    await send_otp_email(owner["email"], otp, "file_access")
+    owner_email = link_meta["owner_email"]
+    await send_otp_email(owner_email, otp, "file_access")
     
-    logging.info(f"File access OTP requested for file {file_doc['filename']}, sent to {owner['email']}")
+    logging.info(f"File access OTP requested for file {link_meta['filename']}, sent to {owner_email}")
     
     return {
         "message": "OTP sent to file owner",
-        "owner_email_hint": f"{owner['email'][:3]}***@{owner['email'].split('@')[1]}",
+        "owner_email_hint": f"{owner_email[:3]}***@{owner_email.split('@')[1]}",
         "expires_in": 600  # 10 minutes
     }
 
 @api_router.post("/access/verify-otp")
-async def verify_file_access_otp(access_data: VerifyFileAccessOTP):
+async def verify_file_access_otp(access_data: VerifyFileAccessOTP, request: Request):
     """Verify OTP and provide file access"""
     # Get share link
     share_link = await db.share_links.find_one({"link_token": access_data.link_token})
     if not share_link:
         raise HTTPException(status_code=404, detail="Invalid link")
     
-    # Verify OTP
-    otp_doc = await db.file_access_otps.find_one({
-        "link_token": access_data.link_token,
-        "otp": access_data.otp,
-        "used": False
-    })
-    
-    if not otp_doc:
-        raise HTTPException(status_code=400, detail="Invalid OTP")
-    
-    # Check OTP expiry
-    otp_expiry = datetime.fromisoformat(otp_doc["expiry"])
-    if datetime.now(timezone.utc) > otp_expiry:
-        raise HTTPException(status_code=400, detail="OTP expired. Please request a new one")
-    
-    # Check link expiry
-    link_expiry = datetime.fromisoformat(share_link["expiry_date"])
-    if datetime.now(timezone.utc) > link_expiry:
+    # Check the link before spending the OTP on it
+    if datetime.now(timezone.utc) > parse_datetime(share_link["expiry_date"]):
         raise HTTPException(status_code=403, detail="Link expired")
     
-    # Check download limit
     if share_link["downloads_count"] >= share_link["download_limit"]:
         raise HTTPException(status_code=403, detail="Download limit reached")
     
     if not share_link["is_active"]:
         raise HTTPException(status_code=403, detail="Link disabled by owner")
     
-    # Get file
-    file_doc = await db.files.find_one({"id": share_link["file_id"]})
-    if not file_doc:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    # Get owner info
-    owner = await db.users.find_one({"id": file_doc["user_id"]})
+    # Consume the OTP atomically (expired or already used OTPs never match)
+    now = datetime.now(timezone.utc)
+    otp_doc = await db.file_access_otps.find_one_and_update(
+        {
+            "link_token": access_data.link_token,
+            "otp": access_data.otp,
+            "used": False,
+            "expiry": {"$gt": now}
+        },
+        {"$set": {"used": True, "used_at": now}}
+    )
     
-    # Verify password
-    password_correct = verify_password(access_data.password, share_link["password_hash"])
+    if not otp_doc:
+        metrics.OTP_FAILURES.labels("share_access").inc()
+        raise HTTPException(status_code=400, detail="Invalid or expired OTP. Please request a new one")
     
-    # Mark OTP as used
-    await db.file_access_otps.update_one(
-        {"id": otp_doc["id"]},
-        {"$set": {"used": True}}
+    # Verify password while the file document is fetched
+    password_correct, file_doc, link_meta = await asyncio.gather(
+        verify_password(access_data.password, share_link["password_hash"]),
+        db.files.find_one({"id": share_link["file_id"]}),
+        share_link_metadata(share_link)
     )
+    if not file_doc:
+        raise HTTPException(status_code=404, detail="File not found")
     
-    # Log access attempt
-    attempt_id = str(uuid.uuid4())
     attempt_doc = {
-        "id": attempt_id,
+        "id": str(uuid.uuid4()),
         "file_id": file_doc["id"],
+        "owner_id": file_doc["user_id"],
         "link_token": access_data.link_token,
-        "attempted_at": datetime.now(timezone.utc).isoformat(),
+        "attempted_at": now,
         "ip_address": "unknown",
         "password_correct": password_correct,
         "file_type_served": "real" if password_correct else "decoy",
-        "owner_notified": False,
-        "otp_verified": True
+        "owner_notified": True,
+        "otp_verified": True,
+        "outcome": "served"
     }
-    await db.access_attempts.insert_one(attempt_doc)
     
     if password_correct:
-        # Correct password - serve real file
-        await db.share_links.update_one(
-            {"link_token": access_data.link_token},
+        # Correct password - count the download, only if the limit still allows it
+        counted = await db.share_links.find_one_and_update(
+            {
+                "link_token": access_data.link_token,
+                "is_active": True,
+                "$expr": {"$lt": ["$downloads_count", "$download_limit"]}
+            },
             {"$inc": {"downloads_count": 1}}
         )
+        if not counted:
+            # The OTP is spent by now: keep a record of the attempt, since the check above passed
+            # and only a concurrent download (or the owner disabling the link) stopped this one
+            attempt_doc.update(file_type_served="none", owner_notified=False, outcome="limit_reached")
+            await db.access_attempts.insert_one(attempt_doc)
+            raise HTTPException(status_code=403, detail="Download limit reached")
         
         # Alert owner about successful access via email
-        alert_msg = f"✓ File '{file_doc['filename']}' accessed with CORRECT password (OTP verified)"
         email_content = f"""
         <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <div style="background: #10B981; color: white; padding: 20px; border-radius: 8px 8px 0 0;">
                 <h2 style="margin: 0;">✓ Authorized File Access (OTP Verified)</h2>
             </div>
             <div style="background: #f9fafb; padding: 20px; border: 1px solid #e5e7eb; border-radius: 0 0 8px 8px;">
-                <p style="font-size: 16px; color: #111827;">Your file <strong>'{file_doc['filename']}'</strong> was successfully accessed with the correct password after OTP verification.</p>
+                <p style="font-size: 16px; color: #111827;">Your file <strong>'{link_meta['filename']}'</strong> was successfully accessed with the correct password after OTP verification.</p>
                 <div style="background: white; padding: 15px; border-radius: 6px; margin: 15px 0;">
                     <p style="margin: 5px 0; color: #6b7280;"><strong>Time:</strong> {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}</p>
                     <p style="margin: 5px 0; color: #6b7280;"><strong>File Type Served:</strong> Real File</p>
@@ -602,37 +1006,20 @@ async def verify_file_access_otp(access_data: VerifyFileAccessOTP):
         """
         
         # Send email alert
-        email_sent = await send_alert_email(
-            owner["email"],
+        attempt_doc["email_queued"] = await send_alert_email(
+            link_meta["owner_email"],
             "✓ File Access Alert - Authorized Access (OTP Verified)",
             email_content
         )
         
-        # Update log with email status
-        await db.access_attempts.update_one(
-            {"id": attempt_id},
-            {"$set": {"email_sent": email_sent, "owner_notified": True}}
-        )
-        
-        logging.info(f"Authorized access with OTP: file={file_doc['filename']}, email={email_sent}")
-        
-        # Decrypt and return real file
-        encryption_key = base64.b64decode(file_doc["encryption_key"])
-        with open(file_doc["real_file_path"], "rb") as f:
-            encrypted_content = f.read()
+        # Log access attempt
+        await db.access_attempts.insert_one(attempt_doc)
         
-        decrypted_content = decrypt_file(encrypted_content, encryption_key)
+        logging.info(f"Authorized access with OTP: file={link_meta['filename']}, email={attempt_doc['email_queued']}")
         
-        # Save decrypted file temporarily
-        temp_path = UPLOAD_DIR / f"temp_{file_doc['id']}_real_otp.tmp"
-        with open(temp_path, "wb") as f:
-            f.write(decrypted_content)
-        
-        return FileResponse(
-            temp_path,
-            filename=file_doc["filename"],
-            media_type="application/octet-stream"
-        )
+        # Decrypt and stream real file
+        metrics.SHARE_DOWNLOADS.labels("real").inc()
+        return await share_download_response(file_doc, access_data.link_token, "real", attempt_doc["id"], request)
     else:
         # Wrong password - serve decoy file & alert owner via email
         verification_code = generate_otp()
@@ -647,7 +1034,7 @@ async def verify_file_access_otp(access_data: VerifyFileAccessOTP):
                 <p style="font-size: 16px; color: #991B1B; font-weight: bold;">Someone accessed your file with OTP verification but INCORRECT password!</p>
                 
                 <div style="background: white; padding: 20px; border-radius: 6px; margin: 20px 0; border-left: 4px solid #EF4444;">
-                    <p style="margin: 8px 0; color: #374151;"><strong>File:</strong> {file_doc['filename']}</p>
+                    <p style="margin: 8px 0; color: #374151;"><strong>File:</strong> {link_meta['filename']}</p>
                     <p style="margin: 8px 0; color: #374151;"><strong>Time:</strong> {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}</p>
                     <p style="margin: 8px 0; color: #374151;"><strong>Status:</strong> <span style="color: #EF4444; font-weight: bold;">⚠️ INTRUSION (Wrong Password)</span></p>
                     <p style="margin: 8px 0; color: #374151;"><strong>OTP Verification:</strong> <span style="color: #10B981;">Passed ✓</span></p>
@@ -673,231 +1060,55 @@ async def verify_file_access_otp(access_data: VerifyFileAccessOTP):
         """
         
         # Send email alert
-        email_sent = await send_alert_email(
-            owner["email"],
+        attempt_doc["email_queued"] = await send_alert_email(
+            link_meta["owner_email"],
             "🚨 INTRUSION ALERT - Wrong Password Used (OTP Verified)",
             email_content
         )
         
-        # Update attempt with verification code and alert status
-        await db.access_attempts.update_one(
-            {"id": attempt_id},
-            {"$set": {
-                "owner_notified": True,
-                "verification_code": verification_code,
-                "email_sent": email_sent
-            }}
-        )
-        
-        logging.warning(f"INTRUSION with OTP verification: file={file_doc['filename']}, code={verification_code}, email={email_sent}")
+        # Log access attempt with verification code
+        attempt_doc["verification_code"] = verification_code
+        await db.access_attempts.insert_one(attempt_doc)
         
-        # Serve decoy file
-        encryption_key = base64.b64decode(file_doc["encryption_key"])
-        with open(file_doc["decoy_file_path"], "rb") as f:
-            encrypted_content = f.read()
+        logging.warning(f"INTRUSION with OTP verification: file={link_meta['filename']}, code={verification_code}, email={attempt_doc['email_queued']}")
         
-        decrypted_content = decrypt_file(encrypted_content, encryption_key)
-        
-        # Save decrypted decoy file temporarily
-        temp_path = UPLOAD_DIR / f"temp_{file_doc['id']}_decoy_otp.tmp"
-        with open(temp_path, "wb") as f:
-            f.write(decrypted_content)
-        
-        return FileResponse(
-            temp_path,
-            filename=file_doc["decoy_filename"],
-            media_type="application/octet-stream"
-        )
-    # Get share link
-    share_link = await db.share_links.find_one({"link_token": access_data.link_token})
-    if not share_link:
+        # Decrypt and stream decoy file
+        metrics.SHARE_DOWNLOADS.labels("decoy").inc()
+        return await share_download_response(file_doc, access_data.link_token, "decoy", attempt_doc["id"], request)
+
+@api_router.get("/access/download/{ticket}")
+async def download_with_ticket(ticket: str, request: Request):
+    """Stream (a byte range of) a verified share download while its link is still usable"""
+    grant = download_tickets.redeem(ticket)
+    links = await db.share_links.aggregate(redeem_pipeline(grant)).to_list(1)
+    if not links:
         raise HTTPException(status_code=404, detail="Invalid link")
-    
-    # Check expiry
-    expiry = datetime.fromisoformat(share_link["expiry_date"])
-    if datetime.now(timezone.utc) > expiry:
+    share_link = links[0]
+    if datetime.now(timezone.utc) > parse_datetime(share_link["expiry_date"]):
         raise HTTPException(status_code=403, detail="Link expired")
-    
-    # Check download limit
-    if share_link["downloads_count"] >= share_link["download_limit"]:
-        raise HTTPException(status_code=403, detail="Download limit reached")
-    
     if not share_link["is_active"]:
         raise HTTPException(status_code=403, detail="Link disabled by owner")
-    
-    # Get file
-    file_doc = await db.files.find_one({"id": share_link["file_id"]})
-    if not file_doc:
+    if not share_link["file"]:
         raise HTTPException(status_code=404, detail="File not found")
-    
-    # Verify password
-    password_correct = verify_password(access_data.password, share_link["password_hash"])
-    
-    # Log access attempt
-    attempt_id = str(uuid.uuid4())
-    attempt_doc = {
-        "id": attempt_id,
-        "file_id": file_doc["id"],
-        "link_token": access_data.link_token,
-        "attempted_at": datetime.now(timezone.utc).isoformat(),
-        "ip_address": "unknown",
-        "password_correct": password_correct,
-        "file_type_served": "real" if password_correct else "decoy",
-        "owner_notified": False
-    }
-    await db.access_attempts.insert_one(attempt_doc)
-    
-    # Get owner info
-    owner = await db.users.find_one({"id": file_doc["user_id"]})
-    
-    if password_correct:
-        # Correct password - serve real file
-        await db.share_links.update_one(
-            {"link_token": access_data.link_token},
-            {"$inc": {"downloads_count": 1}}
-        )
-        
-        # Alert owner about successful access via email
-        alert_msg = f"✓ File '{file_doc['filename']}' accessed with CORRECT password"
-        email_content = f"""
-        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-            <div style="background: #10B981; color: white; padding: 20px; border-radius: 8px 8px 0 0;">
-                <h2 style="margin: 0;">✓ Authorized File Access</h2>
-            </div>
-            <div style="background: #f9fafb; padding: 20px; border: 1px solid #e5e7eb; border-radius: 0 0 8px 8px;">
-                <p style="font-size: 16px; color: #111827;">Your file <strong>'{file_doc['filename']}'</strong> was successfully accessed with the correct password.</p>
-                <div style="background: white; padding: 15px; border-radius: 6px; margin: 15px 0;">
-                    <p style="margin: 5px 0; color: #6b7280;"><strong>Time:</strong> {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}</p>
-                    <p style="margin: 5px 0; color: #6b7280;"><strong>File Type Served:</strong> Real File</p>
-                    <p style="margin: 5px 0; color: #6b7280;"><strong>Status:</strong> <span style="color: #10B981;">Authorized ✓</span></p>
-                </div>
-                <p style="color: #6b7280; font-size: 14px;">This is a notification for successful file access. No action required.</p>
-            </div>
-        </div>
-        """
-        
-        # Send email alert
-        email_sent = await send_alert_email(
-            owner["email"],
-            "✓ File Access Alert - Authorized Access",
-            email_content
-        )
-        
-        # Log alert status
-        await db.access_attempts.update_one(
-            {"id": attempt_id},
-            {"$set": {"email_sent": email_sent}}
-        )
-        
-        logging.info(f"Authorized access: file={file_doc['filename']}, email={email_sent}")
-        
-        # Decrypt and return real file
-        encryption_key = base64.b64decode(file_doc["encryption_key"])
-        with open(file_doc["real_file_path"], "rb") as f:
-            encrypted_content = f.read()
-        
-        decrypted_content = decrypt_file(encrypted_content, encryption_key)
-        
-        # Save decrypted file temporarily
-        temp_path = UPLOAD_DIR / f"temp_{file_doc['id']}_real.tmp"
-        with open(temp_path, "wb") as f:
-            f.write(decrypted_content)
-        
-        return FileResponse(
-            temp_path,
-            filename=file_doc["filename"],
-            media_type="application/octet-stream"
-        )
-    else:
-        # Wrong password - serve decoy file & alert owner via email
-        verification_code = f"{secrets.randbelow(900000) + 100000}"
-        
-        # Send intrusion alert via email
-        email_content = f"""
-        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-            <div style="background: #EF4444; color: white; padding: 20px; border-radius: 8px 8px 0 0;">
-                <h2 style="margin: 0;">🚨 INTRUSION ALERT - Unauthorized Access Attempt</h2>
-            </div>
-            <div style="background: #fff5f5; padding: 20px; border: 2px solid #FEE2E2; border-radius: 0 0 8px 8px;">
-                <p style="font-size: 16px; color: #991B1B; font-weight: bold;">Someone attempted to access your file with an INCORRECT password!</p>
-                
-                <div style="background: white; padding: 20px; border-radius: 6px; margin: 20px 0; border-left: 4px solid #EF4444;">
-                    <p style="margin: 8px 0; color: #374151;"><strong>File:</strong> {file_doc['filename']}</p>
-                    <p style="margin: 8px 0; color: #374151;"><strong>Time:</strong> {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}</p>
-                    <p style="margin: 8px 0; color: #374151;"><strong>Status:</strong> <span style="color: #EF4444; font-weight: bold;">⚠️ INTRUSION DETECTED</span></p>
-                </div>
-                
-                <div style="background: #FEE2E2; padding: 15px; border-radius: 6px; margin: 20px 0;">
-                    <p style="margin: 0 0 10px 0; color: #991B1B; font-weight: bold;">Verification Code:</p>
-                    <p style="font-family: monospace; font-size: 24px; font-weight: bold; color: #DC2626; margin: 0; letter-spacing: 3px;">{verification_code}</p>
-                </div>
-                
-                <div style="background: #DBEAFE; padding: 15px; border-radius: 6px; border-left: 4px solid #3B82F6;">
-                    <p style="margin: 0; color: #1E40AF; font-size: 14px;"><strong>What happened?</strong> The attacker received a DECOY file (they think they succeeded, but got fake data). Your real file remains secure.</p>
-                </div>
-                
-                <div style="margin-top: 20px; padding-top: 20px; border-top: 1px solid #E5E7EB;">
-                    <p style="color: #6B7280; font-size: 14px; margin: 5px 0;"><strong>Action Required:</strong></p>
-                    <p style="color: #6B7280; font-size: 14px; margin: 5px 0;">• Log in to your SecureShare dashboard</p>
-                    <p style="color: #6B7280; font-size: 14px; margin: 5px 0;">• View Access Logs to see intrusion details</p>
-                    <p style="color: #6B7280; font-size: 14px; margin: 5px 0;">• Block the share link if needed</p>
-                </div>
-            </div>
-        </div>
-        """
-        
-        # Send email alert
-        email_sent = await send_alert_email(
-            owner["email"],
-            "🚨 INTRUSION ALERT - Unauthorized Access to Your File",
-            email_content
-        )
-        
-        # Update attempt with verification code and alert status
-        await db.access_attempts.update_one(
-            {"id": attempt_id},
-            {"$set": {
-                "owner_notified": True,
-                "verification_code": verification_code,
-                "email_sent": email_sent
-            }}
-        )
-        
-        logging.warning(f"INTRUSION DETECTED: file={file_doc['filename']}, code={verification_code}, email={email_sent}")
-        
-        # Serve decoy file (user thinks they got access)
-        encryption_key = base64.b64decode(file_doc["encryption_key"])
-        with open(file_doc["decoy_file_path"], "rb") as f:
-            encrypted_content = f.read()
-        
-        decrypted_content = decrypt_file(encrypted_content, encryption_key)
-        
-        # Save decrypted decoy file temporarily
-        temp_path = UPLOAD_DIR / f"temp_{file_doc['id']}_decoy.tmp"
-        with open(temp_path, "wb") as f:
-            f.write(decrypted_content)
-        
-        return FileResponse(
-            temp_path,
-            filename=file_doc["decoy_filename"],
-            media_type="application/octet-stream"
-        )
+    return await decrypted_file_response(share_link["file"][0], grant["variant"], request)
 
 @api_router.get("/access/attempts")
-async def get_access_attempts(current_user: dict = Depends(get_current_user)):
-    # Get user's files
-    user_files = await db.files.find({"user_id": current_user["id"]}, {"_id": 0, "id": 1, "filename": 1}).to_list(100)
-    file_ids = [f["id"] for f in user_files]
-    
-    # Get attempts for those files
-    attempts = await db.access_attempts.find({"file_id": {"$in": file_ids}}, {"_id": 0}).sort("attempted_at", -1).to_list(100)
-    
-    # Add filename to each attempt
-    file_map = {f["id"]: f["filename"] for f in user_files}
-    for attempt in attempts:
-        attempt["filename"] = file_map.get(attempt["file_id"], "Unknown")
-    
-    return {"attempts": attempts}
+async def get_access_attempts(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    file_id: Optional[str] = None,
+    password_correct: Optional[bool] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {"owner_id": current_user["id"], **date_range_filter("attempted_at", since, until)}
+    if file_id:
+        query["file_id"] = file_id
+    if password_correct is not None:
+        query["password_correct"] = password_correct
+    pipeline = page_with_filenames_pipeline(query, "attempted_at", limit, cursor)
+    return await page_response(db.access_attempts.aggregate(pipeline), "attempts", "attempted_at", limit)
 
 @api_router.post("/owner/action")
 async def owner_action(action_data: OwnerAction, current_user: dict = Depends(get_current_user)):
@@ -924,14 +1135,49 @@ async def owner_action(action_data: OwnerAction, current_user: dict = Depends(ge
 async def root():
     return {"message": "Secure File Sharing API"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/debug/profiles")
+async def list_profiles(x_profile_token: Optional[str] = Header(None)):
+    request_profiler.authorize(x_profile_token)
+    return {"profiles": await run_in_threadpool(request_profiler.list), **request_profiler.stats()}
+
+@app.get("/debug/profiles/{name}")
+async def download_profile(name: str, x_profile_token: Optional[str] = Header(None)):
+    request_profiler.authorize(x_profile_token)
+    return FileResponse(await run_in_threadpool(request_profiler.path, name), filename=name)
+
+@api_router.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "password_hasher": password_hasher.stats(),
+        "email_outbox": email_outbox.stats(),
+        "principal_cache": principal_cache.stats(),
+        "segment_cache": segment_cache.stats(),
+        "dedup": blob_dedup.stats(),
+        "storage_sweeper": storage_sweeper.stats(),
+        "profiler": request_profiler.stats()
+    }
+
 app.include_router(api_router)
 
+app.add_middleware(metrics.MetricsMiddleware)
+
+app.add_middleware(tracing.TracingMiddleware)
+
+if request_profiler.enabled:
+    app.add_middleware(ProfilerMiddleware, profiler=request_profiler)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Content-Disposition", "Content-Range", "Content-Location", "Accept-Ranges", "ETag"],
 )
 
 logging.basicConfig(
@@ -940,6 +1186,69 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    failed = await ensure_indexes(db)
+    if failed:
+        logger.warning(f"Missing indexes: {', '.join(failed)}")
+
+@app.on_event("startup")
+async def start_owner_id_backfill():
+    # The dashboards filter on owner_id, which links and attempts stored before it existed lack
+    async def backfill():
+        try:
+            updated = await backfill_owner_ids(db)
+            if updated:
+                logger.info(f"owner_id backfilled on {updated} share links and access attempts")
+        except Exception as e:
+            logger.error(f"owner_id backfill failed: {e}")
+    app.state.owner_id_backfill = asyncio.create_task(backfill())
+
+@app.on_event("shutdown")
+async def stop_owner_id_backfill():
+    app.state.owner_id_backfill.cancel()
+    await asyncio.gather(app.state.owner_id_backfill, return_exceptions=True)
+
+@app.on_event("startup")
+async def start_email_outbox():
+    email_outbox.start()
+
+@app.on_event("startup")
+async def start_upload_session_sweeper():
+    upload_sessions.start()
+
+@app.on_event("shutdown")
+async def stop_upload_session_sweeper():
+    await upload_sessions.stop()
+
+@app.on_event("startup")
+async def start_storage_sweeper():
+    storage_sweeper.start()
+
+@app.on_event("shutdown")
+async def stop_storage_sweeper():
+    await storage_sweeper.stop()
+
+@app.on_event("startup")
+async def start_event_loop_lag_monitor():
+    event_loop_lag.start()
+
+@app.on_event("shutdown")
+async def stop_event_loop_lag_monitor():
+    await event_loop_lag.stop()
+
+@app.on_event("shutdown")
+async def stop_email_outbox():
+    await email_outbox.stop()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+
+@app.on_event("shutdown")
+async def shutdown_password_hasher():
+    password_hasher.shutdown()
+
+@app.on_event("shutdown")
+async def flush_traces():
+    tracing.shutdown()
\ No newline at end of file
@@ -0,0 +1,284 @@
+"""Background reconciliation of stored blobs against the database.
+
+Every SWEEPER_INTERVAL_SECONDS the sweeper walks the blob store a batch at
+a time and removes what nothing refers to any more:
+
+* blobs of files whose document is gone, or that were superseded (e.g. by
+  a re-encryption that died before deleting them);
+* deduplicated blobs without a db.blobs record;
+* upload session parts whose session is gone;
+* partial writes left behind by a crashed LocalBlobStore.put;
+* plaintext temp_*.tmp files written by older versions of the download
+  paths into UPLOAD_DIR.
+
+Every blob's owner can be read from its key, so each batch is reconciled
+with a few indexed lookups. Only blobs older than SWEEPER_MIN_AGE_SECONDS
+are candidates, so blobs stored just before their document is written are
+never touched. Blobs replaced by the re-encryption job keep their original
+age, so those it lists in db.retired_blobs are left alone until their
+grace period is over. It also marks expired share links inactive.
+
+Deletes are rate limited, and with SWEEPER_DRY_RUN=1 (or --dry-run) it
+only reports what it would remove. One pass can also be run by hand:
+
+    python storage_sweeper.py [--dry-run]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from blob_store import BlobStat, blob_store_from_env
+from reencrypt import Throttle
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path(__file__).parent / "uploads"
+
+# {file_id}_{variant}.enc, or {file_id}_{variant}.{generation}.enc once re-encrypted
+_FILE_BLOB = re.compile(r"^(?P<id>[^/]+)_(?P<variant>real|decoy)(\.[0-9a-f]+)?\.enc$")
+_DEDUP_BLOB = re.compile(r"^cas_(?P<digest>[0-9a-f]{64})\.[0-9a-f]+\.enc$")
+_UPLOAD_PART = re.compile(r"^(?P<id>[^/]+)_(real|decoy)\.\d+(\.[0-9a-f]{32})?\.part$")
+# LocalBlobStore.put writes to .{name}.{uuid}.part before renaming into place
+_PARTIAL_WRITE = re.compile(r"(^|/)\.[^/]+\.[0-9a-f]{32}\.part$")
+
+KINDS = ("orphan_blobs", "orphan_dedup_blobs", "orphan_upload_parts", "partial_writes", "temp_files")
+
+
+def _file_blob_keys(file_doc: dict) -> List[str]:
+    keys = []
+    for variant in ("real", "decoy"):
+        if f"{variant}_blob_key" in file_doc:
+            keys.append(file_doc[f"{variant}_blob_key"])
+        elif f"{variant}_file_path" in file_doc:
+            # Documents from before the blob store recorded absolute paths under UPLOAD_DIR
+            keys.append(Path(file_doc[f"{variant}_file_path"]).name)
+    return keys
+
+
+class StorageSweeper:
+    def __init__(self, db, blob_store, temp_dir: Optional[Path] = None, interval: Optional[float] = None,
+                 batch_size: Optional[int] = None, max_deletes_per_second: Optional[float] = None,
+                 min_age: Optional[timedelta] = None, dry_run: Optional[bool] = None):
+        self.db = db
+        self.blob_store = blob_store
+        self.temp_dir = temp_dir
+        self.interval = interval if interval is not None else float(os.environ.get("SWEEPER_INTERVAL_SECONDS", 3600))
+        self.batch_size = batch_size or int(os.environ.get("SWEEPER_BATCH_SIZE", 500))
+        self.min_age = min_age if min_age is not None else timedelta(
+            seconds=int(os.environ.get("SWEEPER_MIN_AGE_SECONDS", 3600))
+        )
+        self.dry_run = dry_run if dry_run is not None else os.environ.get("SWEEPER_DRY_RUN", "0") == "1"
+        self._throttle = Throttle(
+            max_deletes_per_second if max_deletes_per_second is not None
+            else float(os.environ.get("SWEEPER_MAX_DELETES_PER_SECOND", 50))
+        )
+        self._task: Optional[asyncio.Task] = None
+        self.sweeps = 0
+        self.removed: Dict[str, int] = dict.fromkeys(KINDS, 0)
+        self.bytes_reclaimed = 0
+        self.links_expired = 0
+        self.last_sweep: Optional[dict] = None
+
+    async def sweep(self) -> dict:
+        """One full pass; returns what it removed (or, in dry-run mode, would have removed)"""
+        started = time.monotonic()
+        report = {"removed": dict.fromkeys(KINDS, 0), "bytes_reclaimed": 0, "links_expired": 0, "scanned": 0}
+        cutoff = datetime.now(timezone.utc) - self.min_age
+
+        batch: List[BlobStat] = []
+        async for blob in self.blob_store.list():
+            report["scanned"] += 1
+            if blob.modified <= cutoff:
+                batch.append(blob)
+            if len(batch) >= self.batch_size:
+                await self._sweep_blobs(batch, report)
+                batch = []
+        if batch:
+            await self._sweep_blobs(batch, report)
+        if self.temp_dir is not None:
+            await self._sweep_temp_files(cutoff, report)
+        await self._expire_share_links(report)
+
+        report["duration_seconds"] = round(time.monotonic() - started, 3)
+        report["dry_run"] = self.dry_run
+        report["finished_at"] = datetime.now(timezone.utc)
+        self.sweeps += 1
+        self.last_sweep = report
+        if not self.dry_run:
+            for kind, count in report["removed"].items():
+                self.removed[kind] += count
+            self.bytes_reclaimed += report["bytes_reclaimed"]
+            self.links_expired += report["links_expired"]
+        removed = sum(report["removed"].values())
+        if removed or report["links_expired"]:
+            logger.info(
+                f"Storage sweep{' (dry run)' if self.dry_run else ''}: {removed} blobs, "
+                f"{report['bytes_reclaimed']} bytes, {report['links_expired']} expired links "
+                f"in {report['duration_seconds']}s"
+            )
+        return report
+
+    async def _sweep_blobs(self, blobs: List[BlobStat], report: dict):
+        # Replaced, but downloads that started before may still be streaming them
+        retired = {
+            record["blob_key"]
+            async for record in self.db.retired_blobs.find(
+                {"blob_key": {"$in": [blob.key for blob in blobs]}, "delete_after": {"$gt": datetime.now(timezone.utc)}},
+                {"_id": 0, "blob_key": 1}
+            )
+        }
+        file_blobs, dedup_blobs, parts = {}, {}, {}
+        for blob in blobs:
+            if blob.key in retired:
+                continue
+            if _PARTIAL_WRITE.search(blob.key):
+                await self._remove(blob, "partial_writes", report)
+            elif match := _FILE_BLOB.match(blob.key):
+                file_blobs[blob.key] = (match["id"], blob)
+            elif match := _DEDUP_BLOB.match(blob.key):
+                dedup_blobs[blob.key] = (match["digest"], blob)
+            elif match := _UPLOAD_PART.match(blob.key):
+                parts[blob.key] = (match["id"], blob)
+            # Anything else is not ours to judge
+
+        if file_blobs:
+            file_ids = list({file_id for file_id, _ in file_blobs.values()})
+            referenced = set()
+            async for file_doc in self.db.files.find(
+                {"id": {"$in": file_ids}},
+                {"_id": 0, "real_blob_key": 1, "decoy_blob_key": 1, "real_file_path": 1, "decoy_file_path": 1}
+            ):
+                referenced.update(_file_blob_keys(file_doc))
+            for key, (_, blob) in file_blobs.items():
+                if key not in referenced:
+                    await self._remove(blob, "orphan_blobs", report)
+
+        if dedup_blobs:
+            digests = list({digest for digest, _ in dedup_blobs.values()})
+            referenced = {
+                record["blob_key"]
+                async for record in self.db.blobs.find({"id": {"$in": digests}}, {"_id": 0, "blob_key": 1})
+            }
+            for key, (_, blob) in dedup_blobs.items():
+                if key not in referenced:
+                    await self._remove(blob, "orphan_dedup_blobs", report)
+
+        if parts:
+            session_ids = list({session_id for session_id, _ in parts.values()})
+            live = {
+                session["id"]
+                async for session in self.db.upload_sessions.find({"id": {"$in": session_ids}}, {"_id": 0, "id": 1})
+            }
+            for session_id, blob in parts.values():
+                if session_id not in live:
+                    await self._remove(blob, "orphan_upload_parts", report)
+
+    async def _remove(self, blob: BlobStat, kind: str, report: dict):
+        report["removed"][kind] += 1
+        report["bytes_reclaimed"] += blob.size
+        if self.dry_run:
+            logger.info(f"Would remove {kind}: {blob.key} ({blob.size} bytes)")
+            return
+        await self._throttle.acquire(1)
+        await self.blob_store.delete(blob.key)
+
+    def _temp_files(self, cutoff: datetime) -> List[BlobStat]:
+        temp_files = []
+        for path in self.temp_dir.glob("temp_*.tmp"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            modified = datetime.fromtimestamp(st.st_mtime, timezone.utc)
+            if modified <= cutoff:
+                temp_files.append(BlobStat(str(path), st.st_size, modified))
+        return temp_files
+
+    async def _sweep_temp_files(self, cutoff: datetime, report: dict):
+        for temp_file in await asyncio.to_thread(self._temp_files, cutoff):
+            report["removed"]["temp_files"] += 1
+            report["bytes_reclaimed"] += temp_file.size
+            if self.dry_run:
+                logger.info(f"Would remove temp_files: {temp_file.key} ({temp_file.size} bytes)")
+                continue
+            await self._throttle.acquire(1)
+            await asyncio.to_thread(Path(temp_file.key).unlink, missing_ok=True)
+
+    async def _expire_share_links(self, report: dict):
+        query = {"is_active": True, "expiry_date": {"$lte": datetime.now(timezone.utc)}}
+        if self.dry_run:
+            report["links_expired"] = await self.db.share_links.count_documents(query)
+            return
+        while True:
+            links = await self.db.share_links.find(query, {"_id": 0, "id": 1}).limit(self.batch_size).to_list(self.batch_size)
+            if not links:
+                return
+            result = await self.db.share_links.update_many(
+                {**query, "id": {"$in": [link["id"] for link in links]}}, {"$set": {"is_active": False}}
+            )
+            report["links_expired"] += result.modified_count
+            if len(links) < self.batch_size:
+                return
+
+    def stats(self) -> dict:
+        return {
+            "dry_run": self.dry_run,
+            "sweeps": self.sweeps,
+            "removed": self.removed,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "links_expired": self.links_expired,
+            "last_sweep": self.last_sweep
+        }
+
+    async def _sweeper(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Storage sweeper error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+async def _main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Remove orphaned SecureShare blobs and expire share links")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    parser.add_argument("--min-age", type=int, help="seconds a blob must have existed to be removed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    try:
+        sweeper = StorageSweeper(
+            client[os.environ['DB_NAME']], blob_store_from_env(UPLOAD_DIR), temp_dir=UPLOAD_DIR,
+            min_age=timedelta(seconds=args.min_age) if args.min_age is not None else None,
+            dry_run=args.dry_run or None
+        )
+        print(await sweeper.sweep())
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,203 @@
+"""OpenTelemetry tracing of requests and the work they fan out to.
+
+Off unless TRACE_EXPORTER is set:
+
+* TRACE_EXPORTER=file: finished spans appended as JSON lines to TRACE_FILE
+  (default traces.jsonl next to this module);
+* TRACE_EXPORTER=otlp: spans sent over OTLP/HTTP to the endpoint in the
+  standard OTEL_EXPORTER_OTLP_TRACES_ENDPOINT / OTEL_EXPORTER_OTLP_ENDPOINT
+  variables (default http://localhost:4318).
+
+TRACE_SAMPLE_RATIO (default 0.01) is the share of new traces recorded; a
+request carrying a W3C traceparent header follows its caller's decision.
+Spans of unsampled traces are no-op objects, and spans are exported in
+batches from a background thread.
+
+Each HTTP request gets a server span named after its route template, with
+children for MongoDB commands, password hashing, encryption, decryption,
+blob I/O and queued emails. Tasks started from a request inherit its
+context; emails are sent later by the outbox workers, so the trace context
+is stored with each message and the send continues the request's trace.
+"""
+import functools
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence
+
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from pymongo import monitoring
+
+tracer = trace.get_tracer("secureshare")
+
+_provider: Optional[TracerProvider] = None
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """Appends each finished span to a file as one line of JSON"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        with self._lock, open(self.path, "a") as f:
+            f.write(lines)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def configure() -> Optional[TracerProvider]:
+    """Install the tracer provider selected by TRACE_EXPORTER (None when tracing is off)"""
+    global _provider
+    exporter_name = os.environ.get("TRACE_EXPORTER", "none")
+    if _provider is not None or exporter_name == "none":
+        return _provider
+    if exporter_name == "file":
+        exporter = JsonLinesSpanExporter(os.environ.get("TRACE_FILE", Path(__file__).parent / "traces.jsonl"))
+    elif exporter_name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    else:
+        raise ValueError(f"Unknown TRACE_EXPORTER: {exporter_name}")
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": os.environ.get("OTEL_SERVICE_NAME", "secureshare")}),
+        sampler=ParentBased(TraceIdRatioBased(float(os.environ.get("TRACE_SAMPLE_RATIO", 0.01))))
+    )
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+    return _provider
+
+
+def shutdown():
+    """Export the spans still buffered"""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+@contextmanager
+def span(name: str, attributes: Optional[dict] = None, carrier: Optional[Dict[str, str]] = None,
+         kind: SpanKind = SpanKind.INTERNAL):
+    """A span around the enclosed block, child of the current span (or of the context in carrier)"""
+    context = propagate.extract(carrier) if carrier else None
+    with tracer.start_as_current_span(name, context=context, kind=kind, attributes=attributes) as current:
+        yield current
+
+
+def carrier() -> Dict[str, str]:
+    """The current trace context as W3C headers, for work picked up later by another task"""
+    headers: Dict[str, str] = {}
+    propagate.inject(headers)
+    return headers
+
+
+def _end(current, error: Optional[BaseException] = None):
+    if error is not None:
+        current.record_exception(error)
+        current.set_status(Status(StatusCode.ERROR, str(error)))
+    current.end()
+
+
+def traced_stream(name: str, attributes: Optional[Callable[..., dict]] = None):
+    """Decorator for async generators: one span from the first chunk to the last.
+
+    attributes, if given, is called with the generator's arguments. The span
+    is not made current, since the consumer runs between chunks; spans
+    started while streaming are its siblings.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            current = tracer.start_span(name, attributes=attributes(*args, **kwargs) if attributes else None)
+            error = None
+            try:
+                async for chunk in fn(*args, **kwargs):
+                    yield chunk
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                # Also reached when the consumer stops early (e.g. a client disconnect)
+                _end(current, error)
+        return wrapper
+    return decorator
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a server span per HTTP request.
+
+    The span is named after the route template: paths carry link tokens and
+    download tickets, so the raw path is never recorded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        method = scope["method"]
+        with tracer.start_as_current_span(
+            method, context=propagate.extract(headers), kind=SpanKind.SERVER,
+            attributes={"http.request.method": method}
+        ) as current:
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    current.set_attribute("http.response.status_code", message["status"])
+                    if message["status"] >= 500:
+                        current.set_status(Status(StatusCode.ERROR))
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    current.update_name(f"{method} {route}")
+                    current.set_attribute("http.route", route)
+
+
+class MongoCommandTracing(monitoring.CommandListener):
+    """pymongo listener adding a client span per command to the trace it runs in.
+
+    Motor runs commands with the caller's context, so the current span is
+    the request (or stage) that issued them. Commands outside a recorded
+    trace, such as background polling, are not traced.
+    """
+
+    def __init__(self):
+        self._spans = {}
+
+    def started(self, event):
+        if not trace.get_current_span().is_recording():
+            return
+        collection = event.command.get(event.command_name)
+        self._spans[(event.connection_id, event.request_id)] = tracer.start_span(
+            f"mongo.{event.command_name}", kind=SpanKind.CLIENT, attributes={
+                "db.system": "mongodb",
+                "db.name": event.database_name,
+                "db.operation": event.command_name,
+                "db.mongodb.collection": collection if isinstance(collection, str) else "",
+            }
+        )
+
+    def succeeded(self, event):
+        current = self._spans.pop((event.connection_id, event.request_id), None)
+        if current is not None:
+            _end(current)
+
+    def failed(self, event):
+        current = self._spans.pop((event.connection_id, event.request_id), None)
+        if current is not None:
+            current.set_status(Status(StatusCode.ERROR, str(event.failure.get("errmsg", ""))))
+            current.end()
@@ -0,0 +1,331 @@
+"""Resumable, chunked uploads.
+
+A client creates a session declaring the names and sizes of the real and
+decoy file, PUTs numbered chunks of either file in any order (and in
+parallel), can ask which chunks have landed, and finally asks for the
+session to be finalized into a regular file.
+
+Each chunk is encrypted as soon as it arrives: the session fixes the
+file's key and format 2 header up front, and the chunk size is a multiple
+of the segment size, so every chunk maps onto whole segments and can be
+encrypted on its own. Finalizing only concatenates the stored parts.
+
+Since a segment's nonce is fixed by the header and its index, a chunk can
+only be sent again with the same content (a retry). Different content for
+a chunk already received would be encrypted under the same key and nonce,
+so it is refused: the chunk's checksum is claimed before it is encrypted.
+Each upload of a chunk is stored under its own key and only then recorded
+in the session, so a part being assembled is never overwritten or deleted.
+
+Sessions expire UPLOAD_SESSION_TTL_HOURS after their last chunk; a
+background sweeper deletes the parts of expired sessions.
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from blob_format import SEGMENT_SIZE, SegmentEncryptor
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = ("real", "decoy")
+
+
+def _chunk_count(size: int, chunk_size: int) -> int:
+    # An empty file is still one (empty) chunk
+    return max(1, -(-size // chunk_size))
+
+
+def part_key(session_id: str, variant: str, index: int, token: Optional[str] = None) -> str:
+    if token is None:
+        # Sessions created before each upload of a part got its own key
+        return f"{session_id}_{variant}.{index:08d}.part"
+    return f"{session_id}_{variant}.{index:08d}.{token}.part"
+
+
+def stored_part(session: dict, variant: str, index: int) -> Optional[dict]:
+    """{"sha256", "key"} of a received chunk; without "key" while its upload is still being stored"""
+    part = session.get("parts", {}).get(variant, {}).get(str(index))
+    if isinstance(part, str):
+        return {"sha256": part, "key": part_key(session["id"], variant, index)}
+    return part
+
+
+class UploadSessions:
+    def __init__(self, collection, blob_store, chunk_size: Optional[int] = None, ttl: Optional[timedelta] = None,
+                 finalize_lease: timedelta = timedelta(minutes=10), sweep_interval: float = 300.0):
+        chunk_size = chunk_size or int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+        # Chunks must cover whole segments so they can be encrypted independently
+        self.chunk_size = max(1, chunk_size // SEGMENT_SIZE) * SEGMENT_SIZE
+        self.ttl = ttl or timedelta(hours=int(os.environ.get("UPLOAD_SESSION_TTL_HOURS", 24)))
+        self.finalize_lease = finalize_lease
+        self.sweep_interval = sweep_interval
+        self.collection = collection
+        self.blob_store = blob_store
+        self._task: Optional[asyncio.Task] = None
+
+    async def create(self, user_id: str, files: Dict[str, dict], encryption_key: bytes) -> dict:
+        """files maps "real" and "decoy" to {"filename", "size"}"""
+        now = datetime.now(timezone.utc)
+        session = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "status": "open",
+            "chunk_size": self.chunk_size,
+            "encryption_key": base64.b64encode(encryption_key).decode(),
+            "files": {
+                variant: {
+                    "filename": files[variant]["filename"],
+                    "size": files[variant]["size"],
+                    "chunks": _chunk_count(files[variant]["size"], self.chunk_size),
+                    "header": SegmentEncryptor(encryption_key).header()
+                }
+                for variant in VARIANTS
+            },
+            "parts": {variant: {} for variant in VARIANTS},
+            "created_at": now,
+            "expires_at": now + self.ttl
+        }
+        await self.collection.insert_one(session)
+        return session
+
+    async def get(self, session_id: str, user_id: str) -> dict:
+        session = await self.collection.find_one({"id": session_id, "user_id": user_id}, {"_id": 0})
+        if not session:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        return session
+
+    def _chunk_length(self, session: dict, variant: str, index: int) -> int:
+        file_info = session["files"][variant]
+        if index == file_info["chunks"] - 1:
+            return file_info["size"] - index * session["chunk_size"]
+        return session["chunk_size"]
+
+    @staticmethod
+    def _encrypt_chunk(encryptor: SegmentEncryptor, chunk: bytes, first_segment: int, last_chunk: bool) -> bytes:
+        segment_size = encryptor.segment_size
+        offsets = range(0, len(chunk), segment_size) or [0]
+        return b"".join(
+            encryptor.encrypt_segment(
+                chunk[offset:offset + segment_size], first_segment + n,
+                last_chunk and offset + segment_size >= len(chunk)
+            )
+            for n, offset in enumerate(offsets)
+        )
+
+    async def put_chunk(self, session: dict, variant: str, index: int, body: AsyncIterator[bytes], sha256: str):
+        """Verify, encrypt and store one chunk; a chunk may be sent again, but only with the same content"""
+        if session["status"] != "open":
+            raise HTTPException(status_code=409, detail="Upload session is already being finalized")
+        if variant not in VARIANTS:
+            raise HTTPException(status_code=404, detail="Unknown file variant")
+        file_info = session["files"][variant]
+        if not 0 <= index < file_info["chunks"]:
+            raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {file_info['chunks'] - 1}")
+
+        expected = self._chunk_length(session, variant, index)
+        digest = hashlib.sha256()
+        chunk = bytearray()
+        async for data in body:
+            chunk += data
+            if len(chunk) > expected:
+                raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+            digest.update(data)
+        if len(chunk) != expected:
+            raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+        if digest.hexdigest() != sha256.lower():
+            raise HTTPException(status_code=400, detail="Chunk checksum mismatch")
+        checksum = digest.hexdigest()
+        received = stored_part(session, variant, index)
+        if received is not None and received["sha256"] != checksum:
+            raise HTTPException(status_code=409, detail=f"Chunk {index} was already received with different content")
+        if received is not None and "key" in received:
+            # A retry of a stored chunk would produce the same ciphertext
+            await self.collection.update_one(
+                {"id": session["id"], "status": "open"},
+                {"$set": {"expires_at": datetime.now(timezone.utc) + self.ttl}}
+            )
+            return
+
+        # Claim the chunk's content before encrypting it, so two different uploads never share a nonce
+        field = f"parts.{variant}.{index}"
+        claimed = await self.collection.update_one(
+            {
+                "id": session["id"],
+                "status": "open",
+                "$or": [{field: {"$exists": False}}, {f"{field}.sha256": checksum}]
+            },
+            {"$set": {f"{field}.sha256": checksum, "expires_at": datetime.now(timezone.utc) + self.ttl}}
+        )
+        if not claimed.matched_count:
+            current = await self.collection.find_one({"id": session["id"]}, {"_id": 0, "status": 1})
+            if current is None or current["status"] != "open":
+                raise HTTPException(status_code=409, detail="Upload session is already being finalized")
+            raise HTTPException(status_code=409, detail=f"Chunk {index} was already received with different content")
+
+        encryptor = SegmentEncryptor.from_header(base64.b64decode(session["encryption_key"]), file_info["header"])
+        first_segment = index * (session["chunk_size"] // encryptor.segment_size)
+        ciphertext = await run_in_threadpool(
+            self._encrypt_chunk, encryptor, bytes(chunk), first_segment, index == file_info["chunks"] - 1
+        )
+
+        async def parts():
+            yield ciphertext
+
+        key = part_key(session["id"], variant, index, uuid.uuid4().hex)
+        await self.blob_store.put(key, parts())
+        result = await self.collection.update_one(
+            {"id": session["id"], "status": "open", f"{field}.sha256": checksum, f"{field}.key": {"$exists": False}},
+            {"$set": {f"{field}.key": key}}
+        )
+        if not result.matched_count:
+            # Only ever delete our own upload: the recorded part may be being assembled
+            await self.blob_store.delete(key)
+            current = await self.collection.find_one({"id": session["id"]}, {"_id": 0, "id": 1, field: 1})
+            stored = stored_part(current, variant, index) if current else None
+            if stored is None or stored.get("key") is None or stored["sha256"] != checksum:
+                raise HTTPException(status_code=409, detail="Upload session is already being finalized")
+            # A concurrent retry of the same chunk was recorded first
+
+    @staticmethod
+    def progress(session: dict) -> dict:
+        """Received and missing chunks per file, and how many bytes from the start are complete"""
+        files = {}
+        for variant in VARIANTS:
+            file_info = session["files"][variant]
+            received = sorted(
+                int(index) for index in session["parts"][variant]
+                if "key" in stored_part(session, variant, int(index))
+            )
+            missing = sorted(set(range(file_info["chunks"])) - set(received))
+            contiguous = missing[0] if missing else file_info["chunks"]
+            files[variant] = {
+                "filename": file_info["filename"],
+                "size": file_info["size"],
+                "chunks": file_info["chunks"],
+                "received": received,
+                "missing": missing,
+                "offset": min(file_info["size"], contiguous * session["chunk_size"])
+            }
+        return {
+            "upload_id": session["id"],
+            "status": session["status"],
+            "chunk_size": session["chunk_size"],
+            "expires_at": session["expires_at"],
+            "file_id": session.get("file_id"),
+            "files": files
+        }
+
+    async def begin_finalize(self, session_id: str, user_id: str) -> dict:
+        """Claim the session for finalizing; returns it with a file_id assigned"""
+        now = datetime.now(timezone.utc)
+        session = await self.collection.find_one_and_update(
+            {
+                "id": session_id,
+                "user_id": user_id,
+                "$or": [
+                    {"status": "open"},
+                    # A finalize that died part way through can be retried once its lease lapses
+                    {"status": "finalizing", "finalizing_until": {"$lte": now}}
+                ]
+            },
+            {"$set": {
+                "status": "finalizing",
+                "finalizing_until": now + self.finalize_lease,
+                "expires_at": now + self.ttl
+            }},
+            projection={"_id": 0}
+        )
+        if session is None:
+            session = await self.get(session_id, user_id)
+            if session["status"] == "finalized":
+                return session
+            raise HTTPException(status_code=409, detail="Upload session is already being finalized")
+
+        missing = {variant: files["missing"] for variant, files in self.progress(session)["files"].items()}
+        if any(missing.values()):
+            await self.collection.update_one({"id": session_id}, {"$set": {"status": "open"}})
+            counts = ", ".join(f"{len(indexes)} {variant}" for variant, indexes in missing.items() if indexes)
+            raise HTTPException(status_code=400, detail=f"Upload incomplete: missing {counts} chunks")
+        if "file_id" not in session:
+            session["file_id"] = str(uuid.uuid4())
+            await self.collection.update_one({"id": session_id}, {"$set": {"file_id": session["file_id"]}})
+        return session
+
+    async def assemble(self, session: dict, variant: str, blob_key: str) -> int:
+        """Concatenate the encrypted parts of one file into its final blob"""
+        file_info = session["files"][variant]
+
+        async def blob():
+            yield file_info["header"]
+            for index in range(file_info["chunks"]):
+                async for data in self.blob_store.get(stored_part(session, variant, index)["key"]):
+                    yield data
+
+        await self.blob_store.put(blob_key, blob())
+        return file_info["size"]
+
+    async def abort_finalize(self, session: dict):
+        await self.collection.update_one({"id": session["id"], "status": "finalizing"}, {"$set": {"status": "open"}})
+
+    async def complete(self, session: dict):
+        """Mark the session finalized and drop its parts (the document stays until expiry for retries)"""
+        await self.collection.update_one({"id": session["id"]}, {"$set": {"status": "finalized"}})
+        await self._delete_parts(session)
+
+    async def discard(self, session: dict):
+        await self.collection.delete_one({"id": session["id"]})
+        await self._delete_parts(session)
+
+    async def _delete_parts(self, session: dict):
+        # Uploads that were stored but never recorded are left to the storage sweeper
+        await asyncio.gather(*(
+            self.blob_store.delete(part["key"])
+            for variant in VARIANTS
+            for part in (stored_part(session, variant, int(index)) for index in session["parts"][variant])
+            if "key" in part
+        ))
+
+    async def sweep(self) -> int:
+        """Delete expired sessions and their parts; returns the number removed"""
+        removed = 0
+        expired: List[dict] = await self.collection.find(
+            {"expires_at": {"$lte": datetime.now(timezone.utc)}},
+            {"_id": 0, "id": 1, "status": 1, "parts": 1}
+        ).to_list(100)
+        for session in expired:
+            if session["status"] != "finalized":
+                await self._delete_parts(session)
+            await self.collection.delete_one({"id": session["id"]})
+            removed += 1
+        if removed:
+            logger.info(f"Removed {removed} expired upload sessions")
+        return removed
+
+    async def _sweeper(self):
+        while True:
+            try:
+                while await self.sweep() == 100:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Upload session sweeper error: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
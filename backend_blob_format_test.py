@@ -0,0 +1,185 @@
+"""Round trips through the segmented blob formats in backend/blob_format.py.
+
+Format 3 (AEAD with zstd and a trailer index) is covered in most depth:
+whole-blob and incremental decryption, random access through the
+trailer, and the ways a damaged blob must be rejected.
+
+Run with pytest, or directly: python backend_blob_format_test.py
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_format import (  # noqa: E402
+    FORMAT_AEAD, FORMAT_AEAD_COMPRESSED, FORMAT_SEGMENTED_FERNET, HEADER_V2, HEADER_V3, PREAMBLE, TRAILER,
+    BlobFormatError, CompressedSegmentEncryptor, FernetSegmentEncryptor, SegmentDecryptor, SegmentEncryptor,
+    SegmentIndex, decrypt_blob, new_encryptor, trailer_length,
+)
+
+SEGMENT_SIZE = 1000
+TEXT = b"".join(b"row %d,alice,bob,ok\n" % i for i in range(600))
+
+
+def encrypt(encryptor, plaintext: bytes, segment_size: int = SEGMENT_SIZE) -> bytes:
+    count = max(1, -(-len(plaintext) // segment_size))
+    parts = [encryptor.header()]
+    for index in range(count):
+        chunk = plaintext[index * segment_size:(index + 1) * segment_size]
+        parts.append(encryptor.encrypt_segment(chunk, index, index == count - 1))
+    parts.append(encryptor.trailer())
+    return b"".join(parts)
+
+
+def open_index(blob: bytes, key: bytes) -> SegmentIndex:
+    """Index from the blob's header and trailer, as the server reads them"""
+    _, version = PREAMBLE.unpack_from(blob)
+    trailer = blob[-trailer_length(blob[-TRAILER.size:]):] if version == FORMAT_AEAD_COMPRESSED else b""
+    return SegmentIndex(key, blob[:HEADER_V3.size], len(blob), trailer)
+
+
+def read_range(blob: bytes, index: SegmentIndex, start: int, end: int) -> bytes:
+    first, offset, length = index.locate(start, end)
+    ciphertext = blob[offset:offset + length]
+    plaintext = b""
+    segment = first
+    while ciphertext:
+        size = index.stored_size(segment)
+        plaintext += index.decrypt_segment(segment, ciphertext[:size])
+        ciphertext = ciphertext[size:]
+        segment += 1
+    skip = start - first * index.segment_size
+    return plaintext[skip:skip + end - start + 1]
+
+
+@pytest.fixture
+def key() -> bytes:
+    return Fernet.generate_key()
+
+
+# Text compresses; random bytes do not, so those segments are stored raw
+PAYLOADS = {
+    "text": TEXT,
+    "random": os.urandom(4321),
+    "mixed": TEXT[:2500] + os.urandom(2500) + TEXT[:1200],
+    "exact-segments": TEXT[:3 * SEGMENT_SIZE],
+    "one-byte": b"x",
+    "empty": b"",
+}
+
+
+@pytest.mark.parametrize("name", PAYLOADS)
+def test_v3_round_trip(key, name):
+    plaintext = PAYLOADS[name]
+    blob = encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), plaintext)
+    assert PREAMBLE.unpack_from(blob)[1] == FORMAT_AEAD_COMPRESSED
+    assert decrypt_blob(blob, key) == plaintext
+
+
+@pytest.mark.parametrize("piece", [1, 7, 999, 4096])
+def test_v3_incremental_decryption(key, piece):
+    plaintext = PAYLOADS["mixed"]
+    blob = encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), plaintext)
+    decryptor = SegmentDecryptor(key)
+    out = b""
+    for start in range(0, len(blob), piece):
+        out += b"".join(decryptor.feed(blob[start:start + piece]))
+    assert out + decryptor.close() == plaintext
+
+
+def test_v3_compresses_text(key):
+    blob = encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), TEXT)
+    assert len(blob) < len(TEXT) / 2
+
+
+@pytest.mark.parametrize("name", ["text", "mixed", "exact-segments", "one-byte"])
+def test_v3_trailer_index_ranges(key, name):
+    plaintext = PAYLOADS[name]
+    blob = encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), plaintext)
+    index = open_index(blob, key)
+    assert index.plaintext_size == len(plaintext)
+    assert index.segment_count == max(1, -(-len(plaintext) // SEGMENT_SIZE))
+    size = len(plaintext)
+    for start, end in [(0, size - 1), (0, 0), (size - 1, size - 1), (SEGMENT_SIZE - 1, SEGMENT_SIZE),
+                       (SEGMENT_SIZE, 2 * SEGMENT_SIZE - 1), (size // 3, 2 * size // 3), (size // 2, size + 100)]:
+        if start >= size:
+            continue
+        assert read_range(blob, index, start, end) == plaintext[start:min(end, size - 1) + 1], (start, end)
+
+
+def test_v2_index_ranges(key):
+    plaintext = os.urandom(4321)
+    blob = encrypt(SegmentEncryptor(key, SEGMENT_SIZE), plaintext)
+    index = SegmentIndex(key, blob[:HEADER_V2.size], len(blob))
+    assert index.plaintext_size == len(plaintext)
+    assert read_range(blob, index, 999, 3100) == plaintext[999:3101]
+
+
+def test_v1_blobs_still_decrypt(key):
+    # Written by uploads before format 2
+    plaintext = os.urandom(4321)
+    blob = encrypt(FernetSegmentEncryptor(key, SEGMENT_SIZE), plaintext)
+    assert PREAMBLE.unpack_from(blob)[1] == FORMAT_SEGMENTED_FERNET
+    assert decrypt_blob(blob, key) == plaintext
+    decryptor = SegmentDecryptor(key)
+    out = b"".join(b"".join(decryptor.feed(blob[start:start + 700])) for start in range(0, len(blob), 700))
+    assert out + decryptor.close() == plaintext
+
+
+def test_new_encryptor_picks_format(key):
+    assert isinstance(new_encryptor(key, TEXT, SEGMENT_SIZE), CompressedSegmentEncryptor)
+    encryptor = new_encryptor(key, os.urandom(SEGMENT_SIZE), SEGMENT_SIZE)
+    assert isinstance(encryptor, SegmentEncryptor)
+    assert PREAMBLE.unpack_from(encryptor.header())[1] == FORMAT_AEAD
+
+
+def test_v3_wrong_key(key):
+    blob = encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), TEXT)
+    with pytest.raises(Exception):
+        decrypt_blob(blob, Fernet.generate_key())
+
+
+def test_v3_truncated_blob(key):
+    blob = encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), TEXT)
+    trailer = trailer_length(blob[-TRAILER.size:])
+    # Dropping the trailer or the final segment must not pass for a shorter file
+    for cut in (len(blob) - trailer, len(blob) - trailer - 10):
+        with pytest.raises(BlobFormatError):
+            decrypt_blob(blob[:cut], key)
+
+
+def test_v3_reordered_segments(key):
+    encryptor = CompressedSegmentEncryptor(key, SEGMENT_SIZE)
+    header = encryptor.header()
+    first = encryptor.encrypt_segment(TEXT[:SEGMENT_SIZE], 0, False)
+    second = encryptor.encrypt_segment(TEXT[SEGMENT_SIZE:2 * SEGMENT_SIZE], 1, False)
+    last = encryptor.encrypt_segment(TEXT[2 * SEGMENT_SIZE:2500], 2, True)
+    blob = header + second + first + last + encryptor.trailer()
+    with pytest.raises(BlobFormatError):
+        decrypt_blob(blob, key)
+
+
+def test_v3_corrupt_trailer(key):
+    blob = bytearray(encrypt(CompressedSegmentEncryptor(key, SEGMENT_SIZE), TEXT))
+    trailer = trailer_length(bytes(blob[-TRAILER.size:]))
+    # The stored length of the first segment
+    blob[-trailer] ^= 0x01
+    with pytest.raises(BlobFormatError):
+        open_index(bytes(blob), key)
+
+
+def test_encryptor_rejects_short_middle_segment(key):
+    encryptor = CompressedSegmentEncryptor(key, SEGMENT_SIZE)
+    with pytest.raises(ValueError):
+        encryptor.encrypt_segment(b"short", 0, False)
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
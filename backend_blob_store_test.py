@@ -0,0 +1,183 @@
+"""Contract tests for the blob stores in backend/blob_store.py.
+
+Every test runs against LocalBlobStore in a temporary directory and
+against S3BlobStore on a bucket mocked by moto (skipped when moto is not
+installed), so both behave the same for the code above them.
+
+Run with pytest, or directly: python backend_blob_store_test.py
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_store import BlobNotFound, BlobStore, LocalBlobStore, MeteredBlobStore, S3BlobStore  # noqa: E402
+
+BUCKET = "secureshare-test"
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture(params=["local", "s3"])
+def store(request, tmp_path):
+    if request.param == "local":
+        return LocalBlobStore(tmp_path / "blobs")
+    return S3BlobStore(BUCKET, prefix="blobs/", client=request.getfixturevalue("s3_client"))
+
+
+async def chunked(data: bytes, size: int = MIB):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def put(store, key: str, data: bytes) -> int:
+    return asyncio.run(store.put(key, chunked(data)))
+
+
+def get(store, key: str, offset: int = 0, length=None) -> bytes:
+    async def read():
+        return b"".join([chunk async for chunk in store.get(key, offset, length)])
+    return asyncio.run(read())
+
+
+def test_put_get_stat(store):
+    data = os.urandom(3000)
+    assert put(store, "a.enc", data) == len(data)
+    assert get(store, "a.enc") == data
+    stat = asyncio.run(store.stat("a.enc"))
+    assert stat.key == "a.enc" and stat.size == len(data)
+
+
+def test_get_ranges(store):
+    data = os.urandom(5000)
+    put(store, "a.enc", data)
+    assert get(store, "a.enc", 100, 50) == data[100:150]
+    assert get(store, "a.enc", 4990) == data[4990:]
+    assert get(store, "a.enc", 4990, 100) == data[4990:]
+    assert get(store, "a.enc", 10, 0) == b""
+
+
+def test_empty_blob(store):
+    assert put(store, "empty.enc", b"") == 0
+    assert get(store, "empty.enc") == b""
+    assert asyncio.run(store.stat("empty.enc")).size == 0
+
+
+def test_overwrite_replaces_blob(store):
+    put(store, "a.enc", b"first version")
+    put(store, "a.enc", b"second")
+    assert get(store, "a.enc") == b"second"
+
+
+def test_missing_blob(store):
+    with pytest.raises(BlobNotFound):
+        get(store, "missing.enc")
+    with pytest.raises(BlobNotFound):
+        asyncio.run(store.stat("missing.enc"))
+    # Deleting what is not there is not an error
+    asyncio.run(store.delete("missing.enc"))
+
+
+def test_delete(store):
+    put(store, "a.enc", b"data")
+    asyncio.run(store.delete("a.enc"))
+    with pytest.raises(BlobNotFound):
+        asyncio.run(store.stat("a.enc"))
+
+
+def test_list(store):
+    for key in ("a.enc", "b.enc", "c.enc"):
+        put(store, key, key.encode())
+
+    async def keys():
+        return sorted([(stat.key, stat.size) async for stat in store.list()])
+    assert asyncio.run(keys()) == [("a.enc", 5), ("b.enc", 5), ("c.enc", 5)]
+
+
+def test_s3_multipart_upload(s3_client):
+    store = S3BlobStore(BUCKET, client=s3_client)
+    # The smallest part size S3 accepts, so 11 MiB takes three parts
+    store.PART_SIZE = 5 * MIB
+    data = os.urandom(11 * MIB)
+    assert put(store, "big.enc", data) == len(data)
+    assert get(store, "big.enc") == data
+    assert get(store, "big.enc", 5 * MIB - 10, 20) == data[5 * MIB - 10:5 * MIB + 10]
+    assert not s3_client.list_multipart_uploads(Bucket=BUCKET).get("Uploads")
+
+
+def test_s3_failed_upload_is_aborted(s3_client):
+    store = S3BlobStore(BUCKET, client=s3_client)
+    store.PART_SIZE = 5 * MIB
+
+    async def failing():
+        yield os.urandom(6 * MIB)
+        raise RuntimeError("client went away")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(store.put("big.enc", failing()))
+    assert not s3_client.list_multipart_uploads(Bucket=BUCKET).get("Uploads")
+    with pytest.raises(BlobNotFound):
+        asyncio.run(store.stat("big.enc"))
+
+
+def test_s3_prefix_scopes_keys(s3_client):
+    s3_client.put_object(Bucket=BUCKET, Key="other/x.enc", Body=b"not ours")
+    store = S3BlobStore(BUCKET, prefix="blobs/", client=s3_client)
+    put(store, "a.enc", b"ours")
+    assert s3_client.get_object(Bucket=BUCKET, Key="blobs/a.enc")["Body"].read() == b"ours"
+
+    async def keys():
+        return [stat.key async for stat in store.list()]
+    assert asyncio.run(keys()) == ["a.enc"]
+
+
+def test_s3_list_pages(s3_client, monkeypatch):
+    store = S3BlobStore(BUCKET, client=s3_client)
+    for i in range(5):
+        put(store, f"{i}.enc", b"x")
+    list_objects = s3_client.list_objects_v2
+    monkeypatch.setattr(s3_client, "list_objects_v2", lambda **kwargs: list_objects(MaxKeys=2, **kwargs))
+
+    async def keys():
+        return sorted([stat.key async for stat in store.list()])
+    assert asyncio.run(keys()) == [f"{i}.enc" for i in range(5)]
+
+
+def test_local_rejects_keys_outside_root(tmp_path):
+    store = LocalBlobStore(tmp_path / "blobs")
+    with pytest.raises(ValueError):
+        put(store, "../escape.enc", b"x")
+
+
+def test_incomplete_store_cannot_be_created(tmp_path):
+    class WriteOnlyStore(BlobStore):
+        async def put(self, key, chunks):
+            return 0
+
+    with pytest.raises(TypeError):
+        WriteOnlyStore()
+    # Every shipped backend implements the whole interface
+    MeteredBlobStore(LocalBlobStore(tmp_path))
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Keyset pages behind the owner dashboard (backend/dashboard.py).
+
+Pages are aggregated in an in-memory MongoDB (mongomock-motor); failures
+mid-query are simulated with a cursor that raises after some rows.
+
+Run with pytest, or directly: python backend_dashboard_test.py
+"""
+import asyncio
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import ExecutionTimeout
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from dashboard import page_response, page_with_filenames_pipeline  # noqa: E402
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def db():
+    db = AsyncMongoMockClient(tz_aware=True)["secureshare_test"]
+    run(db.files.insert_one({"id": "file-1", "user_id": "user-1", "filename": "report.pdf"}))
+    run(db.access_attempts.insert_many([
+        {"id": f"attempt-{i:02d}", "owner_id": "user-1", "file_id": "file-1",
+         "attempted_at": START + timedelta(minutes=i)}
+        for i in range(5)
+    ]))
+    return db
+
+
+class FailingCursor:
+    """Yields rows, then fails as a timed-out getMore would"""
+
+    def __init__(self, rows, fail_after: int):
+        self.rows = iter(rows)
+        self.left = fail_after
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.left:
+            raise ExecutionTimeout("operation exceeded time limit")
+        self.left -= 1
+        return next(self.rows)
+
+
+def body(response) -> dict:
+    async def read():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return json.loads(run(read()))
+
+
+def page(db, limit: int, cursor=None) -> dict:
+    pipeline = page_with_filenames_pipeline({"owner_id": "user-1"}, "attempted_at", limit, cursor)
+    return body(run(page_response(db.access_attempts.aggregate(pipeline), "attempts", "attempted_at", limit)))
+
+
+def test_pages_follow_the_cursor(db):
+    first = page(db, 2)
+    assert [row["id"] for row in first["attempts"]] == ["attempt-04", "attempt-03"]
+    assert first["attempts"][0]["filename"] == "report.pdf"
+    second = page(db, 2, first["next_cursor"])
+    assert [row["id"] for row in second["attempts"]] == ["attempt-02", "attempt-01"]
+    last = page(db, 2, second["next_cursor"])
+    assert [row["id"] for row in last["attempts"]] == ["attempt-00"]
+    assert last["next_cursor"] is None
+
+
+def test_empty_page(db):
+    run(db.access_attempts.delete_many({}))
+    assert page(db, 2) == {"attempts": [], "next_cursor": None}
+
+
+def test_query_failing_outright_raises_before_responding():
+    with pytest.raises(ExecutionTimeout):
+        run(page_response(FailingCursor([], 0), "attempts", "attempted_at", 2))
+
+
+def test_query_failing_mid_stream_closes_the_json():
+    rows = [{"id": f"attempt-{i}", "attempted_at": START} for i in range(3)]
+    response = run(page_response(FailingCursor(rows, 2), "attempts", "attempted_at", 5))
+    assert response.status_code == 200
+    # Whatever was sent is still valid JSON, marked incomplete
+    sent = body(response)
+    assert [row["id"] for row in sent["attempts"]] == ["attempt-0", "attempt-1"]
+    assert (sent["next_cursor"], sent["error"]) == (None, "incomplete")
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Reference counting of deduplicated blobs (backend/blob_dedup.py).
+
+db.blobs lives in an in-memory MongoDB (mongomock-motor) with the unique
+index on id that db_indexes.py creates, and blobs in a LocalBlobStore.
+Concurrent acquires and releases are interleaved on one event loop; the
+store callback yields to the loop so uploads of the same payload overlap.
+
+Run with pytest, or directly: python backend_dedup_test.py
+"""
+import asyncio
+import base64
+import sys
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_dedup import BlobDeduplicator  # noqa: E402
+from blob_store import LocalBlobStore  # noqa: E402
+
+PAYLOAD = b"the same file, uploaded again and again"
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalBlobStore(tmp_path / "blobs")
+
+
+@pytest.fixture
+def dedup(store):
+    collection = AsyncMongoMockClient()["secureshare_test"].blobs
+    run(collection.create_index("id", unique=True))
+    return BlobDeduplicator(collection, store, "test secret")
+
+
+def digest_of(dedup, owner_id: str, payload: bytes = PAYLOAD) -> str:
+    hasher = dedup.hasher(owner_id)
+    hasher.update(payload)
+    return hasher.hexdigest()
+
+
+def acquire(dedup, store, owner_id: str, payload: bytes = PAYLOAD):
+    async def put(blob_key: str, key: bytes) -> int:
+        async def chunks():
+            # Let other uploads of the same payload run in between
+            await asyncio.sleep(0)
+            yield Fernet(key).encrypt(payload)
+        return await store.put(blob_key, chunks())
+    return dedup.acquire(owner_id, digest_of(dedup, owner_id, payload), len(payload), Fernet.generate_key, put)
+
+
+def stored_keys(store):
+    async def keys():
+        return sorted([stat.key async for stat in store.list() if not stat.key.startswith(".")])
+    return run(keys())
+
+
+def record(dedup, digest):
+    return run(dedup.collection.find_one({"id": digest}, {"_id": 0}))
+
+
+def test_digest_is_per_owner(dedup):
+    assert digest_of(dedup, "alice") == digest_of(dedup, "alice")
+    assert digest_of(dedup, "alice") != digest_of(dedup, "bob")
+
+
+def test_second_upload_shares_the_blob(dedup, store):
+    first = run(acquire(dedup, store, "alice"))
+    second = run(acquire(dedup, store, "alice"))
+    assert second["blob_key"] == first["blob_key"]
+    assert second["encryption_key"] == first["encryption_key"]
+    assert record(dedup, first["id"])["refcount"] == 2
+    assert stored_keys(store) == [first["blob_key"]]
+    assert (dedup.hits, dedup.misses, dedup.bytes_saved) == (1, 1, len(PAYLOAD))
+
+
+def test_owners_never_share(dedup, store):
+    alice = run(acquire(dedup, store, "alice"))
+    bob = run(acquire(dedup, store, "bob"))
+    assert alice["blob_key"] != bob["blob_key"]
+    assert len(stored_keys(store)) == 2
+
+
+def test_last_release_deletes_the_blob(dedup, store):
+    blob = run(acquire(dedup, store, "alice"))
+    run(acquire(dedup, store, "alice"))
+    run(dedup.release(blob["id"]))
+    assert stored_keys(store) == [blob["blob_key"]]
+    run(dedup.release(blob["id"]))
+    assert stored_keys(store) == []
+    assert record(dedup, blob["id"]) is None
+
+
+def test_concurrent_first_uploads_store_one_blob(dedup, store):
+    async def race():
+        return await asyncio.gather(*(acquire(dedup, store, "alice") for _ in range(8)))
+
+    blobs = run(race())
+    assert len({blob["blob_key"] for blob in blobs}) == 1
+    assert record(dedup, blobs[0]["id"])["refcount"] == 8
+    # The copies stored by the uploads that lost were removed
+    assert stored_keys(store) == [blobs[0]["blob_key"]]
+    key = base64.b64decode(blobs[0]["encryption_key"])
+    assert Fernet(key).decrypt((Path(store.root) / blobs[0]["blob_key"]).read_bytes()) == PAYLOAD
+
+
+def test_concurrent_acquires_and_releases_balance(dedup, store):
+    first = run(acquire(dedup, store, "alice"))
+
+    async def churn():
+        await asyncio.gather(*(acquire(dedup, store, "alice") for _ in range(10)),
+                             *(dedup.release(first["id"]) for _ in range(5)))
+
+    run(churn())
+    # 1 + 10 acquired, 5 released
+    assert record(dedup, first["id"])["refcount"] == 6
+    assert len(stored_keys(store)) == 1
+
+
+def test_release_racing_a_new_upload(dedup, store):
+    """The last release and a fresh upload of the same payload leave exactly one usable blob"""
+    first = run(acquire(dedup, store, "alice"))
+
+    async def race():
+        return await asyncio.gather(dedup.release(first["id"]), acquire(dedup, store, "alice"))
+
+    _, blob = run(race())
+    current = record(dedup, first["id"])
+    assert current["refcount"] == 1
+    assert current["blob_key"] == blob["blob_key"]
+    assert stored_keys(store) == [blob["blob_key"]]
+
+
+def test_record_left_at_zero_is_replaced(dedup, store):
+    """A release that decremented but did not get to delete its record does not block new uploads"""
+    first = run(acquire(dedup, store, "alice"))
+    run(dedup.collection.update_one({"id": first["id"]}, {"$inc": {"refcount": -1}}))
+
+    blob = run(acquire(dedup, store, "alice"))
+    assert blob["blob_key"] != first["blob_key"]
+    assert record(dedup, first["id"])["refcount"] == 1
+    # The stale blob went with its record
+    assert stored_keys(store) == [blob["blob_key"]]
+
+
+def test_owner_stats(dedup, store):
+    for _ in range(3):
+        run(acquire(dedup, store, "alice"))
+    run(acquire(dedup, store, "alice", b"another file"))
+    stats = run(dedup.owner_stats("alice"))
+    assert stats["blobs"] == 2
+    assert stats["references"] == 4
+    assert stats["bytes_saved"] == 2 * len(PAYLOAD)
+    assert run(dedup.owner_stats("bob"))["blobs"] == 0
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Streaming decrypted downloads (iter_decrypted_blob and
+decrypted_file_response in backend/server.py).
+
+server.py is imported with placeholder settings; its database is swapped
+for an in-memory MongoDB (mongomock-motor) and its blob store for a
+LocalBlobStore under a temporary directory. Startup hooks do not run and
+nothing sends email.
+
+Run with pytest, or directly: python backend_download_test.py
+"""
+import asyncio
+import base64
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+for name, value in (("MONGO_URL", "mongodb://localhost:27017"), ("DB_NAME", "secureshare_download_test"),
+                    ("SENDGRID_API_KEY", "unused"), ("SENDGRID_FROM_EMAIL", "test@example.com")):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import server  # noqa: E402
+from blob_format import (  # noqa: E402
+    SEGMENT_SIZE, BlobFormatError, FernetSegmentEncryptor, SegmentEncryptor, new_encryptor
+)
+from blob_store import LocalBlobStore  # noqa: E402
+from segment_cache import SegmentCache  # noqa: E402
+
+USER = {"id": "user-1", "email": "owner@example.com", "name": "Owner"}
+TEXT = b"Quarterly figures, nothing to see here.\n" * 2000
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def segmented(encryptor, plaintext: bytes) -> bytes:
+    count = max(1, -(-len(plaintext) // SEGMENT_SIZE))
+    return encryptor.header() + b"".join(
+        encryptor.encrypt_segment(plaintext[index * SEGMENT_SIZE:(index + 1) * SEGMENT_SIZE], index, index == count - 1)
+        for index in range(count)
+    ) + encryptor.trailer()
+
+
+# Every format a stored blob may be in, by the format recorded for it (None: a whole-file Fernet token)
+WRITERS = {
+    None: lambda key, plaintext: Fernet(key).encrypt(plaintext),
+    1: lambda key, plaintext: segmented(FernetSegmentEncryptor(key), plaintext),
+    2: lambda key, plaintext: segmented(SegmentEncryptor(key), plaintext),
+    3: lambda key, plaintext: segmented(new_encryptor(key, plaintext), plaintext),
+}
+PLAINTEXTS = {None: os.urandom(SEGMENT_SIZE + 10), 1: os.urandom(2 * SEGMENT_SIZE), 2: os.urandom(SEGMENT_SIZE + 1),
+              3: TEXT}
+
+
+@pytest.fixture(params=[0, 64 * 1024 * 1024], ids=["uncached", "cached"])
+def store(request, tmp_path, monkeypatch):
+    store = LocalBlobStore(tmp_path / "blobs")
+    monkeypatch.setattr(server, "db", AsyncMongoMockClient(tz_aware=True)["secureshare_test"])
+    monkeypatch.setattr(server, "blob_store", store)
+    monkeypatch.setattr(server, "segment_cache", SegmentCache(store, max_bytes=request.param, block_size=100_000))
+    # Older versions wrote plaintext temp files here; downloads must not
+    monkeypatch.setattr(server, "UPLOAD_DIR", tmp_path / "uploads")
+    return store
+
+
+@pytest.fixture
+def client(store):
+    server.app.dependency_overrides[server.get_current_user] = lambda: USER
+    yield TestClient(server.app)
+    server.app.dependency_overrides.clear()
+
+
+def add_file(store, file_id: str, blob_format, plaintext: bytes) -> dict:
+    key = Fernet.generate_key()
+    (Path(store.root) / f"{file_id}_real.enc").write_bytes(WRITERS[blob_format](key, plaintext))
+    doc = {"id": file_id, "user_id": USER["id"], "filename": "report.pdf", "file_size": len(plaintext),
+           "real_blob_key": f"{file_id}_real.enc", "real_encryption_key": base64.b64encode(key).decode()}
+    if blob_format is not None:
+        doc["real_blob_format"] = blob_format
+    run(server.db.files.insert_one(dict(doc)))
+    return doc
+
+
+def decrypted(doc: dict) -> bytes:
+    async def collect():
+        blob_size = (await server.blob_store.stat(doc["real_blob_key"])).size
+        key = server.file_key(doc, "real")
+        return b"".join([data async for data in server.iter_decrypted_blob(doc["real_blob_key"], blob_size, key)])
+    return run(collect())
+
+
+@pytest.mark.parametrize("blob_format", WRITERS)
+def test_every_format_decrypts(store, blob_format):
+    doc = add_file(store, "file-1", blob_format, PLAINTEXTS[blob_format])
+    assert decrypted(doc) == PLAINTEXTS[blob_format]
+
+
+@pytest.mark.parametrize("blob_format", WRITERS)
+def test_owner_download_streams_plaintext(client, store, blob_format):
+    add_file(store, "file-1", blob_format, PLAINTEXTS[blob_format])
+    response = client.get("/api/files/file-1/download")
+    assert response.status_code == 200
+    assert response.content == PLAINTEXTS[blob_format]
+    assert response.headers["content-length"] == str(len(PLAINTEXTS[blob_format]))
+    assert 'filename="report.pdf"' in response.headers["content-disposition"]
+    assert not (Path(store.root).parent / "uploads").exists()
+
+
+def test_legacy_document_with_shared_key_and_path(client, store):
+    key = Fernet.generate_key()
+    (Path(store.root) / "file-1_real.enc").write_bytes(Fernet(key).encrypt(b"legacy"))
+    run(server.db.files.insert_one({"id": "file-1", "user_id": USER["id"], "filename": "old.txt",
+                                    "encryption_key": base64.b64encode(key).decode(),
+                                    "real_file_path": "/srv/app/backend/uploads/file-1_real.enc"}))
+    response = client.get("/api/files/file-1/download")
+    assert (response.status_code, response.content) == (200, b"legacy")
+
+
+def test_truncated_blob_never_completes(store):
+    doc = add_file(store, "file-1", 2, PLAINTEXTS[2])
+    path = Path(store.root) / "file-1_real.enc"
+    path.write_bytes(path.read_bytes()[:SEGMENT_SIZE // 2])
+    with pytest.raises(BlobFormatError):
+        decrypted(doc)
+
+
+def test_missing_blob_is_not_found(client, store):
+    add_file(store, "file-1", 2, b"data")
+    (Path(store.root) / "file-1_real.enc").unlink()
+    response = client.get("/api/files/file-1/download")
+    assert response.status_code == 404
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Download tickets (backend/download_tickets.py).
+
+Redemption reads the link and its file in one aggregation; that runs
+against an in-memory MongoDB (mongomock-motor).
+
+Run with pytest, or directly: python backend_download_tickets_test.py
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from download_tickets import DownloadTickets, redeem_pipeline  # noqa: E402
+
+GRANT = {"file_id": "file-1", "link_token": "token-1", "variant": "decoy", "attempt_id": "attempt-1"}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def tickets():
+    return DownloadTickets("test-secret", ttl=60)
+
+
+@pytest.fixture
+def db():
+    db = AsyncMongoMockClient(tz_aware=True)["secureshare_test"]
+    run(db.files.insert_one({
+        "id": "file-1", "filename": "real.pdf", "decoy_filename": "decoy.pdf", "file_size": 10, "decoy_file_size": 20,
+        "real_blob_key": "file-1_real.enc", "decoy_blob_key": "file-1_decoy.enc",
+        "real_encryption_key": "real-key", "decoy_encryption_key": "decoy-key", "decoy_blob_format": 2,
+    }))
+    run(db.share_links.insert_one({"link_token": "token-1", "file_id": "file-1", "is_active": True,
+                                   "expiry_date": "2099-01-01T00:00:00+00:00", "password_hash": "hash"}))
+    return db
+
+
+def redeem(db, grant):
+    return run(db.share_links.aggregate(redeem_pipeline(grant)).to_list(1))
+
+
+def test_issue_and_redeem(tickets):
+    ticket = tickets.issue("file-1", "token-1", "decoy", "attempt-1")
+    assert tickets.redeem(ticket) == GRANT
+    # Encrypted, not just signed: the variant cannot be read off the ticket
+    assert b"decoy" not in ticket.encode()
+
+
+def test_expired_ticket(tickets, monkeypatch):
+    ticket = tickets.issue("file-1", "token-1", "real", "attempt-1")
+    issued = time.time()
+    monkeypatch.setattr("cryptography.fernet.time.time", lambda: issued + tickets.ttl + 5)
+    with pytest.raises(HTTPException) as error:
+        tickets.redeem(ticket)
+    assert error.value.status_code == 404
+
+
+@pytest.mark.parametrize("forge", [
+    lambda ticket: ticket[:-4] + ("AAAA" if not ticket.endswith("AAAA") else "BBBB"),
+    lambda ticket: DownloadTickets("another-secret").issue("file-1", "token-1", "real", "attempt-1"),
+    lambda ticket: "not-a-ticket",
+])
+def test_tampered_ticket(tickets, forge):
+    with pytest.raises(HTTPException) as error:
+        tickets.redeem(forge(tickets.issue("file-1", "token-1", "decoy", "attempt-1")))
+    assert error.value.status_code == 404
+
+
+def test_redeem_reads_link_and_variant_fields(db):
+    [link] = redeem(db, GRANT)
+    assert link == {
+        "is_active": True, "expiry_date": "2099-01-01T00:00:00+00:00",
+        "file": [{"id": "file-1", "decoy_filename": "decoy.pdf", "decoy_file_size": 20,
+                  "decoy_blob_key": "file-1_decoy.enc", "decoy_encryption_key": "decoy-key",
+                  "decoy_blob_format": 2}],
+    }
+
+
+def test_redeem_sees_disabled_link(db):
+    run(db.share_links.update_one({"link_token": "token-1"}, {"$set": {"is_active": False}}))
+    [link] = redeem(db, GRANT)
+    assert link["is_active"] is False
+
+
+def test_redeem_missing_link_or_file(db):
+    assert redeem(db, {**GRANT, "link_token": "token-2"}) == []
+    # A ticket only opens the file its link shares
+    assert redeem(db, {**GRANT, "file_id": "file-2"}) == []
+    run(db.files.delete_one({"id": "file-1"}))
+    [link] = redeem(db, GRANT)
+    assert link["file"] == []
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
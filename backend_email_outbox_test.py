@@ -0,0 +1,225 @@
+"""Email outbox and its circuit breaker (backend/email_outbox.py).
+
+The outbox collection is an in-memory MongoDB (mongomock-motor) and
+messages go to a transport that records them, failing on demand.
+
+Run with pytest, or directly: python backend_email_outbox_test.py
+"""
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import email_outbox  # noqa: E402
+from email_outbox import CircuitBreaker, EmailOutbox, LocalSinkTransport, TransportError  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class FlakyTransport(LocalSinkTransport):
+    """Raises the queued errors, one per send, then sends normally"""
+
+    def __init__(self, *errors: Exception):
+        super().__init__()
+        self.errors = list(errors)
+        self.attempts = 0
+
+    async def send(self, message: dict):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        await super().send(message)
+
+
+@pytest.fixture
+def collection():
+    return AsyncMongoMockClient(tz_aware=True)["secureshare_test"].email_outbox
+
+
+def outbox(collection, transport=None, **kwargs) -> EmailOutbox:
+    return EmailOutbox(collection, transport or LocalSinkTransport(), workers=1, batch_size=10, max_attempts=3,
+                       poll_interval=0.01, **kwargs)
+
+
+def enqueue(box: EmailOutbox, count: int = 1) -> list:
+    async def enqueue_all():
+        return [await box.enqueue(f"user{index}@example.com", "Alert", "<p>hi</p>") for index in range(count)]
+    return run(enqueue_all())
+
+
+def status(collection, message_id: str) -> dict:
+    return run(collection.find_one({"id": message_id}, {"_id": 0}))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The breaker's clock; advance it with clock.append(seconds)"""
+    now = [1000.0]
+    # Only the module's view of time: the event loop keeps the real clock
+    monkeypatch.setattr(email_outbox, "time", SimpleNamespace(monotonic=lambda: sum(now)))
+    return now
+
+
+def test_claim_batch_leases_each_message_once(collection):
+    box = outbox(collection)
+    ids = enqueue(box, 3)
+    first = run(box._claim_batch(2))
+    second = run(box._claim_batch(10))
+    assert {m["id"] for m in first} | {m["id"] for m in second} == set(ids)
+    assert (len(first), len(second)) == (2, 1)
+    assert run(box._claim_batch(10)) == []
+    assert all(status(collection, message_id)["status"] == "sending" for message_id in ids)
+
+
+def test_claim_skips_backed_off_and_reclaims_expired_leases(collection):
+    box = outbox(collection)
+    backed_off, abandoned = enqueue(box, 2)
+    now = datetime.now(timezone.utc)
+    run(collection.update_one({"id": backed_off}, {"$set": {"next_attempt_at": now + timedelta(minutes=1)}}))
+    # Claimed by a worker that died before it finished sending
+    run(collection.update_one({"id": abandoned},
+                              {"$set": {"status": "sending", "locked_until": now - timedelta(seconds=1)}}))
+    assert [m["id"] for m in run(box._claim_batch(10))] == [abandoned]
+
+
+def test_delivered_message_is_marked_sent(collection):
+    box = outbox(collection)
+    [message_id] = enqueue(box)
+    [message] = run(box._claim_batch(1))
+    run(box._deliver(message))
+    doc = status(collection, message_id)
+    assert (doc["status"], doc["attempts"]) == ("sent", 1)
+    assert box.transport.messages == [{"to": "user0@example.com", "subject": "Alert", "html": "<p>hi</p>"}]
+
+
+def test_retryable_failure_backs_off_then_fails_permanently(collection):
+    transport = FlakyTransport(*(TransportError("503") for _ in range(3)))
+    box = outbox(collection, transport, base_delay=10)
+    [message_id] = enqueue(box)
+
+    [message] = run(box._claim_batch(1))
+    started = datetime.now(timezone.utc)
+    run(box._deliver(message))
+    doc = status(collection, message_id)
+    assert (doc["status"], doc["attempts"], doc["last_error"]) == ("pending", 1, "503")
+    assert doc["next_attempt_at"] >= started + timedelta(seconds=8)
+    assert run(box._claim_batch(1)) == []
+
+    for attempt in (2, 3):
+        run(collection.update_one({"id": message_id}, {"$set": {"next_attempt_at": datetime.now(timezone.utc)}}))
+        [message] = run(box._claim_batch(1))
+        run(box._deliver(message))
+    doc = status(collection, message_id)
+    assert (doc["status"], doc["attempts"]) == ("failed", 3)
+    assert (box.retried, box.failed, box.sent) == (2, 1, 0)
+    assert box.breaker.failures == 3
+
+
+def test_rejected_message_fails_without_tripping_breaker(collection):
+    box = outbox(collection, FlakyTransport(TransportError("400", retryable=False)))
+    [message_id] = enqueue(box)
+    [message] = run(box._claim_batch(1))
+    run(box._deliver(message))
+    assert status(collection, message_id)["status"] == "failed"
+    assert (box.retried, box.failed, box.breaker.failures) == (0, 1, 0)
+
+
+def test_workers_send_enqueued_messages(collection):
+    async def scenario():
+        box = outbox(collection, FlakyTransport(TransportError("timeout")), base_delay=0.01)
+        box.start()
+        try:
+            [message_id] = [await box.enqueue("owner@example.com", "Alert", "<p>hi</p>")]
+            for _ in range(200):
+                if (await collection.find_one({"id": message_id}))["status"] == "sent":
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await box.stop()
+        return box, await collection.find_one({"id": message_id})
+
+    box, doc = run(scenario())
+    assert (doc["status"], doc["attempts"]) == ("sent", 2)
+    assert (box.sent, box.retried, box.transport.attempts) == (1, 1, 2)
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(threshold=2, reset_after=30)
+    breaker.record_failure()
+    assert (breaker.state, breaker.allow()) == ("closed", True)
+    breaker.record_failure()
+    assert (breaker.state, breaker.allow()) == ("open", False)
+    clock.append(29)
+    assert breaker.allow() is False
+
+
+def test_breaker_admits_one_half_open_probe(clock):
+    breaker = CircuitBreaker(threshold=1, reset_after=30)
+    breaker.record_failure()
+    clock.append(30)
+    assert breaker.state == "half_open"
+    assert [breaker.allow() for _ in range(3)] == [True, False, False]
+    # Nothing was sent, so the slot goes to the next caller
+    breaker.release_probe()
+    assert [breaker.allow() for _ in range(2)] == [True, False]
+
+
+def test_failed_probe_reopens_and_successful_probe_closes(clock):
+    breaker = CircuitBreaker(threshold=1, reset_after=30)
+    breaker.record_failure()
+    clock.append(30)
+    assert breaker.allow() is True
+    breaker.record_failure()
+    assert (breaker.state, breaker.allow()) == ("open", False)
+
+    clock.append(30)
+    assert breaker.allow() is True
+    breaker.record_success()
+    assert (breaker.state, breaker.failures) == ("closed", 0)
+    assert [breaker.allow() for _ in range(2)] == [True, True]
+
+
+def test_workers_share_one_half_open_probe(collection, clock):
+    async def scenario():
+        box = outbox(collection, FlakyTransport(TransportError("503")), base_delay=0.01)
+        box.workers = 3
+        box.breaker = CircuitBreaker(threshold=1, reset_after=30)
+        box.breaker.record_failure()
+        for index in range(3):
+            await box.enqueue(f"user{index}@example.com", "Alert", "<p>hi</p>")
+        box.start()
+        try:
+            await asyncio.sleep(0.1)
+            attempts = [box.transport.attempts]
+            # The probe fails and reopens the breaker: nothing else may go out
+            clock.append(30)
+            await asyncio.sleep(0.1)
+            attempts.append(box.transport.attempts)
+            # The next probe succeeds and closes it, so the rest follow
+            clock.append(30)
+            for _ in range(200):
+                if box.sent == 3:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await box.stop()
+        return attempts, box
+
+    attempts, box = run(scenario())
+    assert attempts == [0, 1]
+    assert (box.sent, box.transport.attempts, box.breaker.state) == (3, 4, "closed")
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
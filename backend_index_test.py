@@ -0,0 +1,130 @@
+"""Checks that every query the API issues is served by an index.
+
+Needs a reachable MongoDB (MONGO_URL, default mongodb://localhost:27017).
+A throwaway database is created, the index registry from
+backend/db_indexes.py is applied, and each registered query shape and
+aggregation is run through explain() to make sure no plan contains a
+COLLSCAN, including the collection a $lookup joins. CI runs this against
+a mongod service (.github/workflows/index-check.yml) with INDEX_CHECK_REQUIRED
+set, so an unreachable server fails the run instead of skipping it.
+
+Run with pytest, or directly: python backend_index_test.py
+"""
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from db_indexes import _NOW, INDEXES, PIPELINE_SHAPES, QUERY_SHAPES  # noqa: E402
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+
+
+def plan_stages(plan):
+    """Yield every stage name in an explain() plan tree"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from plan_stages(item)
+
+
+def explain_stages(db, collection, query, sort):
+    command = {"find": collection, "filter": query}
+    if sort:
+        command["sort"] = dict(sort)
+    explain = db.command("explain", command, verbosity="queryPlanner")
+    return set(plan_stages(explain["queryPlanner"]["winningPlan"]))
+
+
+def explain_pipeline(db, collection, pipeline):
+    """The aggregation's plan, plus the $lookup stages' own execution statistics"""
+    explain = db.command("explain", {"aggregate": collection, "pipeline": pipeline, "cursor": {}},
+                         verbosity="executionStats")
+    stages = set(plan_stages(explain))
+    lookups = [stage["$lookup"] for stage in explain.get("stages", []) if "$lookup" in stage]
+    return stages, lookups, explain
+
+
+def seed_documents(collection, count):
+    """Documents with distinct values in every uniquely indexed field"""
+    unique_fields = {field for model in INDEXES[collection] if model.document.get("unique")
+                     for field in model.document["key"]}
+    return [{"seed": i, **{field: f"seed-{i}" for field in unique_fields}} for i in range(count)]
+
+
+# Rows the aggregations match, so their $lookup stages actually run
+MATCHED = {
+    "files": [{"id": "file-1", "user_id": "user-1", "filename": "report.pdf", "upload_date": _NOW}],
+    "share_links": [{"id": "link-1", "link_token": "token-1", "owner_id": "user-1", "file_id": "file-1",
+                     "is_active": True, "created_at": _NOW}],
+    "access_attempts": [{"id": "attempt-1", "owner_id": "user-1", "file_id": "file-1",
+                         "password_correct": False, "attempted_at": _NOW}],
+    "blobs": [{"id": "digest-1", "owner_id": "user-1", "refcount": 1}],
+}
+
+
+@pytest.fixture(scope="module")
+def index_db():
+    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        if os.environ.get("INDEX_CHECK_REQUIRED"):
+            pytest.fail(f"MongoDB not reachable at {MONGO_URL}")
+        pytest.skip(f"MongoDB not reachable at {MONGO_URL}")
+    db = client[f"secureshare_index_test_{uuid.uuid4().hex[:8]}"]
+    for collection, models in INDEXES.items():
+        db[collection].create_indexes(models)
+        # A few documents so the planner has something to choose between
+        db[collection].insert_many(seed_documents(collection, 10) + MATCHED.get(collection, []))
+    yield db
+    client.drop_database(db.name)
+    client.close()
+
+
+@pytest.mark.parametrize("collection,query,sort", QUERY_SHAPES,
+                         ids=[f"{c}:{','.join(q)}" for c, q, _ in QUERY_SHAPES])
+def test_query_uses_index(index_db, collection, query, sort):
+    stages = explain_stages(index_db, collection, query, sort)
+    assert "COLLSCAN" not in stages, f"{collection} {query} falls back to a collection scan"
+
+
+@pytest.mark.parametrize("collection,pipeline", PIPELINE_SHAPES,
+                         ids=[f"{collection}-{i}" for i, (collection, _) in enumerate(PIPELINE_SHAPES)])
+def test_pipeline_uses_index(index_db, collection, pipeline):
+    stages, lookups, explain = explain_pipeline(index_db, collection, pipeline)
+    assert "COLLSCAN" not in stages, f"{collection} {pipeline[0]} falls back to a collection scan"
+    for lookup in lookups:
+        # Classic engine: the joined collection's scans are counted per $lookup stage
+        assert not lookup.get("collectionScans"), f"$lookup from {collection} scans {lookup['from']}"
+    for plan in (value for value in _walk(explain) if value.get("stage") == "EQ_LOOKUP"):
+        # Slot-based engine: the join is planned in the winning plan
+        assert plan.get("strategy") == "IndexedLoopJoin", f"$lookup from {collection} uses {plan.get('strategy')}"
+
+
+def _walk(value):
+    """Every dict nested in an explain() document"""
+    if isinstance(value, dict):
+        yield value
+        for item in value.values():
+            yield from _walk(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _walk(item)
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""bcrypt in a process pool (backend/password_pool.py).
+
+Workers are real spawned processes; the recovery tests kill them with
+SIGKILL, as the kernel's OOM killer would.
+
+Run with pytest, or directly: python backend_password_pool_test.py
+"""
+import asyncio
+import os
+import signal
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from password_pool import PasswordHasher, PasswordHasherBusy  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(workers=1, max_pending=2)
+    yield hasher
+    hasher.shutdown()
+
+
+def kill_workers(hasher):
+    for process in list(hasher._executor._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+
+
+def test_hash_and_verify(hasher):
+    async def scenario():
+        hashed = await hasher.hash("correct horse")
+        return hashed, await hasher.verify("correct horse", hashed), await hasher.verify("wrong", hashed)
+
+    hashed, right, wrong = run(scenario())
+    assert hashed.startswith("$2")
+    assert (right, wrong) == (True, False)
+    assert hasher.stats()["completed"] == 3
+
+
+def test_malformed_hash_counts_as_failed(hasher):
+    with pytest.raises(ValueError):
+        run(hasher.verify("password", "not-a-hash"))
+    stats = hasher.stats()
+    assert (stats["completed"], stats["failed"], stats["pending"]) == (0, 1, 0)
+
+
+def test_busy_pool_rejects(hasher):
+    async def flood():
+        return await asyncio.gather(*(hasher.hash("password") for _ in range(3)), return_exceptions=True)
+
+    results = run(flood())
+    assert sum(isinstance(result, PasswordHasherBusy) for result in results) == 1
+    assert hasher.stats()["rejected"] == 1
+
+
+def test_recovers_after_worker_dies(hasher):
+    async def scenario():
+        hashed = await hasher.hash("password")
+        kill_workers(hasher)
+        # Give the pool's manager thread time to notice
+        await asyncio.sleep(0.5)
+        return hashed, await hasher.verify("password", hashed)
+
+    _, verified = run(scenario())
+    assert verified is True
+    assert hasher.stats()["restarts"] == 1
+    assert hasher.stats()["failed"] == 0
+
+
+def test_call_in_flight_when_worker_dies_is_retried(hasher):
+    async def scenario():
+        await hasher.hash("warm up")
+        call = asyncio.ensure_future(hasher.hash("password"))
+        await asyncio.sleep(0.05)
+        kill_workers(hasher)
+        hashed = await call
+        return hashed, await hasher.verify("password", hashed)
+
+    _, verified = run(scenario())
+    assert verified is True
+    assert hasher.stats()["restarts"] == 1
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
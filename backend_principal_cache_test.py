@@ -0,0 +1,131 @@
+"""Authenticated-user cache (backend/principal_cache.py) and its use in
+get_current_user.
+
+server.py is imported with placeholder settings and its database swapped
+for an in-memory MongoDB (mongomock-motor); nothing here sends email.
+
+Run with pytest, or directly: python backend_principal_cache_test.py
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from mongomock_motor import AsyncMongoMockClient
+
+for name, value in (("MONGO_URL", "mongodb://localhost:27017"), ("DB_NAME", "secureshare_principal_test"),
+                    ("SENDGRID_API_KEY", "unused"), ("SENDGRID_FROM_EMAIL", "test@example.com")):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import principal_cache  # noqa: E402
+import server  # noqa: E402
+from principal_cache import PrincipalCache  # noqa: E402
+
+USER = {"id": "user-1", "email": "owner@example.com", "name": "Owner"}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The cache's clock; advance it with clock.append(seconds)"""
+    now = [1000.0]
+    monkeypatch.setattr(principal_cache, "time", SimpleNamespace(monotonic=lambda: sum(now)))
+    return now
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = AsyncMongoMockClient(tz_aware=True)["secureshare_test"]
+    run(db.users.insert_one({**USER, "password_hash": "old-hash"}))
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "principal_cache", PrincipalCache(ttl=60, max_entries=10))
+    return db
+
+
+def current_user(user_id: str = "user-1") -> dict:
+    token = server.create_token({"sub": user_id})
+    return run(server.get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)))
+
+
+def test_hit_and_miss(clock):
+    cache = PrincipalCache(ttl=60, max_entries=10)
+    assert cache.get("user-1") is None
+    cache.put("user-1", USER)
+    assert cache.get("user-1") == USER
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = PrincipalCache(ttl=60, max_entries=10)
+    cache.put("user-1", USER)
+    clock.append(59)
+    assert cache.get("user-1") == USER
+    # Reading an entry does not extend its lifetime
+    clock.append(2)
+    assert cache.get("user-1") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_is_evicted(clock):
+    cache = PrincipalCache(ttl=60, max_entries=2)
+    cache.put("user-1", USER)
+    cache.put("user-2", USER)
+    cache.get("user-1")
+    cache.put("user-3", USER)
+    assert [cache.get(user_id) is not None for user_id in ("user-1", "user-2", "user-3")] == [True, False, True]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate(clock):
+    cache = PrincipalCache(ttl=60, max_entries=10)
+    cache.put("user-1", USER)
+    cache.invalidate("user-1")
+    cache.invalidate("user-2")
+    assert cache.get("user-1") is None
+
+
+def test_current_user_is_read_once(db):
+    assert current_user() == USER
+    run(db.users.update_one({"id": "user-1"}, {"$set": {"name": "Renamed"}}))
+    # Served from the cache until it expires or is invalidated
+    assert current_user() == USER
+    assert server.principal_cache.stats()["hits"] == 1
+
+
+def test_unknown_user_is_not_cached(db):
+    with pytest.raises(HTTPException) as error:
+        current_user("user-2")
+    assert error.value.status_code == 401
+    run(db.users.insert_one({"id": "user-2", "email": "new@example.com", "name": "New"}))
+    assert current_user("user-2")["email"] == "new@example.com"
+
+
+def test_password_reset_invalidates(db, monkeypatch):
+    async def hash_password(password: str) -> str:
+        return f"hash of {password}"
+
+    monkeypatch.setattr(server, "hash_password", hash_password)
+    assert current_user() == USER
+    run(db.users.update_one({"id": "user-1"}, {"$set": {"name": "Renamed"}}))
+    run(db.password_reset_otps.insert_one({
+        "email": USER["email"], "otp": "123456", "used": False,
+        "expiry": datetime.now(timezone.utc) + timedelta(minutes=5)
+    }))
+    run(server.reset_password(server.ResetPasswordRequest(email=USER["email"], otp="123456", new_password="new")))
+    assert current_user()["name"] == "Renamed"
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
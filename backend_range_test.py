@@ -0,0 +1,111 @@
+"""HTTP Range handling of file downloads (requested_range in backend/server.py).
+
+server.py is imported with placeholder settings; nothing here talks to
+MongoDB or sends email.
+
+Run with pytest, or directly: python backend_range_test.py
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+for name, value in (("MONGO_URL", "mongodb://localhost:27017"), ("DB_NAME", "secureshare_range_test"),
+                    ("SENDGRID_API_KEY", "unused"), ("SENDGRID_FROM_EMAIL", "test@example.com")):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from server import requested_range  # noqa: E402
+
+ETAG = '"0123456789abcdef0123456789abcdef"'
+LAST_MODIFIED = "Tue, 01 Sep 2026 10:00:00 GMT"
+SIZE = 1000
+
+
+def request(**headers) -> Request:
+    return Request({
+        "type": "http",
+        "headers": [(name.replace("_", "-").lower().encode(), value.encode()) for name, value in headers.items()]
+    })
+
+
+def byte_range(size: int = SIZE, **headers):
+    return requested_range(request(**headers), ETAG, LAST_MODIFIED, size)
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=999-999", (999, 999)),
+    ("bytes=500-5000", (500, 999)),
+    ("bytes= 10-19", (10, 19)),
+])
+def test_single_range(header, expected):
+    assert byte_range(Range=header) == expected
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("bytes=-100", (900, 999)),
+    ("bytes=-1", (999, 999)),
+    ("bytes=-1000", (0, 999)),
+    # A suffix longer than the file is the whole file
+    ("bytes=-5000", (0, 999)),
+])
+def test_suffix_range(header, expected):
+    assert byte_range(Range=header) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=0-9,20-29", "bytes=0-9, -10", "bytes=-5,0-"])
+def test_multiple_ranges_serve_whole_file(header):
+    assert byte_range(Range=header) is None
+
+
+@pytest.mark.parametrize("header", ["items=0-9", "bytes=abc-", "bytes=5-x", "bytes=-", "bytes=20-10", ""])
+def test_invalid_range_is_ignored(header):
+    assert byte_range(Range=header) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1000-2000", "bytes=-0"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(HTTPException) as error:
+        byte_range(Range=header)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == f"bytes */{SIZE}"
+
+
+def test_empty_file_range_is_unsatisfiable():
+    with pytest.raises(HTTPException) as error:
+        byte_range(size=0, Range="bytes=0-")
+    assert error.value.status_code == 416
+
+
+@pytest.mark.parametrize("validator", [ETAG, LAST_MODIFIED])
+def test_if_range_matches(validator):
+    assert byte_range(Range="bytes=0-9", If_Range=validator) == (0, 9)
+
+
+@pytest.mark.parametrize("validator", ['"another-etag"', "Wed, 02 Sep 2026 10:00:00 GMT", 'W/' + ETAG])
+def test_if_range_mismatch_serves_whole_file(validator):
+    assert byte_range(Range="bytes=0-9", If_Range=validator) is None
+
+
+def test_if_range_mismatch_skips_416():
+    # A stale validator means the client's idea of the size is stale too
+    assert byte_range(Range="bytes=5000-", If_Range='"another-etag"') is None
+
+
+def test_no_range():
+    assert byte_range() is None
+    assert requested_range(None, ETAG, LAST_MODIFIED, SIZE) is None
+    # Without a known size nothing can be ranged
+    assert requested_range(request(Range="bytes=0-9"), ETAG, LAST_MODIFIED, None) is None
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
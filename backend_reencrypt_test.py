@@ -0,0 +1,219 @@
+"""Online bulk re-encryption (backend/reencrypt.py).
+
+The database is an in-memory MongoDB (mongomock-motor) and blobs live in
+a LocalBlobStore under a temporary directory, which the job's worker
+processes open from the environment.
+
+Run with pytest, or directly: python backend_reencrypt_test.py
+"""
+import asyncio
+import base64
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_format import (  # noqa: E402
+    FORMAT_AEAD, FORMAT_AEAD_COMPRESSED, FernetSegmentEncryptor, SegmentEncryptor, decrypt_blob
+)
+from blob_store import LocalBlobStore  # noqa: E402
+from reencrypt import JOB_NAME, ReencryptJob  # noqa: E402
+
+SEGMENT_SIZE = 1000
+CURRENT = (FORMAT_AEAD, FORMAT_AEAD_COMPRESSED)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient(tz_aware=True)["secureshare_test"]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # The re-encryption workers open the store from the environment
+    monkeypatch.setenv("BLOB_STORE", "local")
+    monkeypatch.setenv("BLOB_STORE_PATH", str(tmp_path / "blobs"))
+    return LocalBlobStore(tmp_path / "blobs")
+
+
+def job(db, store, **kwargs) -> ReencryptJob:
+    return ReencryptJob(db, store, 2, grace_period=0, report_interval=60, **kwargs)
+
+
+def segmented(encryptor, plaintext: bytes) -> bytes:
+    count = max(1, -(-len(plaintext) // SEGMENT_SIZE))
+    return encryptor.header() + b"".join(
+        encryptor.encrypt_segment(plaintext[index * SEGMENT_SIZE:(index + 1) * SEGMENT_SIZE], index, index == count - 1)
+        for index in range(count)
+    ) + encryptor.trailer()
+
+
+# Blob writers by the format the file document records; "fernet" is the whole-file format uploads never recorded
+WRITERS = {
+    "fernet": lambda key, plaintext: Fernet(key).encrypt(plaintext),
+    1: lambda key, plaintext: segmented(FernetSegmentEncryptor(key, SEGMENT_SIZE), plaintext),
+    2: lambda key, plaintext: segmented(SegmentEncryptor(key, SEGMENT_SIZE), plaintext),
+}
+
+
+def add_file(db, store, file_id: str, real="fernet", decoy="fernet", legacy_paths=False) -> dict:
+    """A file with one key for both blobs, as uploads used to store them; returns the plaintexts"""
+    key = Fernet.generate_key()
+    plaintexts, doc = {}, {"id": file_id, "encryption_key": base64.b64encode(key).decode()}
+    for variant, writer in (("real", real), ("decoy", decoy)):
+        plaintexts[variant] = os.urandom(2500)
+        name = f"{file_id}_{variant}.enc"
+        (Path(store.root) / name).write_bytes(WRITERS[writer](key, plaintexts[variant]))
+        if legacy_paths:
+            doc[f"{variant}_file_path"] = f"/srv/uploads/{name}"
+        else:
+            doc[f"{variant}_blob_key"] = name
+        if writer != "fernet":
+            doc[f"{variant}_blob_format"] = writer
+    doc.update(file_size=2500, decoy_file_size=2500)
+    run(db.files.insert_one(doc))
+    return plaintexts
+
+
+def stored(store, doc: dict, variant: str) -> bytes:
+    data = (Path(store.root) / doc[f"{variant}_blob_key"]).read_bytes()
+    return decrypt_blob(data, base64.b64decode(doc[f"{variant}_encryption_key"]))
+
+
+def stored_keys(store) -> list:
+    return sorted(path.name for path in Path(store.root).iterdir())
+
+
+def test_legacy_blobs_are_rewritten(db, store):
+    plaintexts = {
+        "file-1": add_file(db, store, "file-1", legacy_paths=True),
+        "file-2": add_file(db, store, "file-2", real=1, decoy="fernet"),
+    }
+    keys = {doc["id"]: doc["encryption_key"] for doc in run(db.files.find().to_list(None))}
+    report = run(job(db, store).run())
+    assert (report["files_done"], report["failed"]) == (2, 0)
+
+    docs = run(db.files.find({}, {"_id": 0}).to_list(None))
+    for doc in docs:
+        for variant in ("real", "decoy"):
+            assert stored(store, doc, variant) == plaintexts[doc["id"]][variant]
+            assert doc[f"{variant}_blob_format"] in CURRENT
+            # Without --rotate-keys each blob keeps the key it had
+            assert doc[f"{variant}_encryption_key"] == keys[doc["id"]]
+        assert not {"encryption_key", "blob_format", "real_file_path", "decoy_file_path"} & set(doc)
+    # The old blobs are gone once the grace period is over
+    assert stored_keys(store) == sorted(doc[f"{variant}_blob_key"] for doc in docs for variant in ("real", "decoy"))
+
+
+def test_current_files_are_left_alone(db, store):
+    add_file(db, store, "file-1", real=2, decoy=2)
+    add_file(db, store, "file-2", real=2, decoy=1)
+    run(db.files.insert_one({"id": "file-3", "blob_format": FORMAT_AEAD, "real_blob_key": "file-3_real.enc"}))
+    run(db.files.insert_one({"id": "file-4", "real_blob_id": "a" * 64, "decoy_blob_id": "b" * 64}))
+    before = {doc["id"]: doc for doc in run(db.files.find().to_list(None))}
+
+    report = run(job(db, store).run())
+    assert (report["files_total"], report["files_done"]) == (1, 1)
+    after = {doc["id"]: doc for doc in run(db.files.find().to_list(None))}
+    assert [file_id for file_id in before if before[file_id] != after[file_id]] == ["file-2"]
+    assert after["file-2"]["decoy_blob_format"] in CURRENT
+
+    # Nothing left to do the second time
+    assert run(job(db, store).run())["files_total"] == 0
+
+
+def test_rotate_keys(db, store):
+    plaintexts = add_file(db, store, "file-1", real=2, decoy=2)
+    old = run(db.files.find_one({"id": "file-1"}))
+    run(job(db, store, rotate_keys=True).run())
+    doc = run(db.files.find_one({"id": "file-1"}))
+    keys = {doc["real_encryption_key"], doc["decoy_encryption_key"], old["encryption_key"]}
+    assert len(keys) == 3
+    assert [stored(store, doc, variant) for variant in ("real", "decoy")] == [plaintexts["real"], plaintexts["decoy"]]
+
+
+def test_rotate_deduplicated_blobs(db, store):
+    blobs = {}
+    for digest in ("a" * 64, "b" * 64):
+        key, plaintext = Fernet.generate_key(), os.urandom(2500)
+        name = f"cas_{digest}.0a1b2c3d.enc"
+        (Path(store.root) / name).write_bytes(WRITERS[2](key, plaintext))
+        run(db.blobs.insert_one({"id": digest, "blob_key": name, "encryption_key": base64.b64encode(key).decode(),
+                                 "size": 2500, "refcount": 2, "blob_format": FORMAT_AEAD}))
+        blobs[digest] = plaintext
+    for file_id in ("file-1", "file-2"):
+        record = {digest: run(db.blobs.find_one({"id": digest})) for digest in blobs}
+        run(db.files.insert_one({"id": file_id, **{
+            f"{variant}_{field}": record[digest][source]
+            for variant, digest in (("real", "a" * 64), ("decoy", "b" * 64))
+            for field, source in (("blob_id", "id"), ("blob_key", "blob_key"), ("encryption_key", "encryption_key"),
+                                  ("blob_format", "blob_format"))
+        }}))
+
+    report = run(job(db, store, rotate_keys=True).run())
+    assert (report["files_done"], report["blobs_done"]) == (0, 2)
+    records = {record["id"]: record for record in run(db.blobs.find().to_list(None))}
+    for doc in run(db.files.find().to_list(None)):
+        for variant, digest in (("real", "a" * 64), ("decoy", "b" * 64)):
+            assert doc[f"{variant}_blob_key"] == records[digest]["blob_key"] != f"cas_{digest}.0a1b2c3d.enc"
+            assert doc[f"{variant}_encryption_key"] == records[digest]["encryption_key"]
+            assert stored(store, doc, variant) == blobs[digest]
+    assert stored_keys(store) == sorted(record["blob_key"] for record in records.values())
+
+
+def test_resumes_after_checkpoint(db, store):
+    for file_id in ("file-1", "file-2", "file-3"):
+        add_file(db, store, file_id)
+    first = run(db.files.find_one({"id": "file-1"}))
+    # As left by a run stopped after the first file
+    run(db.migration_checkpoints.insert_one({"_id": JOB_NAME, "phase": "files", "last_id": first["_id"],
+                                             "finished_at": None}))
+    report = run(job(db, store).run())
+    assert report["files_done"] == 2
+    formats = {doc["id"]: doc.get("real_blob_format") for doc in run(db.files.find().to_list(None))}
+    assert formats["file-1"] is None and formats["file-2"] in CURRENT and formats["file-3"] in CURRENT
+    assert run(db.migration_checkpoints.find_one({"_id": JOB_NAME}))["finished_at"] is not None
+
+    # A finished run is not resumed: the next one starts over and finds file-1
+    assert run(job(db, store).run())["files_done"] == 1
+
+
+def test_file_changed_during_reencryption_keeps_its_blobs(db, store):
+    add_file(db, store, "file-1")
+    stale = run(db.files.find_one({"id": "file-1"}))
+    # Replaced by the owner while the job was reading the old one
+    (Path(store.root) / "file-1_decoy.2.enc").write_bytes(b"new upload")
+    run(db.files.update_one({"id": "file-1"}, {"$set": {"decoy_blob_key": "file-1_decoy.2.enc"}}))
+
+    async def rewrite():
+        reencrypt = job(db, store)
+        reencrypt._executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            return await reencrypt._rewrite(stale), reencrypt._retired
+        finally:
+            reencrypt._executor.shutdown()
+
+    _, retired = run(rewrite())
+    assert retired == []
+    doc = run(db.files.find_one({"id": "file-1"}))
+    assert (doc["real_blob_key"], doc["decoy_blob_key"]) == ("file-1_real.enc", "file-1_decoy.2.enc")
+    # The new blobs were discarded, the old ones kept
+    assert stored_keys(store) == ["file-1_decoy.2.enc", "file-1_decoy.enc", "file-1_real.enc"]
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
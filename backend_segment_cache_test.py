@@ -0,0 +1,152 @@
+"""Single-flight ciphertext block cache (backend/segment_cache.py).
+
+Blobs come from a LocalBlobStore under a temporary directory, wrapped to
+count reads and, when a test needs concurrent readers, to hold them open.
+
+Run with pytest, or directly: python backend_segment_cache_test.py
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_store import LocalBlobStore  # noqa: E402
+from segment_cache import SegmentCache  # noqa: E402
+
+BLOCK_SIZE = 100
+BLOB = os.urandom(350)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class CountingStore(LocalBlobStore):
+    """Counts reads; while `gate` is set to an unset Event, reads wait for it"""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.reads = []
+        self.gate = None
+        self.error = None
+
+    async def get(self, key, offset=0, length=None):
+        self.reads.append((key, offset, length))
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        async for data in super().get(key, offset, length):
+            yield data
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = CountingStore(tmp_path)
+    (tmp_path / "blob.enc").write_bytes(BLOB)
+    return store
+
+
+def read(cache: SegmentCache, offset: int = 0, length=None) -> bytes:
+    async def collect():
+        return b"".join([data async for data in cache.read("blob.enc", len(BLOB), offset, length)])
+    return run(collect())
+
+
+@pytest.mark.parametrize("offset,length", [(0, None), (0, 100), (50, 100), (99, 2), (250, None), (340, 500)])
+def test_reads_match_the_blob(store, offset, length):
+    cache = SegmentCache(store, max_bytes=10_000, block_size=BLOCK_SIZE)
+    expected = BLOB[offset:] if length is None else BLOB[offset:offset + length]
+    assert read(cache, offset, length) == expected
+    # Twice: the second time from the cache
+    assert read(cache, offset, length) == expected
+    assert cache.stats()["misses"] == len(store.reads)
+
+
+def test_blocks_are_read_once(store):
+    cache = SegmentCache(store, max_bytes=10_000, block_size=BLOCK_SIZE)
+    read(cache)
+    read(cache, 120, 50)
+    assert store.reads == [("blob.enc", 0, 100), ("blob.enc", 100, 100), ("blob.enc", 200, 100),
+                           ("blob.enc", 300, 50)]
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["bytes"], stats["blocks"]) == (4, 1, 350, 4)
+
+
+def test_concurrent_readers_share_one_read(store):
+    cache = SegmentCache(store, max_bytes=10_000, block_size=BLOCK_SIZE)
+
+    async def readers():
+        store.gate = asyncio.Event()
+        waiting = [asyncio.ensure_future(cache.block("blob.enc", 0, len(BLOB))) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        store.gate.set()
+        return await asyncio.gather(*waiting)
+
+    assert run(readers()) == [BLOB[:BLOCK_SIZE]] * 5
+    assert len(store.reads) == 1
+    assert (cache.misses, cache.coalesced) == (1, 4)
+
+
+def test_cancelled_reader_does_not_cancel_the_others(store):
+    cache = SegmentCache(store, max_bytes=10_000, block_size=BLOCK_SIZE)
+
+    async def readers():
+        store.gate = asyncio.Event()
+        first = asyncio.ensure_future(cache.block("blob.enc", 0, len(BLOB)))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(cache.block("blob.enc", 0, len(BLOB)))
+        await asyncio.sleep(0.01)
+        # The reader that started the load gives up
+        first.cancel()
+        await asyncio.sleep(0.01)
+        store.gate.set()
+        return await second
+
+    assert run(readers()) == BLOB[:BLOCK_SIZE]
+    assert len(store.reads) == 1
+
+
+def test_failed_read_reaches_every_waiter_and_is_not_cached(store):
+    cache = SegmentCache(store, max_bytes=10_000, block_size=BLOCK_SIZE)
+
+    async def readers():
+        store.gate = asyncio.Event()
+        store.error = OSError("disk went away")
+        waiting = [asyncio.ensure_future(cache.block("blob.enc", 0, len(BLOB))) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        store.gate.set()
+        return await asyncio.gather(*waiting, return_exceptions=True)
+
+    assert all(isinstance(result, OSError) for result in run(readers()))
+    store.gate = store.error = None
+    assert run(cache.block("blob.enc", 0, len(BLOB))) == BLOB[:BLOCK_SIZE]
+    assert len(store.reads) == 2
+
+
+def test_least_recently_used_blocks_are_evicted(store):
+    cache = SegmentCache(store, max_bytes=250, block_size=BLOCK_SIZE)
+    read(cache, 0, 200)
+    read(cache, 0, 50)
+    # Block 2 pushes the cache over 250 bytes; block 1 is the least recently used
+    read(cache, 200, 100)
+    assert set(cache._blocks) == {("blob.enc", 0), ("blob.enc", 2)}
+    assert (cache.size, cache.evictions) == (200, 1)
+
+
+def test_blocks_larger_than_the_cache_are_not_kept(store):
+    cache = SegmentCache(store, max_bytes=50, block_size=BLOCK_SIZE)
+    assert read(cache) == BLOB
+    assert read(cache) == BLOB
+    assert (cache.size, len(store.reads)) == (50, 7)
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
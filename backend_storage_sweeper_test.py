@@ -0,0 +1,199 @@
+"""Storage sweeper reconciliation (backend/storage_sweeper.py).
+
+The database is an in-memory MongoDB (mongomock-motor) and blobs live in
+a LocalBlobStore under a temporary directory. Sweeps run with no minimum
+age, so everything a sweep leaves alone is left alone for a reason.
+
+Run with pytest, or directly: python backend_storage_sweeper_test.py
+"""
+import asyncio
+import base64
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_format import SegmentEncryptor, decrypt_blob  # noqa: E402
+from blob_store import LocalBlobStore  # noqa: E402
+from reencrypt import ReencryptJob  # noqa: E402
+from storage_sweeper import StorageSweeper  # noqa: E402
+
+SEGMENT_SIZE = 1000
+GRACE_PERIOD = 3
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient(tz_aware=True)["secureshare_test"]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # The re-encryption workers open the store from the environment
+    monkeypatch.setenv("BLOB_STORE", "local")
+    monkeypatch.setenv("BLOB_STORE_PATH", str(tmp_path / "blobs"))
+    return LocalBlobStore(tmp_path / "blobs")
+
+
+@pytest.fixture
+def sweeper(db, store):
+    return StorageSweeper(db, store, interval=0, max_deletes_per_second=0, min_age=timedelta(0))
+
+
+def encrypt(key: bytes, plaintext: bytes) -> bytes:
+    encryptor = SegmentEncryptor(key, SEGMENT_SIZE)
+    count = max(1, -(-len(plaintext) // SEGMENT_SIZE))
+    return encryptor.header() + b"".join(
+        encryptor.encrypt_segment(plaintext[index * SEGMENT_SIZE:(index + 1) * SEGMENT_SIZE], index, index == count - 1)
+        for index in range(count)
+    ) + encryptor.trailer()
+
+
+def put(store, key: str, data: bytes = b"ciphertext"):
+    async def chunks():
+        yield data
+    run(store.put(key, chunks()))
+
+
+def stored_keys(store):
+    async def keys():
+        return sorted([stat.key async for stat in store.list()])
+    return run(keys())
+
+
+def add_file(db, store, file_id: str) -> dict:
+    """A file with both blobs stored; returns the plaintexts by variant"""
+    plaintexts, doc = {}, {"id": file_id, "user_id": "user-1", "blob_format": 2}
+    for variant in ("real", "decoy"):
+        key = Fernet.generate_key()
+        plaintexts[variant] = os.urandom(2500)
+        put(store, f"{file_id}_{variant}.enc", encrypt(key, plaintexts[variant]))
+        doc.update({f"{variant}_blob_key": f"{file_id}_{variant}.enc",
+                    f"{variant}_encryption_key": base64.b64encode(key).decode()})
+    doc.update(file_size=2500, decoy_file_size=2500)
+    run(db.files.insert_one(doc))
+    return plaintexts
+
+
+def test_sweep_during_reencryption_grace_period(db, store, sweeper):
+    plaintexts = add_file(db, store, "file-1")
+    old_blobs = ["file-1_decoy.enc", "file-1_real.enc"]
+
+    async def reencrypt_and_sweep():
+        job = ReencryptJob(db, store, 1, rotate_keys=True, grace_period=GRACE_PERIOD, report_interval=60)
+        task = asyncio.ensure_future(job.run())
+        for _ in range(600):
+            doc = await db.files.find_one({"id": "file-1"})
+            if doc["real_blob_key"] != "file-1_real.enc" or task.done():
+                break
+            await asyncio.sleep(0.05)
+        assert not task.done(), "the job finished before the sweep could run in its grace period"
+        # Swapped in, so the old blobs are unreferenced but may still be streaming
+        report = await sweeper.sweep()
+        left = sorted([stat.key async for stat in store.list()])
+        await task
+        return report, left
+
+    report, left = run(reencrypt_and_sweep())
+    assert report["removed"]["orphan_blobs"] == 0
+    assert set(old_blobs) <= set(left)
+
+    # The job itself removes them once the grace period is over
+    doc = run(db.files.find_one({"id": "file-1"}))
+    assert stored_keys(store) == sorted([doc["decoy_blob_key"], doc["real_blob_key"]])
+    for variant in ("real", "decoy"):
+        data = (Path(store.root) / doc[f"{variant}_blob_key"]).read_bytes()
+        assert decrypt_blob(data, base64.b64decode(doc[f"{variant}_encryption_key"])) == plaintexts[variant]
+
+
+def test_expired_hold_does_not_protect(db, store, sweeper):
+    # Left behind by a re-encryption job that died during its grace period
+    put(store, "file-1_real.enc")
+    put(store, "file-2_real.enc")
+    now = datetime.now(timezone.utc)
+    run(db.retired_blobs.insert_many([
+        {"blob_key": "file-1_real.enc", "delete_after": now - timedelta(seconds=1)},
+        {"blob_key": "file-2_real.enc", "delete_after": now + timedelta(minutes=5)},
+    ]))
+    report = run(sweeper.sweep())
+    assert report["removed"]["orphan_blobs"] == 1
+    assert stored_keys(store) == ["file-2_real.enc"]
+
+
+def test_orphans_are_classified(db, store, sweeper):
+    add_file(db, store, "file-1")
+    run(db.files.insert_one({"id": "file-2", "real_file_path": "/srv/uploads/file-2_real.enc"}))
+    run(db.blobs.insert_one({"id": "a" * 64, "blob_key": f"cas_{'a' * 64}.0a1b.enc", "refcount": 1}))
+    run(db.upload_sessions.insert_one({"id": "session-1"}))
+    kept = [
+        "file-1_real.enc", "file-1_decoy.enc", "file-2_real.enc", f"cas_{'a' * 64}.0a1b.enc",
+        "session-1_real.0.part", f"session-1_decoy.3.{'c' * 32}.part", "README", "other/file-1_real.txt",
+    ]
+    removed = {
+        "orphan_blobs": ["file-1_real.0f1e.enc", "file-3_decoy.enc"],
+        "orphan_dedup_blobs": [f"cas_{'a' * 64}.ffff.enc", f"cas_{'b' * 64}.0a1b.enc"],
+        "orphan_upload_parts": ["session-2_real.0.part"],
+        "partial_writes": [f".file-1_real.enc.{'d' * 32}.part", f"nested/.blob.{'e' * 32}.part"],
+    }
+    for key in kept[2:] + [key for keys in removed.values() for key in keys]:
+        put(store, key)
+
+    report = run(sweeper.sweep())
+    assert report["removed"] == {**{kind: len(keys) for kind, keys in removed.items()}, "temp_files": 0}
+    assert stored_keys(store) == sorted(kept)
+
+
+def test_young_blobs_are_left_alone(db, store):
+    put(store, "file-3_real.enc")
+    sweeper = StorageSweeper(db, store, interval=0, max_deletes_per_second=0, min_age=timedelta(hours=1))
+    assert run(sweeper.sweep())["removed"]["orphan_blobs"] == 0
+    assert stored_keys(store) == ["file-3_real.enc"]
+
+
+def test_dry_run_only_reports(db, store):
+    put(store, "file-3_real.enc", b"x" * 10)
+    now = datetime.now(timezone.utc)
+    run(db.share_links.insert_one({"id": "link-1", "is_active": True, "expiry_date": now - timedelta(days=1)}))
+    sweeper = StorageSweeper(db, store, interval=0, max_deletes_per_second=0, min_age=timedelta(0), dry_run=True)
+    report = run(sweeper.sweep())
+    assert (report["removed"]["orphan_blobs"], report["bytes_reclaimed"], report["links_expired"]) == (1, 10, 1)
+    assert stored_keys(store) == ["file-3_real.enc"]
+    assert run(db.share_links.find_one({"id": "link-1"}))["is_active"] is True
+    assert sweeper.stats()["removed"]["orphan_blobs"] == 0
+
+
+def test_temp_files_and_expired_links(db, store, tmp_path):
+    temp_dir = tmp_path / "uploads"
+    temp_dir.mkdir()
+    for name in ("temp_1.tmp", "temp_2.tmp", "keep.tmp"):
+        (temp_dir / name).write_bytes(b"plaintext")
+    now = datetime.now(timezone.utc)
+    run(db.share_links.insert_many([
+        {"id": "link-1", "is_active": True, "expiry_date": now - timedelta(minutes=1)},
+        {"id": "link-2", "is_active": True, "expiry_date": now + timedelta(days=1)},
+        {"id": "link-3", "is_active": False, "expiry_date": now - timedelta(days=1)},
+    ]))
+    sweeper = StorageSweeper(db, store, temp_dir=temp_dir, interval=0, batch_size=1, max_deletes_per_second=0,
+                             min_age=timedelta(0))
+    report = run(sweeper.sweep())
+    assert (report["removed"]["temp_files"], report["links_expired"]) == (2, 1)
+    assert sorted(path.name for path in temp_dir.iterdir()) == ["keep.tmp"]
+    active = run(db.share_links.find({"is_active": True}, {"_id": 0, "id": 1}).to_list(None))
+    assert active == [{"id": "link-2"}]
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Resumable chunked uploads (backend/upload_sessions.py).
+
+Sessions live in an in-memory MongoDB (mongomock-motor) and parts in a
+LocalBlobStore under a temporary directory. Chunks are one encryption
+segment each, so the files stay a few segments long.
+
+Run with pytest, or directly: python backend_upload_sessions_test.py
+"""
+import asyncio
+import hashlib
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from fastapi import HTTPException
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from blob_format import SEGMENT_SIZE, decrypt_blob  # noqa: E402
+from blob_store import LocalBlobStore  # noqa: E402
+from upload_sessions import UploadSessions  # noqa: E402
+
+REAL_SIZE = 2 * SEGMENT_SIZE + SEGMENT_SIZE // 2
+DECOY = b"nothing to see here"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalBlobStore(tmp_path / "blobs")
+
+
+@pytest.fixture
+def sessions(store):
+    return UploadSessions(AsyncMongoMockClient()["secureshare_test"].upload_sessions, store, chunk_size=SEGMENT_SIZE)
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key()
+
+
+@pytest.fixture
+def real():
+    return os.urandom(REAL_SIZE)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def body(data: bytes, piece: int = 64 * 1024):
+    for start in range(0, len(data), piece):
+        yield data[start:start + piece]
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunks_of(data: bytes):
+    return [data[start:start + SEGMENT_SIZE] for start in range(0, len(data), SEGMENT_SIZE)]
+
+
+def create(sessions, key):
+    return run(sessions.create("user-1", {
+        "real": {"filename": "report.pdf", "size": REAL_SIZE},
+        "decoy": {"filename": "decoy.pdf", "size": len(DECOY)}
+    }, key))
+
+
+def put(sessions, session_id, variant, index, data, checksum=None):
+    async def upload():
+        # Each request reads the session afresh, as the API does
+        session = await sessions.get(session_id, "user-1")
+        await sessions.put_chunk(session, variant, index, body(data), checksum or sha256(data))
+    run(upload())
+
+
+def finalize(sessions, store, session_id):
+    """Assemble both files; returns their plaintexts as read back from the store"""
+    async def assemble():
+        session = await sessions.begin_finalize(session_id, "user-1")
+        contents = {}
+        for variant in ("real", "decoy"):
+            blob_key = f"{session['file_id']}_{variant}.enc"
+            await sessions.assemble(session, variant, blob_key)
+            contents[variant] = b"".join([data async for data in store.get(blob_key)])
+        await sessions.complete(session)
+        return contents
+    return run(assemble())
+
+
+def stored_keys(store):
+    async def keys():
+        return sorted([stat.key async for stat in store.list()])
+    return run(keys())
+
+
+def test_chunks_in_any_order_assemble(sessions, store, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+    for index in (2, 0, 1):
+        put(sessions, session["id"], "real", index, chunks[index])
+    put(sessions, session["id"], "decoy", 0, DECOY)
+
+    contents = finalize(sessions, store, session["id"])
+    assert decrypt_blob(contents["real"], key) == real
+    assert decrypt_blob(contents["decoy"], key) == DECOY
+    # Only the assembled blobs are left
+    file_id = run(sessions.get(session["id"], "user-1"))["file_id"]
+    assert stored_keys(store) == [f"{file_id}_decoy.enc", f"{file_id}_real.enc"]
+
+
+def test_progress(sessions, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+    put(sessions, session["id"], "real", 0, chunks[0])
+    put(sessions, session["id"], "real", 2, chunks[2])
+
+    progress = sessions.progress(run(sessions.get(session["id"], "user-1")))
+    assert progress["files"]["real"]["received"] == [0, 2]
+    assert progress["files"]["real"]["missing"] == [1]
+    assert progress["files"]["real"]["offset"] == SEGMENT_SIZE
+    assert progress["files"]["decoy"]["missing"] == [0]
+
+
+def test_identical_resend_is_accepted(sessions, store, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+    put(sessions, session["id"], "real", 0, chunks[0])
+    parts = stored_keys(store)
+    put(sessions, session["id"], "real", 0, chunks[0])
+    # The retry reuses the stored part
+    assert stored_keys(store) == parts
+
+    for index in (1, 2):
+        put(sessions, session["id"], "real", index, chunks[index])
+    put(sessions, session["id"], "decoy", 0, DECOY)
+    assert decrypt_blob(finalize(sessions, store, session["id"])["real"], key) == real
+
+
+def test_resend_with_different_content_is_refused(sessions, store, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+    put(sessions, session["id"], "real", 0, chunks[0])
+    other = os.urandom(SEGMENT_SIZE)
+    with pytest.raises(HTTPException) as error:
+        put(sessions, session["id"], "real", 0, other)
+    assert error.value.status_code == 409
+
+    for index in (1, 2):
+        put(sessions, session["id"], "real", index, chunks[index])
+    put(sessions, session["id"], "decoy", 0, DECOY)
+    assert decrypt_blob(finalize(sessions, store, session["id"])["real"], key) == real
+
+
+def test_concurrent_different_uploads_of_one_chunk(sessions, store, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+    other = os.urandom(SEGMENT_SIZE)
+
+    async def race():
+        snapshot = await sessions.get(session["id"], "user-1")
+        return await asyncio.gather(
+            sessions.put_chunk(snapshot, "real", 0, body(chunks[0]), sha256(chunks[0])),
+            sessions.put_chunk(snapshot, "real", 0, body(other), sha256(other)),
+            return_exceptions=True
+        )
+
+    results = run(race())
+    errors = [result for result in results if isinstance(result, HTTPException)]
+    assert len(errors) == 1 and errors[0].status_code == 409
+    winner = chunks[0] if results[0] is None else other
+
+    for index in (1, 2):
+        put(sessions, session["id"], "real", index, chunks[index])
+    put(sessions, session["id"], "decoy", 0, DECOY)
+    assert decrypt_blob(finalize(sessions, store, session["id"])["real"], key) == winner + real[SEGMENT_SIZE:]
+
+
+def test_concurrent_identical_uploads_of_one_chunk(sessions, store, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+
+    async def race():
+        snapshot = await sessions.get(session["id"], "user-1")
+        await asyncio.gather(*(
+            sessions.put_chunk(snapshot, "real", 0, body(chunks[0]), sha256(chunks[0])) for _ in range(3)
+        ))
+
+    run(race())
+    # The losing uploads removed their own parts
+    assert len(stored_keys(store)) == 1
+
+
+@pytest.mark.parametrize("data,checksum", [
+    (b"short", None),
+    (os.urandom(SEGMENT_SIZE + 1), None),
+    (os.urandom(SEGMENT_SIZE), "0" * 64),
+])
+def test_invalid_chunk(sessions, store, key, data, checksum):
+    session = create(sessions, key)
+    with pytest.raises(HTTPException) as error:
+        put(sessions, session["id"], "real", 0, data, checksum)
+    assert error.value.status_code == 400
+    assert stored_keys(store) == []
+
+
+def test_chunk_index_out_of_range(sessions, key):
+    session = create(sessions, key)
+    with pytest.raises(HTTPException) as error:
+        put(sessions, session["id"], "decoy", 1, DECOY)
+    assert error.value.status_code == 400
+
+
+def test_finalize_incomplete(sessions, key, real):
+    session = create(sessions, key)
+    put(sessions, session["id"], "real", 0, chunks_of(real)[0])
+    with pytest.raises(HTTPException) as error:
+        run(sessions.begin_finalize(session["id"], "user-1"))
+    assert error.value.status_code == 400
+    # Still open for the missing chunks
+    assert run(sessions.get(session["id"], "user-1"))["status"] == "open"
+
+
+def test_no_chunks_while_finalizing(sessions, key, real):
+    session = create(sessions, key)
+    chunks = chunks_of(real)
+    for index, chunk in enumerate(chunks):
+        put(sessions, session["id"], "real", index, chunk)
+    put(sessions, session["id"], "decoy", 0, DECOY)
+    run(sessions.begin_finalize(session["id"], "user-1"))
+    with pytest.raises(HTTPException) as error:
+        put(sessions, session["id"], "real", 0, chunks[0])
+    assert error.value.status_code == 409
+
+
+def test_sweep_removes_expired_sessions(sessions, store, key, real):
+    session = create(sessions, key)
+    put(sessions, session["id"], "real", 0, chunks_of(real)[0])
+    run(sessions.collection.update_one(
+        {"id": session["id"]}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    ))
+    assert run(sessions.sweep()) == 1
+    assert stored_keys(store) == []
+    with pytest.raises(HTTPException):
+        run(sessions.get(session["id"], "user-1"))
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
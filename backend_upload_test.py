@@ -0,0 +1,149 @@
+"""Streaming upload encryption (store_encrypted_upload and POST
+/api/files/upload in backend/server.py).
+
+server.py is imported with placeholder settings; its database is swapped
+for an in-memory MongoDB (mongomock-motor) and its blob store for a
+LocalBlobStore under a temporary directory. Startup hooks do not run and
+nothing sends email.
+
+Run with pytest, or directly: python backend_upload_test.py
+"""
+import asyncio
+import base64
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from fastapi import UploadFile
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+for name, value in (("MONGO_URL", "mongodb://localhost:27017"), ("DB_NAME", "secureshare_upload_test"),
+                    ("SENDGRID_API_KEY", "unused"), ("SENDGRID_FROM_EMAIL", "test@example.com")):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import server  # noqa: E402
+from blob_dedup import BlobDeduplicator  # noqa: E402
+from blob_format import (  # noqa: E402
+    FORMAT_AEAD, FORMAT_AEAD_COMPRESSED, SEGMENT_SIZE, decrypt_blob, is_segmented
+)
+from blob_store import LocalBlobStore  # noqa: E402
+from segment_cache import SegmentCache  # noqa: E402
+
+USER = {"id": "user-1", "email": "owner@example.com", "name": "Owner"}
+TEXT = b"Quarterly figures, nothing to see here.\n" * 2000
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class RecordingUpload(UploadFile):
+    """Remembers how much each read asked for"""
+
+    def __init__(self, data: bytes):
+        super().__init__(io.BytesIO(data), filename="upload.bin")
+        self.reads = []
+
+    async def read(self, size: int = -1) -> bytes:
+        self.reads.append(size)
+        return await super().read(size)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = LocalBlobStore(tmp_path / "blobs")
+    db = AsyncMongoMockClient(tz_aware=True)["secureshare_test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "blob_store", store)
+    monkeypatch.setattr(server, "blob_dedup", BlobDeduplicator(db.blobs, store, "dedup-secret"))
+    monkeypatch.setattr(server, "segment_cache", SegmentCache(store, max_bytes=0))
+    return store
+
+
+@pytest.fixture
+def client(store):
+    server.app.dependency_overrides[server.get_current_user] = lambda: USER
+    yield TestClient(server.app)
+    server.app.dependency_overrides.clear()
+
+
+def blob(store, key: str) -> bytes:
+    return (Path(store.root) / key).read_bytes()
+
+
+def stored_keys(store) -> list:
+    return sorted(path.name for path in Path(store.root).iterdir())
+
+
+@pytest.mark.parametrize("size", [0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, 2 * SEGMENT_SIZE + 5])
+def test_encrypts_any_size(store, size):
+    plaintext, key = os.urandom(size), Fernet.generate_key()
+    blob_format = run(server.store_encrypted_upload(RecordingUpload(plaintext), "blob.enc", key))
+    assert blob_format == FORMAT_AEAD
+    data = blob(store, "blob.enc")
+    assert is_segmented(data)
+    assert decrypt_blob(data, key) == plaintext
+
+
+def test_reads_one_segment_at_a_time(store):
+    upload = RecordingUpload(os.urandom(3 * SEGMENT_SIZE + 10))
+    run(server.store_encrypted_upload(upload, "blob.enc", Fernet.generate_key()))
+    # Never the whole file at once: one read per segment, the last one short
+    assert upload.reads == [SEGMENT_SIZE] * 4
+
+
+def test_compressible_upload_is_compressed(store):
+    key = Fernet.generate_key()
+    assert run(server.store_encrypted_upload(RecordingUpload(TEXT), "blob.enc", key)) == FORMAT_AEAD_COMPRESSED
+    assert len(blob(store, "blob.enc")) < len(TEXT) // 2
+    assert decrypt_blob(blob(store, "blob.enc"), key) == TEXT
+
+
+def test_upload_route(client, store):
+    real = os.urandom(SEGMENT_SIZE + 100)
+    response = client.post("/api/files/upload", files={
+        "real_file": ("report.pdf", real, "application/pdf"),
+        "decoy_file": ("notes.txt", TEXT, "text/plain"),
+    })
+    assert response.status_code == 200, response.text
+    doc = run(server.db.files.find_one({"id": response.json()["file_id"]}))
+    assert (doc["filename"], doc["decoy_filename"]) == ("report.pdf", "notes.txt")
+    assert (doc["file_size"], doc["decoy_file_size"]) == (len(real), len(TEXT))
+    assert (doc["real_blob_format"], doc["decoy_blob_format"]) == (FORMAT_AEAD, FORMAT_AEAD_COMPRESSED)
+    assert "blob_format" not in doc
+    for variant, plaintext in (("real", real), ("decoy", TEXT)):
+        key = base64.b64decode(doc[f"{variant}_encryption_key"])
+        assert decrypt_blob(blob(store, doc[f"{variant}_blob_key"]), key) == plaintext
+    # Only ciphertext reaches storage
+    assert stored_keys(store) == sorted([doc["real_blob_key"], doc["decoy_blob_key"]])
+
+
+def test_failed_decoy_releases_the_real_blob(client, store, monkeypatch):
+    store_encrypted_upload = server.store_encrypted_upload
+
+    async def failing_decoy(upload, blob_key, key):
+        if upload.filename == "notes.txt":
+            raise OSError("disk full")
+        return await store_encrypted_upload(upload, blob_key, key)
+
+    monkeypatch.setattr(server, "store_encrypted_upload", failing_decoy)
+    with pytest.raises(OSError):
+        client.post("/api/files/upload", files={
+            "real_file": ("report.pdf", os.urandom(100), "application/pdf"),
+            "decoy_file": ("notes.txt", TEXT, "text/plain"),
+        })
+    assert run(server.db.files.count_documents({})) == 0
+    assert run(server.db.blobs.count_documents({"refcount": {"$gt": 0}})) == 0
+    assert stored_keys(store) == []
+
+
+def main():
+    sys.exit(pytest.main([__file__, "-v"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+// A correct password turned away because the link's download limit was used up is neither
+// an authorized access nor an intrusion
+export const attemptStatus = (attempt) => {
+  if (attempt.outcome === 'limit_reached') return 'limit_reached';
+  return attempt.password_correct ? 'authorized' : 'intrusion';
+};
+
+export const STATUS_STYLES = {
+  authorized: {
+    entry: 'border-primary bg-primary/5',
+    badge: 'bg-primary text-primary-foreground',
+    label: '✓ Authorized',
+  },
+  limit_reached: {
+    entry: 'border-muted-foreground bg-muted/20',
+    badge: 'bg-muted text-muted-foreground',
+    label: '⛔ Limit reached',
+  },
+  intrusion: {
+    entry: 'border-destructive bg-destructive/5 glow-red',
+    badge: 'bg-destructive text-destructive-foreground',
+    label: '⚠️ Intrusion',
+  },
+};
@@ -40,6 +40,8 @@ export default function AccessFile() {
     setLoading(true);
 
     try {
+      // Verification returns a short-lived download ticket; the browser then
+      // downloads (and can resume) the file directly
       const response = await axios.post(
         `${API}/access/verify-otp`,
         {
@@ -48,25 +50,12 @@ export default function AccessFile() {
           password: password,
         },
         {
-          responseType: 'blob',
+          headers: { Accept: 'application/json' },
         }
       );
 
-      // Extract filename from Content-Disposition header
-      const contentDisposition = response.headers['content-disposition'];
-      let filename = 'download';
-      if (contentDisposition) {
-        const filenameMatch = contentDisposition.match(/filename="?(.+?)"?$/i);
-        if (filenameMatch) {
-          filename = filenameMatch[1];
-        }
-      }
-
-      // Create download link
-      const url = window.URL.createObjectURL(new Blob([response.data]));
       const link = document.createElement('a');
-      link.href = url;
-      link.setAttribute('download', filename);
+      link.href = `${BACKEND_URL}${response.data.download_url}`;
       document.body.appendChild(link);
       link.click();
       link.remove();
@@ -3,8 +3,9 @@ import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { toast } from 'sonner';
 import { Button } from '@/components/ui/button';
-import { ArrowLeft, Activity, ShieldCheck, AlertTriangle, CheckCircle } from 'lucide-react';
+import { ArrowLeft, Activity, ShieldCheck, AlertTriangle, CheckCircle, Ban } from 'lucide-react';
 import { motion } from 'framer-motion';
+import { attemptStatus, STATUS_STYLES } from '@/lib/attempts';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -49,8 +50,9 @@ export default function AccessLogs() {
   };
 
   const filteredAttempts = attempts.filter((attempt) => {
-    if (filter === 'authorized') return attempt.password_correct;
-    if (filter === 'intrusions') return !attempt.password_correct;
+    if (filter === 'authorized') return attemptStatus(attempt) === 'authorized';
+    if (filter === 'limit_reached') return attemptStatus(attempt) === 'limit_reached';
+    if (filter === 'intrusions') return attemptStatus(attempt) === 'intrusion';
     return true;
   });
 
@@ -99,6 +101,14 @@ export default function AccessLogs() {
               >
                 Authorized
               </Button>
+              <Button
+                variant={filter === 'limit_reached' ? 'default' : 'outline'}
+                onClick={() => setFilter('limit_reached')}
+                data-testid="logs-filter-limit-reached"
+                className={filter === 'limit_reached' ? 'bg-muted text-foreground' : ''}
+              >
+                Limit Reached
+              </Button>
               <Button
                 variant={filter === 'intrusions' ? 'default' : 'outline'}
                 onClick={() => setFilter('intrusions')}
@@ -123,17 +133,15 @@ export default function AccessLogs() {
                   initial={{ opacity: 0, y: 20 }}
                   animate={{ opacity: 1, y: 0 }}
                   transition={{ delay: idx * 0.05 }}
-                  className={`border rounded-lg p-6 ${
-                    attempt.password_correct
-                      ? 'border-primary bg-primary/5'
-                      : 'border-destructive bg-destructive/5 glow-red'
-                  }`}
+                  className={`border rounded-lg p-6 ${STATUS_STYLES[attemptStatus(attempt)].entry}`}
                   data-testid={`log-entry-${idx}`}
                 >
                   <div className="flex items-start justify-between">
                     <div className="flex items-start gap-4 flex-1">
-                      {attempt.password_correct ? (
+                      {attemptStatus(attempt) === 'authorized' ? (
                         <CheckCircle className="h-8 w-8 text-primary mt-1" />
+                      ) : attemptStatus(attempt) === 'limit_reached' ? (
+                        <Ban className="h-8 w-8 text-muted-foreground mt-1" />
                       ) : (
                         <AlertTriangle className="h-8 w-8 text-destructive mt-1" />
                       )}
@@ -143,12 +151,11 @@ export default function AccessLogs() {
                           <h3 className="font-semibold text-lg">{attempt.filename}</h3>
                           <span
                             className={`px-3 py-1 rounded-full text-sm font-semibold ${
-                              attempt.password_correct
-                                ? 'bg-primary text-primary-foreground'
-                                : 'bg-destructive text-destructive-foreground'
+                              STATUS_STYLES[attemptStatus(attempt)].badge
                             }`}
+                            data-testid={`log-status-${idx}`}
                           >
-                            {attempt.password_correct ? '✓ Authorized' : '⚠️ Intrusion'}
+                            {STATUS_STYLES[attemptStatus(attempt)].label}
                           </span>
                         </div>
 
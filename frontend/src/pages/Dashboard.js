@@ -5,6 +5,7 @@ import { toast } from 'sonner';
 import { Button } from '@/components/ui/button';
 import { ShieldCheck, Upload, Share2, Activity, Settings, LogOut, FileKey, AlertTriangle, Eye } from 'lucide-react';
 import { motion } from 'framer-motion';
+import { attemptStatus, STATUS_STYLES } from '@/lib/attempts';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -47,7 +48,7 @@ export default function Dashboard() {
     navigate('/login');
   };
 
-  const unauthorizedAttempts = attempts.filter(a => !a.password_correct);
+  const unauthorizedAttempts = attempts.filter(a => attemptStatus(a) === 'intrusion');
 
   return (
     <div className="min-h-screen p-4 md:p-8" data-testid="dashboard">
@@ -159,9 +160,7 @@ export default function Dashboard() {
               {attempts.map((attempt, idx) => (
                 <div
                   key={idx}
-                  className={`p-4 rounded-lg border ${
-                    attempt.password_correct ? 'border-primary bg-primary/5' : 'border-destructive bg-destructive/5 glow-red'
-                  }`}
+                  className={`p-4 rounded-lg border ${STATUS_STYLES[attemptStatus(attempt)].entry}`}
                   data-testid={`dashboard-attempt-${idx}`}
                 >
                   <div className="flex items-center justify-between">
@@ -173,11 +172,9 @@ export default function Dashboard() {
                     </div>
                     <div className="text-right">
                       <span
-                        className={`px-3 py-1 rounded-full text-sm font-semibold ${
-                          attempt.password_correct ? 'bg-primary text-primary-foreground' : 'bg-destructive text-destructive-foreground'
-                        }`}
+                        className={`px-3 py-1 rounded-full text-sm font-semibold ${STATUS_STYLES[attemptStatus(attempt)].badge}`}
                       >
-                        {attempt.password_correct ? '✓ Authorized' : '⚠️ Intrusion'}
+                        {STATUS_STYLES[attemptStatus(attempt)].label}
                       </span>
                       <p className="text-xs text-muted-foreground mt-1">
                         Served: {attempt.file_type_served}